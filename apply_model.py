@@ -6,53 +6,122 @@ import numpy as np
 from scipy.stats import linregress
 
 import calibrate as cal
+import ensemble
+import project_settings as settings
 
 log = logging.getLogger('apply_model')
 
-def apply_model(data, cal_data, start_date, end_date):
+def apply_model(data, cal_data, start_date, end_date, num_workers=None,
+                ensemble_size=None):
     """Applies all models found in cal.FUNCS to the given data
     
 data: must contain all the discharge, temperature, snow and precip 
       data as produced by prepare.py.
 cal_data: all data that calibration produces.
 start_date/end_date: date range over which to apply model.
+num_workers: number of processes to apply the models in at once,
+             settings.MODEL_WORKERS if None.
+ensemble_size: number of param sets to run an ensemble of each model
+               with (see apply_ensemble), settings.ENSEMBLE_SIZE if None.
+               0 for no ensemble.
 
 returns the result of applying the model.
 """
-    discharge   = data['discharge']
-    temperature = data['temperature']
-    snow_data   = data['snow']
-    precip      = data['precip']
-
-    dates = snow_data['dates']
-    date_mask = ((dates >= start_date) & (dates <= end_date))
-    # If looking at 2009-2010 data, discharge data only runs up to
-    # end of 2010, hence it's shorter than dates.
-    discharge_for_year = discharge[date_mask[:len(discharge)]]
-    temperature_for_year = temperature[date_mask]
-    snow_prop_for_year = snow_data['COMBINED_total_snow'][date_mask]
-    precip_for_year = precip[date_mask[:len(precip)]]
-
-    model_data = {'temp': temperature_for_year, 
-	          'snowprop': snow_prop_for_year,
-	          'precip': precip_for_year }
+    if num_workers is None:
+        num_workers = settings.MODEL_WORKERS
+    if ensemble_size is None:
+        ensemble_size = settings.ENSEMBLE_SIZE
+    dates, discharge_for_year, model_data = cal.calibration_period_data(data,
+                                                       start_date, end_date)
 
-    app_data = {}
-    for k, v in cal.FUNCS:
-	func = v['f']
-	p_est = cal_data[k]['p_est']
-	# N.B. a is slope, b is intercept.
-	a, b, r_val, p_val, stderr = linregress(discharge_for_year, 
-						func(p_est, model_data))
-
-	log.info("Func %s"%k)
-	log.info("  slope, intercept: %f, %f"%(a, b))
-	log.info("  r-value, p-value: %f, %f"%(r_val, p_val))
-	log.info("  Std. err.: %f"%(stderr))
-	app_data[k] = {'a': a, 'b': b, 'r_val': r_val, 
-	    'dates': dates[date_mask],
-	    'discharge_for_year': discharge_for_year,
-	    'model_data': model_data,
-	    'start_date': start_date }
+    args = [(k, cal_data[k]['p_est'], dates, discharge_for_year, model_data,
+             start_date, cal_data[k] if ensemble_size else None, 
+             ensemble_size) for k, v in cal.FUNCS]
+    func_app_datas = cal.map_in_pool(_apply_func, args, 
+                                     min(num_workers, len(cal.FUNCS)))
 
+    app_data = {}
+    for (k, v), func_app_data in zip(cal.FUNCS, func_app_datas):
+        app_data[k] = func_app_data
     return app_data
+
+def _apply_func(args):
+    """Calls apply_func(*args), module level for multiprocessing.Pool"""
+    return apply_func(*args)
+
+def apply_func(k, p_est, dates, discharge_for_year, model_data, start_date,
+               func_cal_data=None, ensemble_size=0):
+    """Applies function k in cal.FUNCS with params p_est, see apply_model
+
+If ensemble_size, an ensemble is also run using func_cal_data (the 
+calibration data for function k) and put in 'ensemble'.
+"""
+    func = dict(cal.FUNCS)[k]['f']
+    # N.B. a is slope, b is intercept.
+    a, b, r_val, p_val, stderr = linregress(discharge_for_year, 
+                                            func(p_est, model_data))
+
+    log.info("Func %s"%k)
+    log.info("  slope, intercept: %f, %f"%(a, b))
+    log.info("  r-value, p-value: %f, %f"%(r_val, p_val))
+    log.info("  Std. err.: %f"%(stderr))
+    func_app_data = {'a': a, 'b': b, 'r_val': r_val, 
+        'dates': dates,
+        'discharge_for_year': discharge_for_year,
+        'model_data': model_data,
+        'start_date': start_date }
+    if ensemble_size:
+        func_app_data['ensemble'] = apply_ensemble(k, func_cal_data, 
+                                        discharge_for_year, model_data, 
+                                        ensemble_size)
+    return func_app_data
+
+def apply_ensemble(k, func_cal_data, discharge_for_year, model_data, 
+                   ensemble_size, seed=0):
+    """Runs an ensemble of function k in cal.FUNCS over model_data
+
+ensemble_size param sets are drawn around the calibrated params using
+settings.ENSEMBLE_SAMPLING (see ensemble.draw_param_sets), and run in 
+batches. If settings.ENSEMBLE_RESIDUAL_NOISE, noise with the spread of
+the calibration residuals is added to each run, so that the bands are 
+prediction intervals for discharge.
+
+Returns the settings.ENSEMBLE_PERCENTILES bands, mean and std. dev. of
+the ensemble (see ensemble.run_ensemble), along with the linear 
+regression of its mean against discharge ('a', 'b', 'r_val') and the 
+fraction of days the observed discharge is within the outermost bands
+('coverage').
+"""
+    func_info = dict(cal.FUNCS)[k]
+    p_est = func_cal_data['p_est']
+    cal_model_data = func_cal_data['model_data']
+    cal_discharge = func_cal_data['discharge_for_year']
+
+    param_sets = ensemble.draw_param_sets(func_info, p_est, cal_model_data, 
+                                          cal_discharge, ensemble_size, 
+                                          settings.ENSEMBLE_SAMPLING,
+                                          settings.ENSEMBLE_SPREAD, seed)
+    noise_std = 0.
+    if settings.ENSEMBLE_RESIDUAL_NOISE:
+        noise_std = ensemble.residual_std(func_info, p_est, cal_model_data,
+                                          cal_discharge)
+    ens = ensemble.run_ensemble(func_info, param_sets, model_data, 
+                                settings.ENSEMBLE_PERCENTILES, noise_std, 
+                                seed)
+
+    valid = ensemble.valid_days(func_info, p_est, model_data, 
+                                discharge_for_year)
+    discharge = np.asarray(discharge_for_year, dtype=float)[valid]
+    a, b, r_val, p_val, stderr = linregress(discharge, ens['mean'][valid])
+    bands = ens['bands'][:, valid]
+    coverage = ((discharge >= bands.min(axis=0)) & 
+                (discharge <= bands.max(axis=0))).mean()
+    ens.update({'a': a, 'b': b, 'r_val': r_val, 'coverage': coverage,
+                'param_sets': param_sets})
+
+    log.info("  Ensemble of %i, mean slope, intercept: %f, %f"%(
+             ensemble_size, a, b))
+    log.info("  Ensemble r-value: %f, discharge within %s-%s%% bands on "
+             "%2.1f%% of days"%(r_val, min(ens['percentiles']), 
+                                max(ens['percentiles']), 100 * coverage))
+    return ens
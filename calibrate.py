@@ -1,7 +1,11 @@
 #!/usr/bin/python
+import time
 import logging
+import multiprocessing
 import datetime as dt
 
+import numpy as np
+import numpy.ma as ma
 import matplotlib
 import pylab as plt
 from scipy import optimize
@@ -9,6 +13,8 @@ from scipy.stats import linregress
 
 from external import snow_model_accum as sma
 
+import project_settings as settings
+
 log = logging.getLogger('calibrate')
 
 def obj_exp_dec(p, x, y):
@@ -17,102 +23,440 @@ def obj_exp_dec(p, x, y):
 def obj_exp_dec_with_precip(p, x, y):
     return ((func_exp_dec_with_precip(p, x) - y)**2).sum()
 
+def obj_invgauss(p, x, y):
+    return ((func_invgauss(p, x) - y)**2).sum()
+
 def func_exp_dec(p, x):
-    return sma.model_accum_exp_decrease(x, p[0], p[1], p[2])
+    return sma.model_accum_exp_decrease(x, p[0], p[1], p[2], 
+                                        engine=settings.NRF_ENGINE)
 
 def func_exp_dec_with_precip(p, x):
-    return sma.model_accum_exp_decrease_with_precip(x, p)
+    return sma.model_accum_exp_decrease_with_precip(x, p, 
+                                                    engine=settings.NRF_ENGINE)
+
+def func_invgauss(p, x):
+    return sma.model_accum_invgauss_decrease(x, p, engine=settings.NRF_ENGINE)
+
+# Return (model output, Jacobian) for gradient based CAL_METHODS.
+def jac_exp_dec(p, x):
+    return sma.jac_accum_exp_decrease(x, p[0], p[1], p[2])
+
+def jac_exp_dec_with_precip(p, x):
+    return sma.jac_accum_exp_decrease_with_precip(x, p)
+
+# Return model output for many params at once, P has shape (K, num_params).
+def batch_exp_dec(P, x):
+    return sma.model_accum_exp_decrease_batch(x, P)
+
+def batch_exp_dec_with_precip(P, x):
+    return sma.model_accum_exp_decrease_with_precip_batch(x, P)
+
+# Max number of param sets the batch functions are given at once, limits
+# memory use to BATCH_SIZE * num_days floats (a few times over).
+BATCH_SIZE = 1000
+
+# Methods that can be used to fit the models in FUNCS, see fit_model.
+CAL_METHODS = ('powell', 'l-bfgs-b', 'least_squares')
+
+# Global searches that can be done before/instead of fitting from p_guess,
+# see global_search.
+SEARCH_MODES = ('grid', 'multistart')
+
+# Bounds on the params: temperature threshold, k and p (exp. decay rate).
+TEMP_THRESH_BOUNDS = (-40., 40.)
+K_BOUNDS = (0., None)
+P_BOUNDS = (0., 0.9999)
 
 FUNCS = (('exponential decay model', 
           {'f': func_exp_dec, 
 	   'p_guess':[  5.55677672e+00,   1.26624410e-05,   9.72481286e-01], 
-	   'o': obj_exp_dec}),
-	 #('inv_gauss', {'f': func4, 'p_guess':[8.4, 0.000045, 1.35537962e-02,   4.99842790e-04,   2.45289445e+00, -2.81229089e-03,   9.67786847e-03], 'o': obj4}),
+	   'o': obj_exp_dec,
+	   'jac': jac_exp_dec,
+	   'batch': batch_exp_dec,
+	   'bounds': [TEMP_THRESH_BOUNDS, K_BOUNDS, P_BOUNDS],
+	   # Params the model is a step function of, see ensemble.
+	   'thresholds': (0,),
+	   # (start, stop, step) for each param, as for optimize.brute.
+	   'grid': ((0, 20, 1), 
+		    (0.0, 0.00001, 0.000001), 
+		    (0.9, 0.99, 0.01))}),
+	 #('inv_gauss', {'f': func_invgauss, 'p_guess':[8.4, 0.000045, 1.35537962e-02,   4.99842790e-04,   2.45289445e+00, -2.81229089e-03,   9.67786847e-03], 'o': obj_invgauss}),
          ('exponential decay with precip. model', 
           {'f': func_exp_dec_with_precip, 
 	   'p_guess':[5.55677672e+00, 1, 1.26624410e-05, 0.00009, 9.72481286e-01, 0.99], 
-	   'o': obj_exp_dec_with_precip}))
+	   'o': obj_exp_dec_with_precip,
+	   'jac': jac_exp_dec_with_precip,
+	   'batch': batch_exp_dec_with_precip,
+	   'bounds': [TEMP_THRESH_BOUNDS, TEMP_THRESH_BOUNDS, K_BOUNDS, K_BOUNDS,
+	              P_BOUNDS, P_BOUNDS],
+	   'thresholds': (0, 1),
+	   'grid': ((0, 10, 1), 
+		    (0, 10, 1), 
+		    (0.0, 0.00001, 0.000005), 
+		    (0.0, 0.00001, 0.000005), 
+		    (0.9, 0.99, 0.02),
+		    (0.9, 0.99, 0.02))}))
 
-def calibrate_model(data, start_date, end_date):
-    '''Performs a full calibration using the powell method for optimization
+def fit_model(func_info, model_data, discharge, method='powell', 
+              p_start=None):
+    '''Fits one of the models in FUNCS to discharge, starting from p_guess
+(or p_start if given)
 
-Works on as many functions as are provided in FUNCS.
-uses data as the input and observed data to calibrate with.
-works between start_date and end_date, which define the cal period.
+method: one of CAL_METHODS:
+ 'powell': fmin_powell on the sum of squares objective 'o', no derivatives.
+ 'l-bfgs-b': quasi-Newton minimisation of the sum of squares, using the
+             Jacobian 'jac' for its gradient, within 'bounds'.
+ 'least_squares': trust region least squares on the residuals, using the
+                  Jacobian 'jac', within 'bounds'.
+If the model has no 'jac', derivatives are found by finite differences.
 
-returns a dict with all the calibration info for the functions calibrated.
+Returns (p_est, fit_info), fit_info is a dict with the 'method', 
+'nfev' and 'njev' (number of model and Jacobian evaluations), 'time'
+taken (secs) and final 'objective' value.
 '''
+    if method not in CAL_METHODS:
+        raise Exception('Unknown calibration method %s, use one of %s'%(
+                        method, str(CAL_METHODS)))
+    start_time = time.time()
+    counts = {'nfev': 0, 'njev': 0}
+    if p_start is None:
+        p_start = func_info['p_guess']
+    p_guess = np.array(p_start, dtype=float)
+    func, jac = func_info['f'], func_info.get('jac')
+    y = np.asarray(discharge, dtype=float)
+    # Days where both the model and discharge have values.
+    valid = ~(ma.getmaskarray(func(p_guess, model_data)) | 
+              ma.getmaskarray(discharge))
+
+    def residuals(p):
+        counts['nfev'] += 1
+        return np.asarray(func(p, model_data))[valid] - y[valid]
+
+    # Model output and Jacobian for last params, as the optimizers ask for
+    # residuals and Jacobian separately.
+    last = {}
+    def residuals_and_jac(p):
+        if last.get('p') is None or (last['p'] != p).any():
+            counts['nfev'] += 1
+            counts['njev'] += 1
+            accum, jac_values = jac(p, model_data)
+            last.update({'p': p.copy(), 'r': accum[valid] - y[valid],
+                         'jac': jac_values[valid]})
+        return last['r'], last['jac']
+
+    # Gradient based methods work much better if all params have a similar
+    # effect, so scale them by how much the model changes with each.
+    scale = np.where(p_guess != 0, np.abs(p_guess), 1.)
+    if jac is not None and method != 'powell':
+        jac_norms = np.sqrt((residuals_and_jac(p_guess)[1]**2).sum(axis=0))
+        scale[jac_norms > 0] = 1. / jac_norms[jac_norms > 0]
+    bounds = func_info.get('bounds', [(None, None)] * len(p_guess))
+    lower = np.array([-np.inf if b[0] is None else b[0] for b in bounds])
+    upper = np.array([np.inf if b[1] is None else b[1] for b in bounds])
+
+    if method == 'powell':
+        def objective_f(p, x, y):
+            counts['nfev'] += 1
+            return func_info['o'](p, x, y)
+        p_est = optimize.fmin_powell(objective_f, p_guess, 
+                                     args=(model_data, discharge),
+                                     maxfun=10000, maxiter=10000, disp=False)
+    elif method == 'l-bfgs-b':
+        if jac is None:
+            def f_and_grad(x):
+                return (residuals(x * scale)**2).sum()
+        else:
+            def f_and_grad(x):
+                r, jac_values = residuals_and_jac(x * scale)
+                return (r**2).sum(), 2. * jac_values.T.dot(r) * scale
+        result = optimize.minimize(f_and_grad, p_guess / scale, 
+                                   jac=jac is not None, method='L-BFGS-B',
+                                   bounds=zip(lower / scale, upper / scale),
+                                   options={'maxiter': 10000, 
+                                            'maxfun': 10000})
+        p_est = result.x * scale
+    elif method == 'least_squares':
+        if jac is None:
+            result = optimize.least_squares(residuals, p_guess, 
+                                            bounds=(lower, upper), 
+                                            x_scale=scale, max_nfev=10000)
+        else:
+            result = optimize.least_squares(
+                lambda p: residuals_and_jac(p)[0], p_guess, 
+                jac=lambda p: residuals_and_jac(p)[1],
+                bounds=(lower, upper), x_scale='jac', max_nfev=10000)
+        p_est = result.x
+    fit_info = {'method': method, 'time': time.time() - start_time}
+    fit_info.update(counts)
+    fit_info['objective'] = func_info['o'](p_est, model_data, discharge)
+    return p_est, fit_info
+
+def search_points(func_info, mode, num_starts=20, seed=0):
+    '''Works out the points in param space to search from for a model
+
+mode: 'grid': every point on func_info['grid'].
+      'multistart': p_guess, and num_starts - 1 points picked at random
+                    from the box that the grid covers.
+Returns an array of shape (num_points, num_params).'''
+    grid = func_info['grid']
+    if mode == 'grid':
+        points = np.mgrid[tuple(slice(*g) for g in grid)]
+        return points.reshape(len(grid), -1).T
+    elif mode == 'multistart':
+        rand = np.random.RandomState(seed)
+        lower = np.array([g[0] for g in grid], dtype=float)
+        upper = np.array([g[1] for g in grid], dtype=float)
+        starts = lower + rand.uniform(size=(num_starts - 1, len(grid))) *\
+                         (upper - lower)
+        return np.vstack((func_info['p_guess'], starts))
+    raise Exception('Unknown search mode %s, use one of %s'%(mode, 
+                                                        str(SEARCH_MODES)))
+
+def global_search(k, model_data, discharge, mode, method='powell', 
+                  num_workers=1, num_starts=20, seed=0):
+    '''Searches for the best params for model k in FUNCS
+
+mode: 'grid': evaluates the objective at every point on the model's grid
+              and fits from the best one (like optimize.brute).
+      'multistart': fits from num_starts points (see search_points) and
+                    keeps the best fit.
+method: CAL_METHOD used to fit (see fit_model).
+num_workers: size of the pool of processes that the objective 
+             evaluations/fits are shared out between.
+
+Returns (p_est, fit_info) like fit_model, the evaluation counts and time
+in fit_info cover the whole search.
+'''
+    func_info = dict(FUNCS)[k]
+    start_time = time.time()
+    points = search_points(func_info, mode, num_starts, seed)
+    log.info('  %s search over %i points using %i process(es)'%(mode, 
+             len(points), num_workers))
+
+    if mode == 'grid':
+        # Send points to the workers in chunks, a few per worker.
+        chunk_size = max(1, int(np.ceil(len(points) / (4. * num_workers))))
+        chunks = [points[i:i + chunk_size] 
+                  for i in range(0, len(points), chunk_size)]
+        objectives = np.concatenate(map_in_pool(_eval_objective_chunk, 
+                                    [(k, chunk, model_data, discharge) 
+                                     for chunk in chunks], num_workers))
+        p_best = points[np.nanargmin(objectives)]
+        log.info('  best grid point: %s, difference in squares: %2.1f'%(
+                 str(p_best), np.nanmin(objectives)))
+        p_est, fit_info = fit_model(func_info, model_data, discharge, method,
+                                    p_best)
+        fit_info['nfev'] += len(points)
+    else:
+        fits = map_in_pool(_fit_from_start, 
+                           [(k, p_start, model_data, discharge, method)
+                            for p_start in points], num_workers)
+        objectives = np.array([fit[1]['objective'] for fit in fits])
+        p_est, fit_info = fits[np.nanargmin(objectives)]
+        fit_info['nfev'] = sum(fit[1]['nfev'] for fit in fits)
+        fit_info['njev'] = sum(fit[1]['njev'] for fit in fits)
+
+    fit_info.update({'search': mode, 'num_points': len(points), 
+                     'time': time.time() - start_time})
+    return p_est, fit_info
+
+def batch_outputs(func_info, points, model_data):
+    '''Yields (index, model outputs) for all points, BATCH_SIZE at a time
+
+points: array of shape (K, num_params).
+Outputs for points[index] are an array of shape (len(index), num_days). 
+Uses the model's 'batch' function if it has one, else 'f' for each point.
+'''
+    points = np.atleast_2d(points)
+    for start in range(0, len(points), BATCH_SIZE):
+        index = slice(start, min(start + BATCH_SIZE, len(points)))
+        if 'batch' in func_info:
+            outputs = func_info['batch'](points[index], model_data)
+        else:
+            outputs = np.array([np.asarray(func_info['f'](p, model_data)) 
+                                for p in points[index]])
+        yield index, outputs
+
+def batch_objective(func_info, points, model_data, discharge):
+    '''Returns the sum of squares objective for each of points
+
+Same as func_info['o'] for each point, but evaluated in batches.'''
+    points = np.atleast_2d(points)
+    y = np.asarray(discharge, dtype=float)
+    # Days where both the model and discharge have values.
+    valid = ~(ma.getmaskarray(func_info['f'](points[0], model_data)) | 
+              ma.getmaskarray(discharge))
+    objectives = np.empty(len(points))
+    for index, outputs in batch_outputs(func_info, points, model_data):
+        objectives[index] = ((outputs[:, valid] - y[valid])**2).sum(axis=1)
+    return objectives
+
+def _eval_objective_chunk(args):
+    '''Evaluates the objective of model k for a chunk of points
+
+Module level so that it can be used by a multiprocessing.Pool.'''
+    k, points, model_data, discharge = args
+    return batch_objective(dict(FUNCS)[k], points, model_data, discharge)
+
+def _fit_from_start(args):
+    '''Fits model k from p_start, module level for multiprocessing.Pool'''
+    k, p_start, model_data, discharge, method = args
+    return fit_model(dict(FUNCS)[k], model_data, discharge, method, p_start)
+
+def map_in_pool(worker, args, num_workers):
+    '''Returns [worker(a) for a in args], using num_workers processes'''
+    if num_workers <= 1:
+        return map(worker, args)
+
+    results = []
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # N.B. next(timeout) is used instead of next() so as ctrl-c works,
+        # which needs chunksize=1. Timeout is just a large number.
+        result_iter = pool.imap(worker, args)
+        for i in range(len(args)):
+            results.append(result_iter.next(999999))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def calibration_period_data(data, start_date, end_date):
+    '''Gets the dates, discharge and model input data for a cal period'''
     discharge   = data['discharge']
     temperature = data['temperature']
     snow_data   = data['snow']
     precip      = data['precip']
 
-    dates = snow_data['dates']
-    date_mask = ((dates >= start_date) & (dates <= end_date))
+    # Slice of the time axis from start_date to end_date, cut short
+    # if any of the data doesn't cover all of it (e.g. if looking at 
+    # 2009-2010 data, discharge data only runs up to end of 2010).
+    time_axis = data['time_axis']
+    index = time_axis.common_index(('discharge', 'temperature', 'snow', 
+                                    'precip'), start_date, end_date)
+    dates = time_axis.datetimes(index)
 
-    # If looking at 2009-2010 data, discharge data only runs up to
-    # end of 2010, hence it's shorter than dates.
-    discharge_for_year = discharge[date_mask[:len(discharge)]]
-    temperature_for_year = temperature[date_mask]
-    snow_prop_for_year = snow_data['COMBINED_total_snow'][date_mask]
-    precip_for_year = precip[date_mask[:len(precip)]]
+    discharge_for_year = time_axis.view('discharge', discharge, index)
+    temperature_for_year = time_axis.view('temperature', temperature, index)
+    snow_prop_for_year = time_axis.view('snow', 
+                                        snow_data['COMBINED_total_snow'], 
+                                        index)
+    precip_for_year = time_axis.view('precip', precip, index)
 
-    # Must make sure that these arrays are all of same length if 
-    # discharge data is incomplete (for 2010).
-    model_data = {'temp': temperature_for_year[:len(discharge_for_year)], 
-		  'snowprop': snow_prop_for_year[:len(discharge_for_year)],
-		  'precip': precip_for_year[:len(discharge_for_year)] }
+    model_data = {'temp': temperature_for_year, 
+		  'snowprop': snow_prop_for_year,
+		  'precip': precip_for_year }
+    return dates, discharge_for_year, model_data
 
-    cal_data = {}
+def compare_cal_methods(data, start_date, end_date, methods=CAL_METHODS):
+    '''Fits every model in FUNCS with each of methods and logs how they do
+
+Returns a dict of model name -> method -> (p_est, fit_info).'''
+    dates, discharge_for_year, model_data = calibration_period_data(data, 
+                                                   start_date, end_date)
+    comparison = {}
     for k, v in FUNCS:
-	log.info("Using func %s"%k)
-	objective_f, p_guess = v['o'], v['p_guess']
-	func = v['f']
-	log.info('  guessed param values: %s'%str(p_guess))
-
-	if False:
-	    # Was used initially to find suitable initial guess values for params.
-	    if k == 'exponential decay model':
-		grid = ((0, 20, 1), 
-			(0.0, 0.00001, 0.000001), 
-			(0.9, 0.99, 0.01))
-	    elif k == 'exponential decay with precip. model':
-		grid = ((0, 10, 1), 
-			(0.0, 0.00001, 0.000005), 
-			(0.9, 0.99, 0.02),
-			(0, 10, 1), 
-			(0.0, 0.00001, 0.000005), 
-			(0.9, 0.99, 0.02))
-	    p_est = optimize.brute(objective_f, grid, 
-		                   args=(model_data, discharge_for_year))
-
-	    log.info('brute')
-	    log.info('  estimated param values: %s'%str(p_est))
-	    log.info('  difference in squares: %2.1f'%objective_f(p_est, 
-		                               model_data, discharge_for_year))
-
-	p_est = optimize.fmin_powell(objective_f, p_guess, 
-		                     args=(model_data, discharge_for_year),
-		                     maxfun=10000, maxiter=10000)
-	log.info('powell')
-	log.info('  estimated param values: %s'%str(p_est))
-	log.info('  difference in squares: %2.1f'%objective_f(p_est,
-	                                       model_data, discharge_for_year))
-
-	a, b, r_val, p_val, stderr = linregress(discharge_for_year, 
-						func(p_est, model_data))
-
-	log.info("Func %s"%k)
-	log.info("  slope, intercept: %f, %f"%(a, b))
-	log.info("  r-value, p-value: %f, %f"%(r_val, p_val))
-	log.info("  Std. err.: %f"%(stderr))
-
-	func_cal_data = {'a': a, 'b': b, 'r_val': r_val, 
-		    'discharge_for_year': discharge_for_year, 
-		    'dates': dates[date_mask], 
-		    'model_data': model_data, 
-		    'start_date': start_date,
-		    'p_est': p_est}
-	cal_data[k] = func_cal_data
+        log.info('Comparing cal methods for func %s'%k)
+        log.info('  %-14s %8s %8s %8s %14s'%('method', 'nfev', 'njev', 
+                                             'time (s)', 'objective'))
+        comparison[k] = {}
+        for method in methods:
+            p_est, fit_info = fit_model(v, model_data, discharge_for_year, 
+                                        method)
+            log.info('  %-14s %8i %8i %8.3f %14.1f'%(method, 
+                     fit_info['nfev'], fit_info['njev'], fit_info['time'],
+                     fit_info['objective']))
+            comparison[k][method] = (p_est, fit_info)
+    return comparison
+
+def calibrate_model(data, start_date, end_date, method=None, search=None,
+                    num_workers=None):
+    '''Performs a full calibration, by default using the powell method
+
+Works on as many functions as are provided in FUNCS.
+uses data as the input and observed data to calibrate with.
+works between start_date and end_date, which define the cal period.
+method is one of CAL_METHODS (see fit_model), settings.CAL_METHOD if None.
+search is one of SEARCH_MODES (see global_search), 
+settings.CAL_GLOBAL_SEARCH if None. If that is also None, each model is
+just fitted from its p_guess.
+num_workers: number of processes to calibrate the functions in at once,
+settings.MODEL_WORKERS if None. If > 1, any global search in each is done 
+in that process.
 
+returns a dict with all the calibration info for the functions calibrated.
+'''
+    if method is None:
+        method = settings.CAL_METHOD
+    if search is None:
+        search = settings.CAL_GLOBAL_SEARCH
+    if num_workers is None:
+        num_workers = settings.MODEL_WORKERS
+    num_workers = min(num_workers, len(FUNCS))
+    # Worker processes can't start their own pools.
+    search_workers = settings.CAL_SEARCH_WORKERS if num_workers <= 1 else 1
+
+    dates, discharge_for_year, model_data = calibration_period_data(data, 
+                                                   start_date, end_date)
+    if num_workers > 1:
+        log.info('Calibrating %i funcs using %i processes'%(len(FUNCS),
+                                                            num_workers))
+    args = [(k, dates, discharge_for_year, model_data, start_date, method,
+             search, search_workers) for k, v in FUNCS]
+    func_cal_datas = map_in_pool(_calibrate_func, args, num_workers)
+
+    cal_data = {}
+    for (k, v), func_cal_data in zip(FUNCS, func_cal_datas):
+        cal_data[k] = func_cal_data
     return cal_data
+
+def _calibrate_func(args):
+    '''Calls calibrate_func(*args), module level for multiprocessing.Pool'''
+    return calibrate_func(*args)
+
+def calibrate_func(k, dates, discharge_for_year, model_data, start_date, 
+                   method, search, search_workers=1):
+    '''Calibrates function k in FUNCS, see calibrate_model
+
+returns a dict with all the calibration info for the function.'''
+    v = dict(FUNCS)[k]
+    log.info("Using func %s"%k)
+    objective_f, p_guess = v['o'], v['p_guess']
+    func = v['f']
+    log.info('  guessed param values: %s'%str(p_guess))
+
+    if search is not None:
+        # Was used initially to find suitable initial guess values for params.
+        p_est, fit_info = global_search(k, model_data, discharge_for_year,
+                                        search, method, search_workers,
+                                        settings.CAL_NUM_STARTS)
+        log.info('%s search'%search)
+    else:
+        p_est, fit_info = fit_model(v, model_data, discharge_for_year, 
+                                    method)
+    log.info(method)
+    log.info('  estimated param values: %s'%str(p_est))
+    log.info('  model evals: %i, Jacobian evals: %i, time: %.2fs'%(
+             fit_info['nfev'], fit_info['njev'], fit_info['time']))
+    log.info('  difference in squares: %2.1f'%objective_f(p_est,
+                                           model_data, discharge_for_year))
+
+    a, b, r_val, p_val, stderr = linregress(discharge_for_year, 
+                                            func(p_est, model_data))
+
+    log.info("Func %s"%k)
+    log.info("  slope, intercept: %f, %f"%(a, b))
+    log.info("  r-value, p-value: %f, %f"%(r_val, p_val))
+    log.info("  Std. err.: %f"%(stderr))
+
+    func_cal_data = {'a': a, 'b': b, 'r_val': r_val, 
+                'discharge_for_year': discharge_for_year, 
+                'dates': dates, 
+                'model_data': model_data, 
+                'start_date': start_date,
+                'p_est': p_est,
+                'fit_info': fit_info}
+    return func_cal_data
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+import os
+import glob
+import json
+import time
+import hashlib
+import cPickle
+import logging
+
+import project_settings as settings
+
+log = logging.getLogger('checkpoint')
+
+# Bump if the way keys are worked out or outputs are stored changes.
+CHECKPOINT_VERSION = 1
+
+def file_fingerprint(file_name):
+    '''Returns [path, mtime, size] of file_name, mtime and size are None if
+it doesn't exist'''
+    if file_name is None or not os.path.exists(file_name):
+        return [file_name, None, None]
+    stat = os.stat(file_name)
+    return [os.path.abspath(file_name), stat.st_mtime, stat.st_size]
+
+def module_fingerprint(module):
+    '''Returns the md5 of module's source code'''
+    source_file = module.__file__
+    if source_file.endswith('.pyc') or source_file.endswith('.pyo'):
+        source_file = source_file[:-1]
+    return hashlib.md5(open(source_file, 'rb').read()).hexdigest()
+
+class Checkpointer:
+    """Saves the output of each stage of the pipeline, keyed on its inputs
+
+A stage's key is the md5 of everything its output depends on: the values
+of the settings it uses, fingerprints (mtime and size) of the files it
+reads, the source code of the modules it runs and the keys of the stages
+whose outputs it is given. If a checkpoint with the same key exists its
+output is loaded rather than the stage being rerun, so changing e.g.
+APP_START_DATE only reruns the application stage, and changing
+START_DATE reruns preparation and everything after it.
+
+Outputs are pickled to <checkpoint_dir>/<stage>_<key>.pkl, the most
+recent keep of each stage are kept. Big arrays shouldn't be pickled, a 
+stage can save them to files named file_prefix(stage, key) + '_...' 
+instead, which are removed along with its checkpoint.
+"""
+    def __init__(self, checkpoint_dir=None, enabled=None, keep=None):
+        """checkpoint_dir defaults to <data_dir>/cache/checkpoints
+enabled, keep default to settings.ENABLE_CHECKPOINTS/CHECKPOINTS_KEPT
+        """
+        if checkpoint_dir is None:
+            checkpoint_dir = '%s/cache/checkpoints'%settings.DATA_DIR
+        if enabled is None:
+            enabled = settings.ENABLE_CHECKPOINTS
+        if keep is None:
+            keep = settings.CHECKPOINTS_KEPT
+        self.checkpoint_dir = checkpoint_dir
+        self.enabled = enabled
+        self.keep = keep
+
+    def key(self, stage, setting_names=(), input_files=(), modules=(),
+            upstream_keys=()):
+        '''Works out the key for stage's output'''
+        key = {'version': CHECKPOINT_VERSION,
+               'stage': stage,
+               'settings': dict((name, repr(getattr(settings, name)))
+                                for name in setting_names),
+               'input_files': [file_fingerprint(f) for f in input_files],
+               'code': dict((module.__name__, module_fingerprint(module))
+                            for module in modules),
+               'upstream': list(upstream_keys)}
+        return hashlib.md5(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def _file_name(self, stage, key):
+        return '%s/%s_%s.pkl'%(self.checkpoint_dir, stage, key)
+
+    def file_prefix(self, stage, key):
+        '''Returns the prefix for files that go with stage's checkpoint'''
+        return self._file_name(stage, key)[:-len('.pkl')]
+
+    def run(self, stage, key, func, args=(), recompute=True):
+        '''Returns (output of func(*args), key), from the checkpoint for key
+if there is one
+
+If recompute is False the stage is never run: if there is no checkpoint
+for key, the most recent one for stage is used (and its key returned),
+so that a stage can be turned off and its last output still used.
+'''
+        if not self.enabled:
+            if not recompute:
+                raise Exception('Stage %s is turned off but checkpoints are '
+                                'disabled, so it has no output'%stage)
+            return func(*args), key
+
+        file_name = self._file_name(stage, key)
+        if not os.path.exists(file_name) and not recompute:
+            checkpoints = self._checkpoints(stage)
+            if len(checkpoints) == 0:
+                raise Exception('Stage %s is turned off and has no '
+                                'checkpoint to use'%stage)
+            file_name = checkpoints[-1]
+            key = os.path.basename(file_name)[len(stage) + 1:-len('.pkl')]
+            log.warn('  Inputs to %s have changed, using its last '
+                     'checkpoint %s'%(stage, key))
+
+        if os.path.exists(file_name):
+            try:
+                log.info('  Loading %s output from checkpoint %s'%(stage, key))
+                output = cPickle.load(open(file_name, 'rb'))
+                # Mark it as recently used.
+                os.utime(file_name, None)
+                return output, key
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                if not recompute:
+                    raise
+                log.warn("  COULDN'T LOAD CHECKPOINT %s, rerunning %s"%(key,
+                                                                    stage))
+                log.warn('  Exception: %s'%(e))
+
+        start_time = time.time()
+        output = func(*args)
+        log.info('  Ran %s in %2.1fs, saving checkpoint %s'%(stage,
+                 time.time() - start_time, key))
+        self.save(stage, key, output)
+        return output, key
+
+    def save(self, stage, key, output):
+        '''Saves output as the checkpoint for stage and key'''
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        file_name = self._file_name(stage, key)
+        with open(file_name + '.tmp', 'wb') as f:
+            cPickle.dump(output, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(file_name + '.tmp', file_name)
+
+        for old_file_name in self._checkpoints(stage)[:-self.keep]:
+            log.debug('  Removing old checkpoint %s'%old_file_name)
+            os.remove(old_file_name)
+            prefix = old_file_name[:-len('.pkl')]
+            for extra_file_name in glob.glob('%s_*'%prefix):
+                os.remove(extra_file_name)
+
+    def _checkpoints(self, stage):
+        '''Returns stage's checkpoint files, least recently used first'''
+        pattern = '%s/%s_%s.pkl'%(self.checkpoint_dir, stage, '?' * 32)
+        return sorted(glob.glob(pattern), key=os.path.getmtime)
@@ -23,10 +23,94 @@ Please edit project_settings.py')
     # DATA_DIR= '../geogg122_data'
 
 ENABLE_CACHE = False
+# Keep parsed copies of the discharge, temperature and precip files.
+CACHE_STATION_DATA = True
+# Save the output of the preparation, calibration and application stages, 
+# and reuse it if nothing it depends on has changed (see checkpoint.py).
+# The most recent CHECKPOINTS_KEPT of each stage are kept.
+ENABLE_CHECKPOINTS = True
+CHECKPOINTS_KEPT = 3
+
+# Number of processes used to read HDF files, 1 reads them one at a time.
+HDF_READ_WORKERS = 4
+
+# Engine used to evaluate the NRF models, 'fast' or 'loop'
+# (see external/snow_model_accum.py).
+NRF_ENGINE = 'fast'
+
+# How to fit the models: 'powell', 'l-bfgs-b' or 'least_squares' (the
+# last two use derivatives and are a lot quicker, see calibrate.fit_model).
+CAL_METHOD = 'powell'
+# Global search done when fitting each model: None (just fit from the guessed
+# params), 'grid' (try every point on the grid given in calibrate.FUNCS and
+# fit from the best) or 'multistart' (fit from CAL_NUM_STARTS points in the
+# grid's range and keep the best). Shared out over CAL_SEARCH_WORKERS procs.
+CAL_GLOBAL_SEARCH = None
+CAL_NUM_STARTS = 20
+CAL_SEARCH_WORKERS = 4
+# Number of processes used to calibrate/apply the models in calibrate.FUNCS
+# at the same time, 1 does them one after the other.
+MODEL_WORKERS = 1
+# Number of param sets in the ensemble of each model run when applying it,
+# 0 for no ensemble. They are drawn around the calibrated params using 
+# 'posterior' or 'neighbourhood' sampling (see ensemble.draw_param_sets), 
+# the latter scaling each param by 1 + ENSEMBLE_SPREAD * N(0, 1), as are the
+# temperature thresholds with 'posterior' sampling. The 
+# ENSEMBLE_PERCENTILES of the runs are kept. If ENSEMBLE_RESIDUAL_NOISE the
+# spread of the calibration residuals is added, making them prediction 
+# intervals.
+ENSEMBLE_SIZE = 0
+ENSEMBLE_SAMPLING = 'posterior'
+ENSEMBLE_SPREAD = 0.05
+ENSEMBLE_PERCENTILES = (5, 50, 95)
+ENSEMBLE_RESIDUAL_NOISE = True
+
+# Engine used to interpolate snow data over time, 'fast' or 'loop'
+# and the number of pixels the fast engine interpolates at once.
+INTERP_ENGINE = 'fast'
+INTERP_BLOCK_SIZE = 2000
+# Number of days that AQUA and TERRA data are QC'd and combined at once.
+COMBINE_BLOCK_DAYS = 32
+# Prepare the snow data SNOW_CHUNK_DAYS days at a time, so that long records
+# fit in memory (see prepare.prepare_all_snow_data_chunked), None does it
+# all at once. If SNOW_CUBE_FILE is set (e.g. DATA_DIR + '/snow_cube.npy'),
+# the interpolated snow data is written to it, otherwise only the totals
+# are kept when preparing in chunks.
+SNOW_CHUNK_DAYS = None
+SNOW_CUBE_FILE = None
 
 TILE = 'h09v05'
+# MODIS tiles to download and read the catchment from: None for just TILE,
+# a list of tiles (e.g. ['h09v05', 'h10v05']) for a catchment that spans 
+# them, or 'auto' to work out which tiles the catchment and SNOW_BASIN_IDS
+# are on (downloading, checkpoints and reading all use these). If not None,
+# each day's tiles are stitched together around the catchment (see 
+# prepare.load_snow_hdf_mosaic).
+TILES = None
+# Feature ids of other catchments in Hydrologic_Units/HUC_Polygons.shp to 
+# prepare snow data for, all in one pass over the HDF files (see 
+# prepare.prepare_basin_snow_data), e.g. (0, 1, 2, 3). They are read from
+# TILES in the same way as the catchment, so they can span many tiles.
+SNOW_BASIN_IDS = ()
 MODIS_DATASETS = ('AQUA', 'TERRA')
 
+# FTP server to download MODIS files from, try 'n5eil01u.ecs.nsidc.org'
+# if this isn't working. Files are downloaded over this many connections.
+MODIS_FTP_HOST = 'n4ftl01u.ecs.nasa.gov'
+MODIS_FTP_PORT = 21
+MODIS_DOWNLOAD_CONNECTIONS = 4
+# How long (secs) listings of the FTP server's dirs are cached for.
+MODIS_FTP_LISTING_TTL = 24 * 3600
+# Listings of a day's dir (or of the daily dirs) made less than this long
+# (secs) after the day are relisted on the next run, as files can still be
+# appearing.
+MODIS_FTP_LISTING_SETTLE = 7 * 24 * 3600
+
+# Downloads over HTTP (see download.download_data).
+DOWNLOAD_TIMEOUT = 60 # secs
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # bytes
+
 START_DATE = datetime.datetime(2007, 12, 01)
 END_DATE = datetime.datetime(2010, 01, 31)
 
@@ -42,6 +126,8 @@ SHOW_PICS = False
 RESULTS_START_DATE = datetime.datetime(2008, 01, 01)
 RESULTS_END_DATE = datetime.datetime(2009, 12, 31)
 
+# Stages to run, if preparation/calibration/application are turned off the
+# last checkpoint of their output is used.
 RUN_DOWNLOAD_FILES = True
 RUN_DOWNLOAD_MODIS_FILES = True
 RUN_DATA_PREPARATION = True
@@ -1,13 +1,21 @@
 #!/usr/bin/python
 import os
+import json
+import time
+import hashlib
 import datetime
 import urllib2
 import logging
-import glob
+import threading
+import Queue
 from ftplib import FTP
 from zipfile import ZipFile
 
+from external.helpers import daterange
+
 import project_settings as settings
+import modis_index
+import modis_grid
 
 log = logging.getLogger('download')
 
@@ -16,155 +24,592 @@ FILES = [('http://txpub.usgs.gov/USACE/data/water_resources/Hydrologic_Units.zip
          ('http://www2.geog.ucl.ac.uk/~plewis/geogg122_local/geogg122/Chapter6a_Practical/data/delnorte.dat', 'delnorte.dat'),
          ('http://www2.geog.ucl.ac.uk/~plewis/geogg122_local/geogg122/Chapter6a_Practical/data/delNorteT.dat', 'delnorteT.dat')]
 
+# Dirs on the FTP server for each dataset.
+MODIS_FTP_DIRS = {'AQUA': '/MOSA/MYD10A1.005/',
+                  'TERRA': '/MOST/MOD10A1.005/'}
+
+class FtpListingCache:
+    """Persistent cache of directory listings from the MODIS FTP server
+
+Holds, for each dataset, the list of daily dirs on the server, and for
+each (dataset, daily_dir) a dict of HDF file name -> size. Entries older
+than ttl secs are treated as missing, so are listed again. Files for a
+day can still be appearing on the server for a while after it, so for a
+daily dir, entries listed less than settle secs after its day are only
+trusted if they were listed since the cache was loaded. Stored in
+cache_file, if the cache was for a different host it is emptied.
+
+Puts are thread safe, and lock can be used to stop several threads
+fetching the same listing.
+"""
+    def __init__(self, host, cache_file=None, ttl=None, settle=None):
+        """Loads the cache from cache_file if it exists
+
+cache_file defaults to <data_dir>/cache/modis_ftp_listing.json
+ttl, settle default to settings.MODIS_FTP_LISTING_TTL/SETTLE
+        """
+        if cache_file is None:
+            cache_file = '%s/cache/modis_ftp_listing.json'%settings.DATA_DIR
+        if ttl is None:
+            ttl = settings.MODIS_FTP_LISTING_TTL
+        if settle is None:
+            settle = settings.MODIS_FTP_LISTING_SETTLE
+        self.host = host
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.settle = settle
+        self.loaded_at = time.time()
+        self.lock = threading.RLock()
+        self.changed = False
+
+        self.daily_dirs = {}
+        self.listings = {}
+        if os.path.exists(self.cache_file):
+            try:
+                cache = json.load(open(self.cache_file, 'r'))
+                if cache['host'] == self.host:
+                    self.daily_dirs = cache['daily_dirs']
+                    self.listings = cache['listings']
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                log.warn("  COULDN'T LOAD FTP LISTING CACHE, ignoring it")
+                log.warn('  Exception: %s'%(e))
+
+    def _fresh(self, entry, daily_dir=None):
+        if entry is None or time.time() - entry['listed_at'] >= self.ttl:
+            return False
+        if daily_dir is None or entry['listed_at'] >= self.loaded_at:
+            return True
+        day = time.mktime(time.strptime(daily_dir, '%Y.%m.%d'))
+        return entry['listed_at'] - day >= self.settle
+
+    def get_daily_dirs(self, dataset):
+        """Returns the list of daily dirs for dataset, or None"""
+        entry = self.daily_dirs.get(dataset)
+        if not self._fresh(entry):
+            return None
+        return entry['dirs']
+
+    def daily_dirs_trusted(self, dataset, daily_dir):
+        """Returns whether the list of daily dirs can be trusted to say if
+daily_dir is on the server"""
+        return self._fresh(self.daily_dirs.get(dataset), daily_dir)
+
+    def put_daily_dirs(self, dataset, daily_dirs):
+        with self.lock:
+            self.daily_dirs[dataset] = {'listed_at': time.time(),
+                                        'dirs': sorted(daily_dirs)}
+            self.changed = True
+
+    def get(self, dataset, daily_dir):
+        """Returns dict of file name -> size for daily_dir, or None"""
+        entry = self.listings.get('%s/%s'%(dataset, daily_dir))
+        if not self._fresh(entry, daily_dir):
+            return None
+        return entry['files']
+
+    def put(self, dataset, daily_dir, files):
+        with self.lock:
+            self.listings['%s/%s'%(dataset, daily_dir)] =\
+                {'listed_at': time.time(), 'files': files}
+            self.changed = True
+
+    def save(self):
+        """Saves the cache to cache_file, dropping stale entries"""
+        with self.lock:
+            if not self.changed:
+                return
+            daily_dirs = dict((k, v) for k, v in self.daily_dirs.items()
+                              if self._fresh(v))
+            listings = dict((k, v) for k, v in self.listings.items()
+                            if self._fresh(v))
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            json.dump({'host': self.host, 'daily_dirs': daily_dirs,
+                       'listings': listings},
+                      open(self.cache_file + '.tmp', 'w'))
+            os.rename(self.cache_file + '.tmp', self.cache_file)
+            self.changed = False
+
 class ModisDataDownloader:
     """Downloads snow data from either AQUA or TERRA
 
-Uses FTP from the standard library to access data.
+Uses FTP from the standard library to access data, over one connection.
+Partial downloads are written to a .part file, which is resumed if the 
+download is interrupted, and renamed once its size has been checked.
 """
-    def __init__(self, dataset='AQUA'):
-	"""Sets up instance to download one of AQUA or TERRA
+    def __init__(self, dataset='AQUA', host=None, port=None,
+                 listing_cache=None):
+        """Sets up instance to download one of AQUA or TERRA
 
 dataset: dataset to download.
-	"""
-	self.ftp = FTP('n4ftl01u.ecs.nasa.gov')
-	# Try this if above isn't working.
-        #self.ftp = FTP('n5eil01u.ecs.nsidc.org') 
+host, port: FTP server, default to settings.MODIS_FTP_HOST/PORT.
+listing_cache: FtpListingCache for the server, one is made if not given.
+        """
+        if host is None:
+            host = settings.MODIS_FTP_HOST
+        if port is None:
+            port = settings.MODIS_FTP_PORT
+        if listing_cache is None:
+            listing_cache = FtpListingCache(host)
+        self.listing_cache = listing_cache
+        self.ftp = FTP()
+        self.ftp.connect(host, port)
         self.ftp.login()
         self.dataset = dataset
+        self.ftp.cwd(MODIS_FTP_DIRS[self.dataset])
+
+    def close(self):
+        """Closes the FTP connection"""
+        try:
+            self.ftp.quit()
+        except Exception:
+            self.ftp.close()
+
+    def list_daily_dirs(self, refresh=False):
+        """Returns the names of all daily dirs for dataset on the server
+
+Comes from the listing cache if it's fresh, unless refresh is True. The
+lock stops several connections listing the same dir at once.
+"""
+        with self.listing_cache.lock:
+            daily_dirs = self.listing_cache.get_daily_dirs(self.dataset)
+            if daily_dirs is None or refresh:
+                daily_dirs = [d.rstrip('/').split('/')[-1] for d in
+                              self.ftp.nlst(MODIS_FTP_DIRS[self.dataset])]
+                self.listing_cache.put_daily_dirs(self.dataset, daily_dirs)
+        return daily_dirs
+
+    def list_daily_dir(self, daily_dir):
+        """Returns a dict of HDF file name -> size for daily_dir
+
+Comes from the listing cache if it's fresh. Dirs that aren't in the
+list of daily dirs are known not to exist without asking the server,
+unless the list might be from before the dir appeared, in which case
+the daily dirs are listed again first.
+"""
+        files = self.listing_cache.get(self.dataset, daily_dir)
+        if files is None:
+            daily_dirs = self.list_daily_dirs()
+            if daily_dir not in daily_dirs and not \
+                    self.listing_cache.daily_dirs_trusted(self.dataset,
+                                                          daily_dir):
+                daily_dirs = self.list_daily_dirs(refresh=True)
+            if daily_dir not in daily_dirs:
+                raise Exception('No dir %s for %s on server'%(daily_dir,
+                                                              self.dataset))
+            all_lines = []
+            self.ftp.dir(MODIS_FTP_DIRS[self.dataset] + daily_dir,
+                         all_lines.append)
+
+            files = dict((l.split()[8], int(l.split()[4]))
+                         for l in all_lines if len(l.split()) >= 9 and
+                                               l.split()[8].endswith('.hdf'))
+            self.listing_cache.put(self.dataset, daily_dir, files)
+        return files
+
+    def find_hdf_file(self, tile, date):
+        """Finds the HDF file for tile and date on the server
+
+Returns a tuple (file name, size in bytes).
+"""
+        files = self.list_daily_dir(date.strftime('%Y.%m.%d'))
+        hdf_file_for_tile = [(f, size) for f, size in sorted(files.items())
+                             if len(f.split('.')) > 2 and
+                                f.split('.')[2] == tile]
+
+        if len(hdf_file_for_tile) != 1:
+            log.warning("PROBLEM FINDING file for %s"%date)
+            log.warning("Found %i files"%len(hdf_file_for_tile))
+            raise Exception('0 or more than one hdf file found')
+        return hdf_file_for_tile[0]
+
+    def find_hdf_files(self, tile, dates):
+        """Finds the HDF files for tile and all dates on the server
+
+The daily dirs are listed once, so dates with no dir cost nothing, then
+each daily dir that isn't in the listing cache is listed.
+
+Returns a dict of date -> (file name, size in bytes), or the exception
+raised when looking for it.
+"""
+        hdf_files = {}
+        for date in dates:
+            try:
+                hdf_files[date] = self.find_hdf_file(tile, date)
+            except Exception, e:
+                hdf_files[date] = e
+        return hdf_files
 
-        if self.dataset == 'AQUA':
-            self.ftp.cwd('/MOSA/MYD10A1.005/')
-        elif self.dataset == 'TERRA':
-            self.ftp.cwd('/MOST/MOD10A1.005/')
+    def download_file(self, date, hdf_file, size, full_file_name):
+        """Downloads hdf_file for date to full_file_name
 
-    def download_all_files(self, tile, start_date, end_date):
-	"""Download all HDF files for tile, between ranges given
+Data goes to full_file_name + '.part' first, and if this already exists
+the download carries on from the end of it. Once it is size bytes long 
+it is renamed to full_file_name.
+"""
+        daily_dir = date.strftime('%Y.%m.%d')
+        part_file_name = full_file_name + '.part'
+
+        offset = 0
+        if os.path.exists(part_file_name):
+            offset = os.path.getsize(part_file_name)
+            if offset > size:
+                log.warning('    Partial file %s is too big, restarting'%
+                            hdf_file)
+                offset = 0
+
+        if offset < size:
+            if offset != 0:
+                log.info('    Resuming %s file %s at byte %i'%(self.dataset,
+                                                            hdf_file, offset))
+            f = open(part_file_name, 'ab' if offset != 0 else 'wb')
+            try:
+                self.ftp.retrbinary('RETR %s%s/%s'%(
+                                    MODIS_FTP_DIRS[self.dataset], daily_dir, 
+                                    hdf_file), 
+                                    f.write, rest=offset or None)
+            finally:
+                f.close()
+
+        downloaded_size = os.path.getsize(part_file_name)
+        if downloaded_size != size:
+            raise Exception('Downloaded %i bytes of %s, expected %i'%(
+                            downloaded_size, hdf_file, size))
+        os.rename(part_file_name, full_file_name)
+
+    def download_date(self, tile, date, hdf_file=None, size=None):
+        """Downloads the HDF file for tile and date
+
+hdf_file, size: file name and size from find_hdf_file(s), found if not
+                given.
+
+Returns the full file name of the downloaded file.
+"""
+        if hdf_file is None:
+            hdf_file, size = self.find_hdf_file(tile, date)
+
+        data_dir = "%s/%s"%(settings.DATA_DIR, 
+                            modis_index.modis_dir_name(self.dataset, tile, 
+                                                       date.year))
+        full_file_name = "%s/%s"%(data_dir, hdf_file)
+        if os.path.exists(full_file_name):
+            # This should have been caught by file index check.
+            log.warning('    %s file %s already exists'%(self.dataset,
+                                                         hdf_file))
+        else:
+            log.info('    Downloading %s file %s'%(self.dataset, hdf_file))
+            if not os.path.exists(data_dir):
+                os.makedirs(data_dir)
+
+            # Actually download the file.
+            self.download_file(date, hdf_file, size, full_file_name)
+            log.info('    Downloaded file')
+        return full_file_name
+
+    def download_all_files(self, tile, start_date, end_date, file_index=None):
+        """Download all HDF files for tile, between ranges given
 
 tile: tile id
 start_date: date of first file to download
 start_date: date of last file to download
+file_index: ModisFileIndex used to check for existing files, one is 
+            made (and saved) if not given.
 
 all files will be stored in a dir like e.g. <data_dir>/AQUA_h09v05_2009/
 with their original name.
 """
+        save_file_index = file_index is None
+        if file_index is None:
+            file_index = modis_index.ModisFileIndex(settings.DATA_DIR)
+
         log.info('Downloading all HDF files')
         log.info("  Daterange: %s to %s"%(str(start_date), str(end_date)))
         hdf_files_for_tile = []
 
-	# this is a list of all files in the FTP dir.
-        daily_dirs = []
-        dates = []
-        date = start_date
-        while date < end_date + datetime.timedelta(1):
-            dates.append(date)
-	    # Form if dates in FTP dir.
-            daily_dirs.append(date.strftime('%Y.%m.%d'))
-            date += datetime.timedelta(1)
-
-        for date, daily_dir in zip(dates, daily_dirs):
-	    # Check to see wehter this file has already been downloaded.
-	    data_dir = "%s/%s_%s_%i"%(settings.DATA_DIR, 
-				      self.dataset, tile, date.year)
-	    doy = date.timetuple().tm_yday
-	    existing_files = glob.glob("%s/*.A%04i%03i.*"%(data_dir, 
-		                                           date.year, doy))
-	    if len(existing_files) != 0:
-		log.info('    %s file %s already exists'%(self.dataset, 
-		                          existing_files[0].split('/')[-1]))
-		continue
-
-	    try:
-		self.ftp.cwd(daily_dir)
-	    except:
-		log.warn('    COULD NOT CWD INTO DIR %s'%(daily_dir))
-		#log.warn('    PWD'%(self.ftp.pwd()))
-		continue
-
+        missing_dates = []
+        for date in daterange(start_date, end_date):
+            # Check to see whether this file has already been downloaded.
+            existing_file = file_index.lookup(self.dataset, tile, date)
+            if existing_file is not None:
+                log.info('    %s file %s already exists'%(self.dataset,
+                                          existing_file.split('/')[-1]))
+            else:
+                missing_dates.append(date)
+
+        hdf_files = self.find_hdf_files(tile, missing_dates)
+        for date in missing_dates:
             try:
-		# Not all files exist. Gaurd against this with a try...catch.
-                all_lines = []
-                self.ftp.dir(all_lines.append)
-
-                all_files = [l.split()[8] for l in all_lines[1:]]       
-                hdf_files = [f for f in all_files if f.split('.')[-1] == 'hdf']
-                hdf_file_for_tile =\
-			[f for f in hdf_files if f.split('.')[2] == tile]
-
-                if len(hdf_file_for_tile) != 1:
-                    log.warning("PROBLEM FINDING file for %s"%date)
-                    log.warning("Found %i files"%len(hdf_file_for_tile))
-                    raise Exception('0 or more than one hdf file found')
-
-                hdf_file = hdf_file_for_tile[0]
-                hdf_files_for_tile.append(hdf_file)
-
-                full_file_name = "%s/%s"%(data_dir, hdf_file)
-                if os.path.exists(full_file_name):
-		    # This should have been caught by check above.
-                    log.warning('    %s file %s already exists'%(self.dataset,
-			                                         hdf_file))
-                else:
-                    log.info('    Downloading %s file %s'%(self.dataset, 
-			                                   hdf_file))
-                    if not os.path.exists(data_dir):
-                        os.makedirs(data_dir)
-
-		    # Actually download the file.
-                    self.ftp.retrbinary('RETR %s'%(hdf_file), 
-			                open(full_file_name, 'wb').write)
-                    log.info('    Downloaded file')
+                if isinstance(hdf_files[date], Exception):
+                    raise hdf_files[date]
+                hdf_file, size = hdf_files[date]
+                full_file_name = self.download_date(tile, date,
+                                                    hdf_file, size)
+                file_index.add(self.dataset, tile, date, full_file_name)
+                hdf_files_for_tile.append(full_file_name.split('/')[-1])
             except Exception, e:
                 log.warning(e)
 
-	    # Need to go back up a dir.
-            self.ftp.cwd('..')
+        if save_file_index:
+            file_index.save()
+        self.listing_cache.save()
+        return hdf_files_for_tile
+
+def download_modis_files_pooled(datasets, tiles, start_date, end_date,
+                                num_connections, file_index,
+                                listing_cache=None):
+    """Downloads all missing HDF files using num_connections at once
+
+tiles: a tile name or list of them.
+Each connection is used by its own thread, which takes the next
+(dataset, tile, date) that needs downloading until there are none left. 
+All threads share listing_cache (one is made if not given), which is 
+saved at the end, so each daily dir is only listed once for all tiles.
 
-        return hdf_files_for_tile       
+Returns a list of the full file names of all files downloaded.
+"""
+    if isinstance(tiles, basestring):
+        tiles = [tiles]
+    jobs = Queue.Queue()
+    for tile in tiles:
+        for date in daterange(start_date, end_date):
+            for dataset in datasets:
+                if file_index.lookup(dataset, tile, date) is None:
+                    jobs.put((dataset, tile, date))
+    log.info('  %i files to download using %i connection(s)'%(jobs.qsize(), 
+                                                             num_connections))
+    if listing_cache is None:
+        listing_cache = FtpListingCache(settings.MODIS_FTP_HOST)
+
+    lock = threading.Lock()
+    downloaded_files = []
+
+    def download_jobs():
+        # One connection per dataset, made when first needed.
+        downloaders = {}
+        while True:
+            try:
+                dataset, tile, date = jobs.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                if dataset not in downloaders:
+                    downloaders[dataset] = ModisDataDownloader(dataset,
+                                                 listing_cache=listing_cache)
+                full_file_name = downloaders[dataset].download_date(tile, 
+                                                                    date)
+                with lock:
+                    file_index.add(dataset, tile, date, full_file_name)
+                    downloaded_files.append(full_file_name)
+            except Exception, e:
+                log.warning('    %s %s %s: %s'%(dataset, tile, 
+                                                date.strftime('%Y.%m.%d'), e))
+                # Connection may be in a bad state, make a new one next time.
+                if dataset in downloaders:
+                    downloaders.pop(dataset).close()
+        for downloader in downloaders.values():
+            downloader.close()
+
+    threads = [threading.Thread(target=download_jobs) 
+               for i in range(num_connections)]
+    for thread in threads:
+        # So as ctrl-c works.
+        thread.daemon = True
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+    listing_cache.save()
+    return downloaded_files
 
 def download_all_modis_files():
     """Simple wrapper func to download all modis files based on settings"""
     start_date = settings.START_DATE
     end_date = settings.END_DATE
+    file_index = modis_index.ModisFileIndex(settings.DATA_DIR)
 
-    for dataset in settings.MODIS_DATASETS:
-        log.info("Downloading dataset %s"%dataset)
-        mdd = ModisDataDownloader(dataset)
-        hdf_files_for_tile = mdd.download_all_files(settings.TILE, 
-		                                    start_date, end_date)
+    tiles = modis_grid.settings_tiles()
+    log.info("Downloading datasets %s for tiles %s"%(
+             str(settings.MODIS_DATASETS), ', '.join(tiles)))
+    download_modis_files_pooled(settings.MODIS_DATASETS, tiles, 
+                                start_date, end_date, 
+                                settings.MODIS_DOWNLOAD_CONNECTIONS, 
+                                file_index)
+    file_index.save()
 
 def download_data(force_download=False):
     """Downloads all files in FILES
 
-if force_download==True it will overwrite any existing files, otherwise
-it will skip downloading any files that have already been downloaded"""
+if force_download==True it will check with the server for newer versions
+of any existing files, otherwise it will skip downloading any files that 
+have already been downloaded (and are the same as when they were)"""
     if not os.path.exists(settings.DATA_DIR):
         os.makedirs(settings.DATA_DIR)
 
-    files = []
-    files.append(FILES)
-
+    download_meta = load_download_meta()
     for url, file_name in FILES:
         rel_file_name = '%s/%s'%(settings.DATA_DIR, file_name)
-
-        if os.path.exists(rel_file_name) and not force_download:
-            log.info('Already downloaded file: %s'%(file_name))
-            continue
-
-        log.info('Downloading file: %s'%(file_name))
-
-        req = urllib2.urlopen(url)
-        f = open(rel_file_name, 'w')
-        f.write(req.read())
-        f.close()
-
-    post_download_actions()
-
-def post_download_actions():
-    '''Unzips Hydrologic_Units.zip if necessary'''
-    log.info('Extracting contents from zip file')
+        try:
+            fetch_url(url, rel_file_name, download_meta, force_download)
+        finally:
+            # Keep meta data for any files that were downloaded.
+            save_download_meta(download_meta)
+
+    post_download_actions(download_meta)
+    save_download_meta(download_meta)
+
+def load_download_meta():
+    """Loads info (etag, size, md5...) about files in FILES from last download"""
+    meta_file = '%s/cache/download_meta.json'%settings.DATA_DIR
+    if os.path.exists(meta_file):
+        try:
+            return json.load(open(meta_file, 'r'))
+        except KeyboardInterrupt:
+            raise
+        except Exception, e:
+            log.warn("  COULDN'T LOAD DOWNLOAD META DATA, ignoring it")
+            log.warn('  Exception: %s'%(e))
+    return {}
+
+def save_download_meta(download_meta):
+    meta_file = '%s/cache/download_meta.json'%settings.DATA_DIR
+    if not os.path.exists(os.path.dirname(meta_file)):
+        os.makedirs(os.path.dirname(meta_file))
+    json.dump(download_meta, open(meta_file + '.tmp', 'w'), indent=2)
+    os.rename(meta_file + '.tmp', meta_file)
+
+def file_md5(file_name, chunk_size=None):
+    """Returns hex md5 of file_name, read in chunks"""
+    if chunk_size is None:
+        chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def fetch_url(url, file_name, download_meta, force_download=False, md5=None):
+    """Downloads url to file_name, if it needs downloading
+
+download_meta: dict of info about previous downloads, keyed by base file
+               name, updated with the etag, last modified, size and md5.
+force_download: if True, asks the server whether the file has changed 
+                (using the etag/last modified) even if it's already there.
+md5: expected md5 of the file, checked if given.
+
+The file is streamed to file_name + '.part' in chunks of 
+settings.DOWNLOAD_CHUNK_SIZE, checked against the Content-Length and md5,
+and then renamed to file_name, so an interrupted download never looks
+like a complete file. Failed downloads are retried 
+settings.DOWNLOAD_RETRIES times.
+
+Returns True if file_name was (re)downloaded.
+"""
+    key = os.path.basename(file_name)
+    meta = download_meta.get(key)
+    if os.path.exists(file_name):
+        if meta is None or meta.get('url') != url:
+            # Downloaded before meta data was kept, trust it.
+            log.info('Recording meta data for file: %s'%(key))
+            meta = {'url': url, 'size': os.path.getsize(file_name),
+                    'md5': file_md5(file_name), 
+                    'mtime': os.path.getmtime(file_name)}
+            download_meta[key] = meta
+
+        # Only work out the md5 if the file might have changed.
+        if (os.path.getsize(file_name) != meta['size'] or 
+            (os.path.getmtime(file_name) != meta.get('mtime') and 
+             file_md5(file_name) != meta['md5']) or
+            (md5 is not None and meta['md5'] != md5)):
+            log.warn('File %s has changed since download, redownloading'%
+                     key)
+        elif not force_download:
+            log.info('Already downloaded file: %s'%(key))
+            return False
+        elif meta.get('etag') or meta.get('last_modified'):
+            # Conditional request, server says 304 if it hasn't changed.
+            headers = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            return _fetch_url(url, file_name, download_meta, md5, headers)
+
+    return _fetch_url(url, file_name, download_meta, md5)
+
+def _fetch_url(url, file_name, download_meta, md5=None, headers=None):
+    if headers is None:
+        headers = {}
+    key = os.path.basename(file_name)
+    part_file_name = file_name + '.part'
+    for attempt in range(settings.DOWNLOAD_RETRIES + 1):
+        if attempt != 0:
+            log.warn('  Retrying download of %s (%i)'%(key, attempt))
+            time.sleep(2 ** attempt)
+        try:
+            try:
+                req = urllib2.urlopen(urllib2.Request(url, headers=headers),
+                                      timeout=settings.DOWNLOAD_TIMEOUT)
+            except urllib2.HTTPError, e:
+                if e.code == 304:
+                    log.info('Not changed on server: %s'%(key))
+                    return False
+                raise
+
+            log.info('Downloading file: %s'%(key))
+            file_md5_hash = hashlib.md5()
+            size = 0
+            with open(part_file_name, 'wb') as f:
+                for chunk in iter(lambda: 
+                                  req.read(settings.DOWNLOAD_CHUNK_SIZE), ''):
+                    f.write(chunk)
+                    file_md5_hash.update(chunk)
+                    size += len(chunk)
+            req.close()
+
+            content_length = req.info().getheader('Content-Length')
+            if content_length is not None and int(content_length) != size:
+                raise Exception('Downloaded %i bytes of %s, expected %s'%(
+                                size, key, content_length))
+            if md5 is not None and file_md5_hash.hexdigest() != md5:
+                raise Exception('md5 of %s does not match'%(key))
+
+            os.rename(part_file_name, file_name)
+            download_meta[key] = {'url': url, 'size': size, 
+                                  'md5': file_md5_hash.hexdigest(),
+                                  'etag': req.info().getheader('ETag'),
+                                  'last_modified': 
+                                  req.info().getheader('Last-Modified'),
+                                  'mtime': os.path.getmtime(file_name)}
+            return True
+        except KeyboardInterrupt:
+            raise
+        except Exception, e:
+            log.warn('  Problem downloading %s: %s'%(key, e))
+            if attempt == settings.DOWNLOAD_RETRIES:
+                raise
+        finally:
+            if os.path.exists(part_file_name):
+                os.remove(part_file_name)
+
+def post_download_actions(download_meta):
+    '''Unzips Hydrologic_Units.zip if necessary
+
+Only extracts it if it has changed since it was last extracted, or any of
+its contents are missing.'''
     rel_file_name = '%s/%s'%(settings.DATA_DIR, HYDROLOGICAL_UNITS_ZIP)
+    meta = download_meta[HYDROLOGICAL_UNITS_ZIP]
     z = ZipFile(rel_file_name)
-    z.extractall(settings.DATA_DIR)
+    all_extracted = all(os.path.exists('%s/%s'%(settings.DATA_DIR, name))
+                        for name in z.namelist())
+    if meta.get('extracted_md5') == meta['md5'] and all_extracted:
+        log.info('Zip file already extracted')
+    else:
+        log.info('Extracting contents from zip file')
+        z.extractall(settings.DATA_DIR)
+        meta['extracted_md5'] = meta['md5']
     z.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+import logging
+
+import numpy as np
+import numpy.ma as ma
+
+import calibrate as cal
+
+log = logging.getLogger('ensemble')
+
+# Ways of drawing the ensemble's param sets, see draw_param_sets.
+SAMPLINGS = ('posterior', 'neighbourhood')
+
+class StreamingPercentiles:
+    """Percentiles over many model runs for each day, added a batch at a time
+
+Works in two passes over the runs, so that only a histogram for each day
+is kept rather than all num_runs * num_days values:
+ 1. update_range(batch) for every batch, to find each day's min and max.
+ 2. add(batch) for every batch, which counts the values into num_bins
+    bins spanning each day's range.
+percentiles() then interpolates within the bins, so it is accurate to
+a small fraction of (max - min) / num_bins. The mean and std. dev. for
+each day are exact.
+"""
+    def __init__(self, num_days, num_bins=200):
+        self.num_days = num_days
+        self.num_bins = num_bins
+        self.lower = np.empty(num_days)
+        self.lower.fill(np.inf)
+        self.upper = np.empty(num_days)
+        self.upper.fill(-np.inf)
+        self.counts = np.zeros((num_days, num_bins), dtype=int)
+        self.num_runs = 0
+        self.sum = np.zeros(num_days)
+        self.sum_sq = np.zeros(num_days)
+
+    def update_range(self, batch):
+        '''Widens the range of each day to cover batch (num_runs, num_days)'''
+        self.lower = np.minimum(self.lower, batch.min(axis=0))
+        self.upper = np.maximum(self.upper, batch.max(axis=0))
+
+    def add(self, batch):
+        '''Counts batch (num_runs, num_days) into each day's bins'''
+        if np.isinf(self.lower).any():
+            raise Exception('update_range must be called with all batches '
+                            'before they are added')
+        width = self.upper - self.lower
+        scale = np.where(width > 0, self.num_bins / np.where(width > 0,
+                                                             width, 1.), 0.)
+        bins = ((batch - self.lower) * scale).astype(int)
+        np.clip(bins, 0, self.num_bins - 1, out=bins)
+        # Count all (day, bin) pairs in one go.
+        flat_bins = bins + np.arange(self.num_days) * self.num_bins
+        self.counts += np.bincount(flat_bins.ravel(),
+                                   minlength=self.counts.size
+                                   ).reshape(self.counts.shape)
+        self.num_runs += len(batch)
+        self.sum += batch.sum(axis=0)
+        self.sum_sq += (batch**2).sum(axis=0)
+
+    def mean(self):
+        return self.sum / self.num_runs
+
+    def std(self):
+        return np.sqrt(np.maximum(self.sum_sq / self.num_runs -
+                                  self.mean()**2, 0.))
+
+    def percentiles(self, qs):
+        '''Returns an array (len(qs), num_days) of the qs percentiles (0-100)'''
+        cum_counts = self.counts.cumsum(axis=1)
+        width = (self.upper - self.lower) / self.num_bins
+        days = np.arange(self.num_days)
+        values = []
+        for q in qs:
+            target = q / 100. * self.num_runs
+            # First bin where the count reaches target, values are spread
+            # evenly within it.
+            bins = np.argmax(cum_counts >= target, axis=1)
+            count_before = np.where(bins > 0, cum_counts[days, bins - 1], 0)
+            in_bin = self.counts[days, bins]
+            frac = np.where(in_bin > 0, (target - count_before) /
+                            np.maximum(in_bin, 1.), 0.)
+            values.append(self.lower + (bins + frac) * width)
+        return np.array(values)
+
+def valid_days(func_info, p_est, model_data, discharge):
+    '''Returns a mask of days where both the model and discharge have values'''
+    return ~(ma.getmaskarray(func_info['f'](p_est, model_data)) |
+             ma.getmaskarray(discharge))
+
+def residual_std(func_info, p_est, model_data, discharge):
+    '''Returns the std. dev. of the model's residuals for params p_est'''
+    valid = valid_days(func_info, p_est, model_data, discharge)
+    residuals = np.asarray(func_info['f'](p_est, model_data))[valid] - \
+                np.asarray(discharge, dtype=float)[valid]
+    dof = max(len(residuals) - len(p_est), 1)
+    return np.sqrt((residuals**2).sum() / dof)
+
+def draw_param_sets(func_info, p_est, model_data, discharge, num_sets,
+                    sampling='posterior', spread=0.05, seed=0):
+    '''Draws num_sets sets of params around p_est for an ensemble
+
+func_info: model from cal.FUNCS.
+p_est: calibrated params.
+model_data, discharge: data the model was calibrated on.
+sampling: 'posterior': from the Gaussian approximation to the posterior
+                       at p_est, with covariance s^2 (J^T J)^-1, where J is
+                       the Jacobian of the model and s^2 the variance of
+                       its residuals. Needs the model's 'jac'. The model 
+                       is a step function of its 'thresholds' params, so
+                       J says nothing about how well they are known, and
+                       they are drawn as for 'neighbourhood' instead.
+          'neighbourhood': p_est times (1 + spread * N(0, 1)) independently
+                           for each param.
+Params are clipped to the model's bounds.
+
+Returns an array of shape (num_sets, num_params).
+'''
+    if sampling not in SAMPLINGS:
+        raise Exception('Unknown ensemble sampling %s, use one of %s'%(
+                        sampling, str(SAMPLINGS)))
+    rand = np.random.RandomState(seed)
+    p_est = np.array(p_est, dtype=float)
+    if sampling == 'posterior' and 'jac' not in func_info:
+        log.warn('  Model has no Jacobian, using neighbourhood sampling')
+        sampling = 'neighbourhood'
+
+    param_sets = p_est * (1 + spread *
+                          rand.standard_normal((num_sets, len(p_est))))
+    if sampling == 'posterior':
+        smooth = np.ones(len(p_est), dtype=bool)
+        smooth[list(func_info.get('thresholds', ()))] = False
+        jac = func_info['jac'](p_est, model_data)[1][:, smooth]
+        jac = jac[valid_days(func_info, p_est, model_data, discharge)]
+        variance = residual_std(func_info, p_est, model_data, discharge)**2
+        # pinv as J^T J can be close to singular, e.g. if k is so small
+        # that p has little effect.
+        cov = variance * np.linalg.pinv(np.dot(jac.T, jac))
+        param_sets[:, smooth] = rand.multivariate_normal(p_est[smooth], cov,
+                                                         num_sets)
+
+    bounds = func_info.get('bounds', [(None, None)] * len(p_est))
+    lower = np.array([-np.inf if b[0] is None else b[0] for b in bounds])
+    upper = np.array([np.inf if b[1] is None else b[1] for b in bounds])
+    return np.clip(param_sets, lower, upper)
+
+def run_ensemble(func_info, param_sets, model_data, percentiles,
+                 noise_std=0., seed=0, num_bins=200):
+    '''Runs the model for all param_sets, returning percentile bands
+
+The model is evaluated cal.BATCH_SIZE param sets at a time (see
+cal.batch_outputs), twice as StreamingPercentiles needs two passes.
+If noise_std is given, Gaussian noise with this std. dev. is added to
+each run (the same noise in both passes), so that the bands are
+prediction intervals rather than just the spread due to the params.
+
+Returns a dict with 'percentiles' (as given), 'bands', an array of shape
+(len(percentiles), num_days), and the ensemble's 'mean' and 'std'.
+'''
+    num_days = len(model_data['snowprop'])
+    stats = StreamingPercentiles(num_days, num_bins)
+    def runs():
+        for index, outputs in cal.batch_outputs(func_info, param_sets,
+                                                model_data):
+            if noise_std > 0:
+                rand = np.random.RandomState([seed, index.start])
+                outputs += noise_std * rand.standard_normal(outputs.shape)
+            yield outputs
+
+    for outputs in runs():
+        stats.update_range(outputs)
+    for outputs in runs():
+        stats.add(outputs)
+    return {'percentiles': tuple(percentiles),
+            'bands': stats.percentiles(percentiles),
+            'mean': stats.mean(),
+            'std': stats.std()}
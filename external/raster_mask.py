@@ -1,6 +1,8 @@
 # Taken P. Lewis' course notes:
 # http://www2.geog.ucl.ac.uk/~plewis/geogg122_local/geogg122/Chapter6a_Practical/python/raster_mask.py
-# Unmodified apart from func docstrings.
+# Unmodified apart from func docstrings, and raster_mask2 being split up 
+# so that raster_mask2_window, raster_label_window and polygon_mask_window
+# can share its code.
 import numpy as np
 import numpy.ma as ma
 from osgeo import ogr,osr
@@ -122,6 +124,144 @@ def raster_mask2(reference_filename, \
                 target_vector_file = "files/data/world.shp",\
                 attribute_filter = 0):
     '''Taken from course notes, see comments at top of file.'''
+    pixel, line, raster = polygon_to_pixels(reference_filename,
+                                            target_vector_file,
+                                            attribute_filter)
+
+    rasterPoly = Image.new("L", (raster.RasterXSize, raster.RasterYSize),1)
+    rasterize = ImageDraw.Draw(rasterPoly)
+    # must be a tuple now ... doh
+    listdata = list(tuple(pixel) for pixel in np.array((pixel,line)).T.tolist())
+    rasterize.polygon(listdata,outline=0,fill=0)
+    mask = imageToArray(rasterPoly).astype(bool)
+    return mask
+
+def raster_mask2_window(reference_filename, \
+                target_vector_file = "files/data/world.shp",\
+                attribute_filter = 0):
+    '''Like raster_mask2, but only rasterizes the rows around the polygon
+
+Returns a tuple (mask, (ymin, ymax, xmin, xmax)), where mask is the same as
+raster_mask2(...)[ymin:ymax, xmin:xmax], without making a full size image.
+The window is the smallest one that holds all unmasked pixels.
+
+N.B. pixel coords are only shifted in y, shifting them in x can change 
+how PIL rounds pixels on the edge of the polygon.'''
+    pixel, line, raster = polygon_to_pixels(reference_filename,
+                                            target_vector_file,
+                                            attribute_filter)
+
+    ymin = int(max(line.min(), 0))
+    ymax = int(min(line.max() + 1, raster.RasterYSize))
+
+    rasterPoly = Image.new("L", (raster.RasterXSize, ymax - ymin),1)
+    rasterize = ImageDraw.Draw(rasterPoly)
+    listdata = list(tuple(pixel) for pixel in 
+                    np.array((pixel, line - ymin)).T.tolist())
+    rasterize.polygon(listdata,outline=0,fill=0)
+    mask = imageToArray(rasterPoly).astype(bool)
+
+    # Crop to what was drawn, which can be smaller than the polygon's 
+    # bounding box if it was clipped by the edge of the raster.
+    rows, cols = np.where(mask == False)
+    mask = mask[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
+    return mask, (int(ymin + rows.min()), int(ymin + rows.max() + 1),
+                  int(cols.min()), int(cols.max() + 1))
+
+def raster_label_window(reference_filename, \
+                target_vector_file = "files/data/world.shp",\
+                attribute_filters = (0,)):
+    '''Like raster_mask2_window, but rasterizes many polygons into one raster
+
+Returns a tuple (labels, (ymin, ymax, xmin, xmax)). labels is an int array
+where pixels in polygon attribute_filters[i] are i + 1 and all others are
+0, cropped to the smallest window that holds all labelled pixels. Each
+polygon gets the same pixels as in raster_mask2_window, unless polygons
+overlap, in which case the later one's label is used.'''
+    polygons = [polygon_to_pixels(reference_filename, target_vector_file,
+                                  attribute_filter)
+                for attribute_filter in attribute_filters]
+    raster = polygons[0][2]
+
+    ymin = int(max(min(line.min() for pixel, line, r in polygons), 0))
+    ymax = int(min(max(line.max() for pixel, line, r in polygons) + 1, 
+                   raster.RasterYSize))
+
+    labels = np.zeros((ymax - ymin, raster.RasterXSize), dtype=np.int32)
+    for i, (pixel, line, r) in enumerate(polygons):
+        rasterPoly = Image.new("L", (raster.RasterXSize, ymax - ymin),1)
+        rasterize = ImageDraw.Draw(rasterPoly)
+        listdata = list(tuple(pixel) for pixel in 
+                        np.array((pixel, line - ymin)).T.tolist())
+        rasterize.polygon(listdata,outline=0,fill=0)
+        labels[imageToArray(rasterPoly) == 0] = i + 1
+
+    rows, cols = np.where(labels != 0)
+    labels = labels[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
+    return labels, (int(ymin + rows.min()), int(ymin + rows.max() + 1),
+                    int(cols.min()), int(cols.max() + 1))
+
+def polygon_mask_window(pixel, line):
+    '''Rasterizes a polygon given by its pixel coords in the window around it
+
+Unlike raster_mask2_window the window isn't clipped to a raster, so pixel
+coords can be e.g. on a grid of many tiles (see polygon_to_grid_pixels).
+Returns a tuple (mask, (ymin, ymax, xmin, xmax)), mask is False inside
+the polygon.'''
+    xmin, ymin = int(pixel.min()), int(line.min())
+    rasterPoly = Image.new("L", (int(pixel.max()) - xmin + 1, 
+                                 int(line.max()) - ymin + 1),1)
+    rasterize = ImageDraw.Draw(rasterPoly)
+    listdata = list(tuple(pixel) for pixel in 
+                    np.array((pixel - xmin, line - ymin)).T.tolist())
+    rasterize.polygon(listdata,outline=0,fill=0)
+    mask = imageToArray(rasterPoly).astype(bool)
+
+    rows, cols = np.where(mask == False)
+    mask = mask[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
+    return mask, (int(ymin + rows.min()), int(ymin + rows.max() + 1),
+                  int(xmin + cols.min()), int(xmin + cols.max() + 1))
+
+def polygon_label_window(polygons):
+    '''Like polygon_mask_window, but puts many polygons in one label raster
+
+polygons: list of (pixel, line) coords of each polygon, e.g. on a grid of
+many tiles (see polygon_to_grid_pixels).
+Returns a tuple (labels, (ymin, ymax, xmin, xmax)), labels is i + 1 for 
+pixels in polygons[i] and 0 elsewhere, as in raster_label_window.'''
+    masks = [polygon_mask_window(pixel, line) for pixel, line in polygons]
+    ymin = min(window[0] for mask, window in masks)
+    ymax = max(window[1] for mask, window in masks)
+    xmin = min(window[2] for mask, window in masks)
+    xmax = max(window[3] for mask, window in masks)
+
+    labels = np.zeros((ymax - ymin, xmax - xmin), dtype=np.int32)
+    for i, (mask, window) in enumerate(masks):
+        labels[window[0] - ymin:window[1] - ymin, 
+               window[2] - xmin:window[3] - xmin][~mask] = i + 1
+    return labels, (ymin, ymax, xmin, xmax)
+
+def polygon_to_pixels(reference_filename, target_vector_file, 
+                      attribute_filter):
+    '''Taken from raster_mask2 (see comments at top of file).
+
+Transforms a polygon in target_vector_file to the raster's projection.
+Returns a tuple (pixel, line, raster): the polygon's pixel coords and
+the opened reference raster.'''
+    # MODIS
+    raster = gdal.Open( reference_filename )
+    pixel, line = polygon_to_grid_pixels(target_vector_file, attribute_filter,
+                                         raster.GetProjectionRef(),
+                                         raster.GetGeoTransform())
+    return pixel, line, raster
+
+def polygon_to_grid_pixels(target_vector_file, attribute_filter, modisWKT, 
+                           geo_t):
+    '''Taken from raster_mask2 (see comments at top of file).
+
+Transforms a polygon in target_vector_file to the projection modisWKT.
+Returns a tuple (pixel, line): the polygon's pixel coords on the grid 
+given by geotransform geo_t.'''
 
     #import pdb;pdb.set_trace()
     #burn_value = 1
@@ -149,12 +289,6 @@ def raster_mask2(reference_filename, \
     # extract and plot the transformed data
     pnts = np.array([(pts.GetX(p), pts.GetY(p)) for p in xrange(pts.GetPointCount())]).transpose()
 
-    # MODIS
-    g = gdal.Open( reference_filename )
-    raster = gdal.Open( reference_filename )
-    # get the wicket
-    modisWKT = raster.GetProjectionRef()
-
     oSRS = osr.SpatialReference ()
     oSRSop = osr.SpatialReference ()
 
@@ -173,17 +307,8 @@ def raster_mask2(reference_filename, \
 
     pnts = np.array([(pts.GetX(p), pts.GetY(p)) for p in xrange(pts.GetPointCount())]).transpose()
 
-    geo_t = raster.GetGeoTransform()
-
     pixel, line = world2Pixel(geo_t,pnts[0],pnts[1])
-
-    rasterPoly = Image.new("L", (raster.RasterXSize, raster.RasterYSize),1)
-    rasterize = ImageDraw.Draw(rasterPoly)
-    # must be a tuple now ... doh
-    listdata = list(tuple(pixel) for pixel in np.array((pixel,line)).T.tolist())
-    rasterize.polygon(listdata,outline=0,fill=0)
-    mask = imageToArray(rasterPoly).astype(bool)
-    return mask
+    return pixel, line
 
 
 def imageToArray(i):
@@ -1,7 +1,145 @@
 import numpy as np
 import scipy.stats as stats
+from scipy import signal
 
-def model_accum_exp_decrease(data, tempThresh, k, p):
+# Engines that can be used to evaluate the NRF models below.
+# 'fast' uses a recursive filter (exp. decay) and evaluates the model in O(N),
+#        or a convolution with the NRF kernel (all other NRFs).
+# 'loop' is the original implementation: one full length NRF per melt day.
+ENGINES = ('fast', 'loop')
+
+# Above this length FFT convolution beats direct convolution.
+FFT_CONVOLVE_MIN_LENGTH = 1000
+
+# Step (deg. C) used for derivatives wrt temperature thresholds, which 
+# the models are step functions of.
+THRESH_STEP = 1.
+
+# Batches of fewer param sets than this are filtered one set at a time by
+# lfilter, larger ones are filtered all at once a day at a time.
+BATCH_LFILTER_MAX = 16
+
+def melt_water(data, key, tempThresh, k, use_temp_delta=False):
+    '''Works out the water released on each day as an impulse series
+
+Water is k * data[key][d] on days d where temp is over tempThresh 
+(multiplied by temp - tempThresh if use_temp_delta is True) and 0 otherwise.
+    '''
+    temp = np.asarray(data['temp'], dtype=float)
+    values = np.asarray(data[key], dtype=float)
+
+    melt_mask = temp > tempThresh
+    water = np.zeros(len(values))
+    water[melt_mask] = k * values[melt_mask]
+    if use_temp_delta:
+        water[melt_mask] *= temp[melt_mask] - tempThresh
+    return water
+
+def exp_decay_filter(water, p, delay=0):
+    '''Convolves an impulse series of water with an exp. decrease NRF
+
+The NRF is p ** n for n >= 0 and 0 before then, which means that
+the convolution can be written as a recursive filter:
+accum[t] = p * accum[t - 1] + water[t]
+so only a single pass is needed (done in C by lfilter).
+
+delay shifts the start of the NRF by that many days.
+    '''
+    return signal.lfilter([1.], [1., -p], delay_water(water, p, delay))
+
+def delay_water(water, p, delay):
+    '''Shifts water by delay days, as exp_decay_filter does before filtering'''
+    water = np.asarray(water, dtype=float)
+    shifted_water = np.zeros(len(water))
+    if delay >= 0:
+        if delay < len(water):
+            shifted_water[delay:] = water[:len(water) - delay]
+    else:
+        n_before = min(-delay, len(water))
+        shifted_water[:len(water) - n_before] = water[n_before:]
+        # Water whose response would start before day 0 is already part
+        # way through its decay on day 0, so add it into the first value.
+        n = -delay - np.arange(n_before)
+        shifted_water[0] += (water[:n_before] * p ** n).sum()
+    return shifted_water
+
+def kernel_convolve(water, kernel):
+    '''Convolves an impulse series of water with an arbitrary NRF kernel
+
+kernel[n] is the NRF n days after the water was released, so:
+accum[t] = sum(water[d] * kernel[t - d] for d <= t)
+The kernel only needs to be evaluated once per set of params. Direct 
+convolution is used for short series, FFT convolution for long ones.
+    '''
+    water = np.asarray(water, dtype=float)
+    kernel = np.asarray(kernel, dtype=float)
+    if min(len(water), len(kernel)) < FFT_CONVOLVE_MIN_LENGTH:
+        accum = np.convolve(water, kernel)
+    else:
+        accum = signal.fftconvolve(water, kernel)
+    return accum[:len(water)]
+
+def invgauss_nrf(p, num_days):
+    '''Evaluates the invgauss NRF used in the models below for num_days
+
+p[2] is a scaling factor, p[3] scales days, p[4:7] are the mu, loc 
+and scale params of the invgauss dist.
+    '''
+    n = np.arange(num_days)
+    return p[2] * stats.invgauss.pdf(n * p[3], p[4], p[5], p[6])
+
+def exp_decay_filter_grad(accum, p):
+    '''Derivative wrt p of accum = exp_decay_filter(water, p) (no delay)
+
+Differentiating accum[t] = p * accum[t - 1] + water[t] gives
+grad[t] = p * grad[t - 1] + accum[t - 1]
+which is the same recursive filter applied to accum shifted by a day.
+    '''
+    return signal.lfilter([0., 1.], [1., -p], accum)
+
+def exp_decay_jac_columns(data, key, tempThresh, k, p, 
+                          thresh_step=THRESH_STEP):
+    '''Works out one exp. decay term of a model and its derivatives
+
+Returns (accum, d_tempThresh, d_k, d_p). d_k and d_p are exact. accum is 
+a step function of tempThresh, so d_tempThresh is the central difference
+over thresh_step, which shows which way moving the threshold would go.
+    '''
+    unit_water = melt_water(data, key, tempThresh, 1.)
+    unit_accum = exp_decay_filter(unit_water, p)
+    accum = k * unit_accum
+    d_tempThresh = k * (exp_decay_filter(melt_water(data, key, 
+                            tempThresh + thresh_step / 2., 1.), p) - 
+                        exp_decay_filter(melt_water(data, key,
+                            tempThresh - thresh_step / 2., 1.), p)) \
+                   / thresh_step
+    return accum, d_tempThresh, unit_accum, exp_decay_filter_grad(accum, p)
+
+def jac_accum_exp_decrease(data, tempThresh, k, p, thresh_step=THRESH_STEP):
+    '''model_accum_exp_decrease and its Jacobian
+
+Returns (accum, jac) where jac has shape (N, 3), the derivatives of accum
+wrt (tempThresh, k, p). See exp_decay_jac_columns.
+    '''
+    columns = exp_decay_jac_columns(data, 'snowprop', tempThresh, k, p,
+                                    thresh_step)
+    return columns[0], np.column_stack(columns[1:])
+
+def jac_accum_exp_decrease_with_precip(data, p, thresh_step=THRESH_STEP):
+    '''model_accum_exp_decrease_with_precip and its Jacobian
+
+Returns (accum, jac) where jac has shape (N, 6), the derivatives of accum
+wrt p. See exp_decay_jac_columns.
+    '''
+    snow = exp_decay_jac_columns(data, 'snowprop', p[0], p[2], p[4], 
+                                 thresh_step)
+    precip = exp_decay_jac_columns(data, 'precip', p[1], p[3], p[5], 
+                                   thresh_step)
+    jac = np.column_stack((snow[1], precip[1], snow[2], precip[2],
+                           snow[3], precip[3]))
+    return snow[0] + precip[0], jac
+
+def model_accum_exp_decrease(data, tempThresh, k, p, engine='fast'):
     '''Implements a simple Network Response Function (NRF) 
 
 Assumes NRF is a decreasing (if p < 1) exponential function.
@@ -9,8 +147,13 @@ Taken from P. Lewis' course notes: 6a. Assessed Practical
 http://www2.geog.ucl.ac.uk/~plewis/geogg122_local/geogg122//Chapter6a_Practical/Practical.html
 renamed from model_accum to model_accum_exp_decrease to make model used explicit.
 
-Commented to remind me how it works. otherwise unchanged.
+Commented to remind me how it works. otherwise unchanged, apart from
+the fast engine (see ENGINES).
     '''
+    if engine == 'fast':
+        water = melt_water(data, 'snowprop', tempThresh, k)
+        return data['snowprop']*0. + exp_decay_filter(water, p)
+
     # Get indices of all days where temp is over threshold.
     meltDays = np.where(data['temp'] > tempThresh)[0]
     accum = data['snowprop']*0.
@@ -32,7 +175,7 @@ Commented to remind me how it works. otherwise unchanged.
         accum += m * water
     return accum
 
-def model_accum_exp_decrease_with_precip(data, p):
+def model_accum_exp_decrease_with_precip(data, p, engine='fast'):
     '''Implements a simple Network Response Function (NRF) 
 
 Assumes NRF is a decreasing (if p < 1) exponential function.
@@ -47,6 +190,12 @@ Based on model_accum_exp_decrease by P. Lewis above.
     k2 = p[3]
     p1 = p[4]
     p2 = p[5]
+    if engine == 'fast':
+        snow_water = melt_water(data, 'snowprop', tempThresh1, k1)
+        precip_water = melt_water(data, 'precip', tempThresh2, k2)
+        return data['snowprop']*0. + exp_decay_filter(snow_water, p1) \
+                                   + exp_decay_filter(precip_water, p2)
+
     # Get indices of all days where temp is over threshold.
     meltDays1 = np.where(data['temp'] > tempThresh1)[0]
     meltDays2 = np.where(data['temp'] > tempThresh2)[0]
@@ -87,7 +236,8 @@ Based on model_accum_exp_decrease by P. Lewis above.
         accum += m * water
     return accum
 
-def model_accum_exp_decrease_with_temp_delta(data, tempThresh, k, p):
+def model_accum_exp_decrease_with_temp_delta(data, tempThresh, k, p, 
+                                             engine='fast'):
     '''Implements a simple Network Response Function (NRF) 
 
 Assumes NRF is a decreasing (if p < 1) exponential function.
@@ -96,6 +246,11 @@ difference between the threshold temp and the actual temp.
 
 Based on model_accum_exp_decrease by P. Lewis above.
     '''
+    if engine == 'fast':
+        water = melt_water(data, 'snowprop', tempThresh, k, 
+                           use_temp_delta=True)
+        return data['snowprop']*0. + exp_decay_filter(water, p)
+
     # Get indices of all days where temp is over threshold.
     meltDays = np.where(data['temp'] > tempThresh)[0]
     temp_deltas = data['temp'][data['temp'] > tempThresh] - tempThresh
@@ -119,7 +274,7 @@ Based on model_accum_exp_decrease by P. Lewis above.
         accum += m * water
     return accum
 
-def model_accum_invgauss_decrease(data, p):
+def model_accum_invgauss_decrease(data, p, engine='fast'):
     '''Implements a invgaus Network Response Function (NRF) 
 
 Uses an invguass response function instead if an exp decrease.
@@ -128,6 +283,11 @@ Based on model_accum_exp_decrease by P. Lewis above.
     #base_flow_rate = p[7]
     tempThresh = p[0]
     k          = p[1]
+    if engine == 'fast':
+        water = melt_water(data, 'snowprop', tempThresh, k)
+        return data['snowprop']*0. + kernel_convolve(water, 
+                                             invgauss_nrf(p, len(water)))
+
     # Get indices of all days where temp is over threshold.
     meltDays = np.where(data['temp'] > tempThresh)[0]
     temp_deltas = data['temp'][data['temp'] > tempThresh] - tempThresh
@@ -150,7 +310,7 @@ Based on model_accum_exp_decrease by P. Lewis above.
         accum += m * water # + base_flow_rate # makes things worse!
     return accum
 
-def model_accum_invgauss_decrease_with_temp_delta(data, p):
+def model_accum_invgauss_decrease_with_temp_delta(data, p, engine='fast'):
     '''Implements a invgauss Network Response Function (NRF) 
 
 Like a combined version of methods above:
@@ -161,6 +321,12 @@ Based on model_accum_exp_decrease by P. Lewis above.
     #base_flow_rate = p[7]
     tempThresh = p[0]
     k          = p[1]
+    if engine == 'fast':
+        water = melt_water(data, 'snowprop', tempThresh, k, 
+                           use_temp_delta=True)
+        return data['snowprop']*0. + kernel_convolve(water, 
+                                             invgauss_nrf(p, len(water)))
+
     # Get indices of all days where temp is over threshold.
     meltDays = np.where(data['temp'] > tempThresh)[0]
     temp_deltas = data['temp'][data['temp'] > tempThresh] - tempThresh
@@ -183,7 +349,8 @@ Based on model_accum_exp_decrease by P. Lewis above.
         accum += m * water # + base_flow_rate # makes things worse!
     return accum
 
-def model_accum_exp_decrease_with_delay(data, tempThresh, k, p, delay):
+def model_accum_exp_decrease_with_delay(data, tempThresh, k, p, delay, 
+                                        engine='fast'):
     '''Implements a simple Network Response Function (NRF) 
 
 Assumes NRF is a decreasing (if p < 1) exponential function.
@@ -192,6 +359,11 @@ Adds in a delay to the NRF.
 
 Based on model_accum_exp_decrease by P. Lewis above.
 '''
+    if engine == 'fast':
+        water = melt_water(data, 'snowprop', tempThresh, k)
+        return data['snowprop']*0. + exp_decay_filter(water, p, 
+                                                      int(delay * 100000))
+
     # Get indices of all days where temp is over threshold.
     meltDays = np.where(data['temp'] > tempThresh)[0]
     accum = data['snowprop']*0.
@@ -212,3 +384,271 @@ Based on model_accum_exp_decrease by P. Lewis above.
 	# This is like a convolution of each m * water into accum. 
         accum += m * water
     return accum
+
+def melt_water_batch(data, key, tempThresh, k, use_temp_delta=False):
+    '''melt_water for K sets of params at once
+
+tempThresh, k: arrays of shape (K,).
+Returns an array of shape (K, N).
+    '''
+    temp = np.asarray(data['temp'], dtype=float)
+    values = np.asarray(data[key], dtype=float)
+    tempThresh = np.asarray(tempThresh, dtype=float)[:, None]
+    k = np.asarray(k, dtype=float)[:, None]
+
+    # N.B. nan temps are never over the threshold.
+    melt_mask = temp > tempThresh
+    water = np.where(melt_mask, k * values, 0.)
+    if use_temp_delta:
+        water *= np.where(melt_mask, temp - tempThresh, 0.)
+    return water
+
+def exp_decay_filter_batch(water, p):
+    '''exp_decay_filter (no delay) for K series with their own p at once
+
+water: array of shape (K, N), p: array of shape (K,).
+lfilter can only use one p per call, so for large K the recursion
+accum[:, t] = p * accum[:, t - 1] + water[:, t]
+is done a day at a time for all K series together.
+    '''
+    water = np.asarray(water, dtype=float)
+    p = np.asarray(p, dtype=float)
+    if len(p) < BATCH_LFILTER_MAX:
+        return np.array([signal.lfilter([1.], [1., -p_i], water_i) 
+                         for water_i, p_i in zip(water, p)]).reshape(
+                                                          water.shape)
+
+    # Days along the first axis, so each step works on contiguous memory.
+    accum = np.array(water.T, order='C')
+    decayed = np.empty(len(p))
+    for t in range(1, len(accum)):
+        np.multiply(p, accum[t - 1], out=decayed)
+        accum[t] += decayed
+    return accum.T
+
+def kernel_convolve_batch(water, kernels):
+    '''kernel_convolve for K series, each with its own kernel, at once
+
+water, kernels: arrays of shape (K, N). Uses FFT convolution along the
+second axis.
+    '''
+    water = np.asarray(water, dtype=float)
+    num_days = water.shape[1]
+    n_fft = 1
+    while n_fft < 2 * num_days - 1:
+        n_fft *= 2
+    accum = np.fft.irfft(np.fft.rfft(water, n_fft, axis=1) *
+                         np.fft.rfft(kernels, n_fft, axis=1), n_fft, axis=1)
+    return accum[:, :num_days]
+
+def invgauss_nrf_batch(params, num_days):
+    '''invgauss_nrf for K sets of params (shape (K, >= 7)) at once'''
+    params = np.asarray(params, dtype=float)
+    n = np.arange(num_days)
+    return params[:, 2:3] * stats.invgauss.pdf(n * params[:, 3:4], 
+                                               params[:, 4:5], params[:, 5:6],
+                                               params[:, 6:7])
+
+# Batched versions of the models. These take an array of params of shape 
+# (K, num_params), where each row holds the params that the model above
+# takes, and return an array of shape (K, N), row i being the model output
+# for params[i] (as a plain array, not masked).
+def model_accum_exp_decrease_batch(data, params):
+    '''Batched model_accum_exp_decrease, params rows: (tempThresh, k, p)'''
+    params = np.atleast_2d(params)
+    water = melt_water_batch(data, 'snowprop', params[:, 0], params[:, 1])
+    return exp_decay_filter_batch(water, params[:, 2])
+
+def model_accum_exp_decrease_with_precip_batch(data, params):
+    '''Batched model_accum_exp_decrease_with_precip'''
+    params = np.atleast_2d(params)
+    snow_water = melt_water_batch(data, 'snowprop', params[:, 0], 
+                                  params[:, 2])
+    precip_water = melt_water_batch(data, 'precip', params[:, 1], 
+                                    params[:, 3])
+    return exp_decay_filter_batch(snow_water, params[:, 4]) + \
+           exp_decay_filter_batch(precip_water, params[:, 5])
+
+def model_accum_exp_decrease_with_temp_delta_batch(data, params):
+    '''Batched model_accum_exp_decrease_with_temp_delta'''
+    params = np.atleast_2d(params)
+    water = melt_water_batch(data, 'snowprop', params[:, 0], params[:, 1],
+                             use_temp_delta=True)
+    return exp_decay_filter_batch(water, params[:, 2])
+
+def model_accum_exp_decrease_with_delay_batch(data, params):
+    '''Batched model_accum_exp_decrease_with_delay, params rows: 
+(tempThresh, k, p, delay)'''
+    params = np.atleast_2d(params)
+    water = melt_water_batch(data, 'snowprop', params[:, 0], params[:, 1])
+    shifted_water = np.array([delay_water(water_i, p_i, int(delay_i * 100000))
+                              for water_i, p_i, delay_i in 
+                              zip(water, params[:, 2], params[:, 3])])
+    return exp_decay_filter_batch(shifted_water.reshape(water.shape), 
+                                  params[:, 2])
+
+def model_accum_invgauss_decrease_batch(data, params):
+    '''Batched model_accum_invgauss_decrease'''
+    params = np.atleast_2d(params)
+    water = melt_water_batch(data, 'snowprop', params[:, 0], params[:, 1])
+    return kernel_convolve_batch(water, 
+                                 invgauss_nrf_batch(params, water.shape[1]))
+
+def model_accum_invgauss_decrease_with_temp_delta_batch(data, params):
+    '''Batched model_accum_invgauss_decrease_with_temp_delta'''
+    params = np.atleast_2d(params)
+    water = melt_water_batch(data, 'snowprop', params[:, 0], params[:, 1],
+                             use_temp_delta=True)
+    return kernel_convolve_batch(water, 
+                                 invgauss_nrf_batch(params, water.shape[1]))
+
+def check_engines(data, n_trials=20, seed=0):
+    '''Checks that all engines give the same results for random params
+
+Raises an AssertionError if they don't, otherwise returns the largest 
+absolute difference found.
+    '''
+    rand = np.random.RandomState(seed)
+    temp = np.asarray(data['temp'], dtype=float)
+    temp = temp[~np.isnan(temp)]
+    max_diff = 0.
+    for i in range(n_trials):
+        tempThresh = rand.uniform(temp.min(), temp.max())
+        k = rand.uniform(0, 1e-4)
+        p = rand.uniform(0.8, 0.99)
+        # Delays are scaled by 100000 inside the model.
+        delay = rand.randint(-5, 10) / 100000.
+        p_precip = [tempThresh, rand.uniform(temp.min(), temp.max()), 
+                    k, rand.uniform(0, 1e-3), p, rand.uniform(0.8, 0.99)]
+        # Scatter round values that give a sensible invgauss NRF.
+        p_invgauss = np.array([tempThresh, k, 1.36e-2, 5e-4, 2.45, 
+                               -2.8e-3, 9.7e-3]) * rand.uniform(0.8, 1.2, 7)
+
+        models = ((model_accum_exp_decrease, (tempThresh, k, p)),
+                  (model_accum_exp_decrease_with_precip, (p_precip,)),
+                  (model_accum_exp_decrease_with_temp_delta, 
+                   (tempThresh, k, p)),
+                  (model_accum_exp_decrease_with_delay, 
+                   (tempThresh, k, p, delay)),
+                  (model_accum_invgauss_decrease, (p_invgauss,)),
+                  (model_accum_invgauss_decrease_with_temp_delta, 
+                   (p_invgauss,)))
+
+        for model, args in models:
+            results = [model(data, *args, engine=engine) 
+                       for engine in ENGINES]
+            for result in results[1:]:
+                assert np.allclose(results[0], result, rtol=1e-8, atol=1e-12),\
+                       'Engines differ for %s'%model.__name__
+                max_diff = max(max_diff, np.abs(results[0] - result).max())
+    return max_diff
+
+def check_jacobians(data, n_trials=5, seed=0, rel_step=1e-4):
+    '''Checks the analytic derivatives against finite differences
+
+Only the derivatives wrt k and p are checked, as those wrt temperature
+thresholds are finite differences anyway. Raises an AssertionError if 
+they differ, otherwise returns the largest relative difference found.
+    '''
+    rand = np.random.RandomState(seed)
+    temp = np.asarray(data['temp'], dtype=float)
+    temp = temp[~np.isnan(temp)]
+    max_diff = 0.
+    for i in range(n_trials):
+        p = np.array([rand.uniform(temp.min(), temp.max()),
+                      rand.uniform(temp.min(), temp.max()),
+                      rand.uniform(0, 1e-4), rand.uniform(0, 1e-3),
+                      rand.uniform(0.8, 0.99), rand.uniform(0.8, 0.99)])
+        models = ((lambda p: model_accum_exp_decrease(data, *p),
+                   lambda p: jac_accum_exp_decrease(data, *p),
+                   p[[0, 2, 4]], (1, 2)),
+                  (lambda p: model_accum_exp_decrease_with_precip(data, p),
+                   lambda p: jac_accum_exp_decrease_with_precip(data, p),
+                   p, (2, 3, 4, 5)))
+        for model, jac_model, params, checked in models:
+            accum, jac = jac_model(params)
+            assert np.allclose(accum, model(params), rtol=1e-10, atol=1e-12)
+            for j in checked:
+                step = params[j] * rel_step
+                params_plus, params_minus = params.copy(), params.copy()
+                params_plus[j] += step
+                params_minus[j] -= step
+                fd = (model(params_plus) - model(params_minus)) / (2 * step)
+                # Allow for rounding error in fd, from terms that don't 
+                # depend on param j.
+                scale = np.abs(fd).max() + 1e-9 * np.abs(accum).max() / step
+                diff = np.abs(jac[:, j] - fd).max() / scale
+                assert diff < 1e-5, 'Derivative %i differs by %g'%(j, diff)
+                max_diff = max(max_diff, diff)
+    return max_diff
+
+def check_batches(data, num_params=100, seed=0):
+    '''Checks that the batched models agree with the models they batch
+
+Raises an AssertionError if they don't, otherwise returns the largest 
+relative difference found.
+    '''
+    rand = np.random.RandomState(seed)
+    temp = np.asarray(data['temp'], dtype=float)
+    temp = temp[~np.isnan(temp)]
+    def uniform(low, high):
+        return rand.uniform(low, high, num_params)
+    thresh_1, thresh_2 = uniform(temp.min(), temp.max()), \
+                         uniform(temp.min(), temp.max())
+    k_1, k_2 = uniform(0, 1e-4), uniform(0, 1e-3)
+    p_1, p_2 = uniform(0.8, 0.99), uniform(0.8, 0.99)
+    # Delays of up to 30 days either way.
+    delay = uniform(-3e-4, 3e-4)
+    p_invgauss = np.array([thresh_1, k_1] + [np.ones(num_params) * v for v in 
+                           (1.36e-2, 5e-4, 2.45, -2.8e-3, 9.7e-3)]).T * \
+                 rand.uniform(0.8, 1.2, (num_params, 7))
+
+    models = ((model_accum_exp_decrease, model_accum_exp_decrease_batch,
+               np.column_stack((thresh_1, k_1, p_1)), True),
+              (model_accum_exp_decrease_with_precip,
+               model_accum_exp_decrease_with_precip_batch,
+               np.column_stack((thresh_1, thresh_2, k_1, k_2, p_1, p_2)), 
+               False),
+              (model_accum_exp_decrease_with_temp_delta,
+               model_accum_exp_decrease_with_temp_delta_batch,
+               np.column_stack((thresh_1, k_1, p_1)), True),
+              (model_accum_exp_decrease_with_delay,
+               model_accum_exp_decrease_with_delay_batch,
+               np.column_stack((thresh_1, k_1, p_1, delay)), True),
+              (model_accum_invgauss_decrease, 
+               model_accum_invgauss_decrease_batch, p_invgauss, False),
+              (model_accum_invgauss_decrease_with_temp_delta,
+               model_accum_invgauss_decrease_with_temp_delta_batch, 
+               p_invgauss, False))
+    max_diff = 0.
+    for model, batch_model, params, unpack in models:
+        # Check both ways of filtering batches.
+        for batch in (params, params[:BATCH_LFILTER_MAX - 1]):
+            results = batch_model(data, batch)
+            for params_i, result in zip(batch, results):
+                if unpack:
+                    expected = model(data, *params_i)
+                else:
+                    expected = model(data, params_i)
+                scale = max(np.abs(expected).max(), 1e-300)
+                diff = np.abs(result - expected).max() / scale
+                assert diff < 1e-8, 'Batch differs for %s'%model.__name__
+                max_diff = max(max_diff, diff)
+    return max_diff
+
+if __name__ == "__main__":
+    # Check that all engines agree on synthetic data, long enough 
+    # to use FFT convolution in the second case.
+    for num_days in (365, 3 * FFT_CONVOLVE_MIN_LENGTH):
+        days = np.arange(num_days)
+        rand = np.random.RandomState(1)
+        synthetic_data = {'temp': 10 * np.sin(2 * np.pi * (days - 100) / 365.)
+                                  + rand.normal(0, 3, num_days),
+                          'snowprop': 1e5 * (1 + np.cos(2 * np.pi * days / 365.)),
+                          'precip': rand.exponential(1e-3, num_days)}
+        print('%i days, max difference between engines: %g'%(num_days, 
+                                             check_engines(synthetic_data)))
+        print('%i days, max rel. difference of derivatives: %g'%(num_days,
+                                           check_jacobians(synthetic_data)))
+        print('%i days, max rel. difference of batches: %g'%(num_days,
+                                             check_batches(synthetic_data)))
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+import re
+import logging
+
+from osgeo import osr
+
+from external.raster_mask import polygon_to_grid_pixels, polygon_mask_window, \
+                                 polygon_label_window
+import project_settings as settings
+
+log = logging.getLogger('modis_grid')
+
+# MODIS tiles are laid out on one global sinusoidal grid, tile hHHvVV being
+# HH tiles across and VV down from its upper left corner. From the MODIS
+# land grid docs:
+# http://modis-land.gsfc.nasa.gov/MODLAND_grid.html
+GRID_ULX = -20015109.354
+GRID_ULY = 10007554.677
+TILE_WIDTH = 1111950.5197
+SINUSOIDAL_PROJ4 = ('+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +a=6371007.181 '
+                    '+b=6371007.181 +units=m +no_defs')
+# Pixels along each side of a tile for the 500m snow products.
+TILE_PIXELS = 2400
+PIXEL_SIZE = TILE_WIDTH / TILE_PIXELS
+GRID_GEOTRANSFORM = (GRID_ULX, PIXEL_SIZE, 0., GRID_ULY, 0., -PIXEL_SIZE)
+
+TILE_RE = re.compile(r'^h(\d\d)v(\d\d)$')
+
+def parse_tile(tile):
+    '''Returns (h, v) for a tile name, e.g. 'h09v05' -> (9, 5)'''
+    match = TILE_RE.match(tile)
+    if match is None:
+        raise Exception('%s is not a MODIS tile name'%tile)
+    return int(match.group(1)), int(match.group(2))
+
+def tile_name(h, v):
+    return 'h%02iv%02i'%(h, v)
+
+def tile_origin(tile):
+    '''Returns the (row, col) on the grid of the tile's first pixel'''
+    h, v = parse_tile(tile)
+    return v * TILE_PIXELS, h * TILE_PIXELS
+
+def tiles_for_window(window):
+    '''Splits a window on the grid into the parts that lie on each tile
+
+window: (ymin, ymax, xmin, xmax) in grid pixels.
+Returns a list of (tile, tile_window, part_window) tuples, tile_window is
+the part in the tile's pixels and part_window the same part in the
+window's pixels, both as (ymin, ymax, xmin, xmax).'''
+    ymin, ymax, xmin, xmax = window
+    parts = []
+    for v in range(ymin // TILE_PIXELS, (ymax - 1) // TILE_PIXELS + 1):
+        for h in range(xmin // TILE_PIXELS, (xmax - 1) // TILE_PIXELS + 1):
+            row, col = v * TILE_PIXELS, h * TILE_PIXELS
+            part = (max(ymin, row), min(ymax, row + TILE_PIXELS),
+                    max(xmin, col), min(xmax, col + TILE_PIXELS))
+            parts.append((tile_name(h, v),
+                          (part[0] - row, part[1] - row,
+                           part[2] - col, part[3] - col),
+                          (part[0] - ymin, part[1] - ymin,
+                           part[2] - xmin, part[3] - xmin)))
+    return parts
+
+def catchment_grid_mask(shape_file, feature_id):
+    '''Works out the mask for a catchment on the grid
+
+Returns a tuple (catchment_mask, (ymin, ymax, xmin, xmax)) like
+prepare.load_catchment_mask, but with the window in grid pixels, so it
+can span many tiles. Doesn't need any HDF files.'''
+    pixel, line = polygon_to_grid_pixels(shape_file, feature_id,
+                                         sinusoidal_wkt(), GRID_GEOTRANSFORM)
+    return polygon_mask_window(pixel, line)
+
+def catchment_grid_labels(shape_file, feature_ids):
+    '''Works out the label raster for many catchments on the grid
+
+Returns a tuple (labels, (ymin, ymax, xmin, xmax)) like
+prepare.load_catchment_labels, but with the window in grid pixels.'''
+    wkt = sinusoidal_wkt()
+    return polygon_label_window([polygon_to_grid_pixels(shape_file, 
+                                                        feature_id, wkt,
+                                                        GRID_GEOTRANSFORM)
+                                 for feature_id in feature_ids])
+
+def sinusoidal_wkt():
+    '''Returns the WKT of the grid's sinusoidal projection'''
+    sinusoidal = osr.SpatialReference()
+    sinusoidal.ImportFromProj4(SINUSOIDAL_PROJ4)
+    return sinusoidal.ExportToWkt()
+
+def catchment_tiles(shape_file, feature_id):
+    '''Returns the names of all tiles that the catchment is on'''
+    catchment_mask, window = catchment_grid_mask(shape_file, feature_id)
+    return [tile for tile, tile_window, part_window in tiles_for_window(window)
+            if not catchment_mask[part_window[0]:part_window[1],
+                                  part_window[2]:part_window[3]].all()]
+
+def catchments_tiles(shape_file, feature_ids):
+    '''Returns the names of all tiles that any of the catchments are on'''
+    tiles = []
+    for feature_id in feature_ids:
+        for tile in catchment_tiles(shape_file, feature_id):
+            if tile not in tiles:
+                tiles.append(tile)
+    return tiles
+
+def settings_tiles(shape_file="Hydrologic_Units/HUC_Polygons.shp",
+                   feature_id=2):
+    '''Returns the tiles to use from settings.TILES
+
+None: just settings.TILE (the catchment is assumed to be on it).
+'auto': the tiles that the catchment or any of settings.SNOW_BASIN_IDS
+        are on, see catchments_tiles.
+Otherwise settings.TILES is a list of tile names.
+
+Used for downloading, fingerprinting and reading, so that they all agree.'''
+    if settings.TILES is None:
+        return [settings.TILE]
+    elif settings.TILES == 'auto':
+        tiles = catchments_tiles('%s/%s'%(settings.DATA_DIR, shape_file),
+                                 (feature_id,) + tuple(settings.SNOW_BASIN_IDS))
+        log.info('  Catchment and basins are on tiles %s'%', '.join(tiles))
+        return tiles
+    return list(settings.TILES)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+import os
+import re
+import json
+import time
+import logging
+
+log = logging.getLogger('modis_index')
+
+# e.g. MYD10A1.A2008001.h09v05.005.2008003172521.hdf
+# The date part is A<year><doy>.
+MODIS_FILE_RE = re.compile(r'^[^.]+\.A(\d{4})(\d{3})\.(h\d\dv\d\d)\..*\.hdf$')
+
+# Dirs modified less than this many secs before they were scanned are
+# always rescanned, as dir mtimes are not always very precise.
+MTIME_RESOLUTION = 2.
+
+def parse_modis_file_name(file_name):
+    '''Parses a MODIS HDF file name
+
+Returns a tuple (year, doy, tile), or None if file_name isn't a MODIS HDF file.
+'''
+    match = MODIS_FILE_RE.match(os.path.basename(file_name))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)), match.group(3)
+
+def modis_dir_name(dataset, tile, year):
+    '''Name of the dir files are stored in, e.g. AQUA_h09v05_2005'''
+    return '%s_%s_%s'%(dataset, tile, year)
+
+class ModisFileIndex:
+    """Index of the MODIS HDF files downloaded to a data dir
+
+Each <dataset>_<tile>_<year> dir in data_dir is scanned once and the file
+names parsed, giving a map of (dataset, tile, year, doy) -> path. The index
+is saved to index_file, and dirs are only rescanned when their mtime shows
+that files have been added or removed since they were last scanned.
+"""
+    def __init__(self, data_dir, index_file=None):
+        """Loads the index from index_file if it exists
+
+index_file defaults to <data_dir>/cache/modis_index.json
+        """
+        self.data_dir = data_dir
+        if index_file is None:
+            index_file = '%s/cache/modis_index.json'%data_dir
+        self.index_file = index_file
+
+        # Dirs that have been checked to be up to date since loading.
+        self.checked_dirs = set()
+        self.dirs = {}
+        if os.path.exists(self.index_file):
+            try:
+                self.dirs = json.load(open(self.index_file, 'r'))['dirs']
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                log.warn("  COULDN'T LOAD MODIS FILE INDEX, rescanning")
+                log.warn('  Exception: %s'%(e))
+
+    def _dir_entry(self, dataset, tile, year):
+        '''Gets the index entry for a dir, rescanning it if needed'''
+        dir_name = modis_dir_name(dataset, tile, year)
+        if dir_name in self.checked_dirs:
+            return self.dirs.get(dir_name)
+        self.checked_dirs.add(dir_name)
+
+        path = '%s/%s'%(self.data_dir, dir_name)
+        if not os.path.exists(path):
+            self.dirs.pop(dir_name, None)
+            return None
+
+        mtime = os.path.getmtime(path)
+        entry = self.dirs.get(dir_name)
+        if (entry is None or entry['mtime'] != mtime or
+            mtime >= entry['scanned_at'] - MTIME_RESOLUTION):
+            entry = self._scan_dir(path, tile, year)
+            entry['mtime'] = mtime
+            self.dirs[dir_name] = entry
+        return entry
+
+    def _scan_dir(self, path, tile, year):
+        '''Lists a dir and parses all MODIS file names in it'''
+        log.debug('  Scanning %s'%path)
+        entry = {'scanned_at': time.time(), 'files': {}}
+        for file_name in sorted(os.listdir(path)):
+            parsed = parse_modis_file_name(file_name)
+            if parsed is None or parsed[0] != year or parsed[2] != tile:
+                continue
+            # N.B. json needs str keys. If there are 2 files for one day,
+            # use the first, as glob.glob(...)[0] would (usually) have done.
+            entry['files'].setdefault(str(parsed[1]), file_name)
+        return entry
+
+    def lookup(self, dataset, tile, date):
+        '''Returns the path of the file for dataset, tile and date, or None'''
+        entry = self._dir_entry(dataset, tile, date.year)
+        if entry is None:
+            return None
+        doy = date.timetuple().tm_yday
+        file_name = entry['files'].get(str(doy))
+        if file_name is None:
+            return None
+        return '%s/%s/%s'%(self.data_dir, modis_dir_name(dataset, tile,
+                                                         date.year), file_name)
+
+    def any_file(self, dataset, tile, year):
+        '''Returns the path of any file for dataset, tile and year, or None'''
+        entry = self._dir_entry(dataset, tile, year)
+        if entry is None or len(entry['files']) == 0:
+            return None
+        file_name = entry['files'][min(entry['files'], key=int)]
+        return '%s/%s/%s'%(self.data_dir, modis_dir_name(dataset, tile, year),
+                           file_name)
+
+    def add(self, dataset, tile, date, path):
+        '''Adds a newly downloaded file to the index'''
+        entry = self._dir_entry(dataset, tile, date.year)
+        if entry is None:
+            self.checked_dirs.discard(modis_dir_name(dataset, tile, date.year))
+            entry = self._dir_entry(dataset, tile, date.year)
+        doy = date.timetuple().tm_yday
+        entry['files'].setdefault(str(doy), os.path.basename(path))
+
+    def save(self):
+        '''Saves the index to index_file'''
+        index_dir = os.path.dirname(self.index_file)
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        json.dump({'dirs': self.dirs}, open(self.index_file + '.tmp', 'w'))
+        os.rename(self.index_file + '.tmp', self.index_file)
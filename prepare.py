@@ -1,11 +1,12 @@
 #!/usr/bin/python
 import os
-import pickle
-import random
 import glob
+import json
+import hashlib
+import multiprocessing
+import random
 import logging
 import datetime as dt
-import csv
 
 import pylab as plt
 import numpy as np
@@ -13,9 +14,19 @@ import numpy.ma as ma
 import gdal
 from scipy import interpolate
 import matplotlib
+# pyhdf is optional, it lets both datasets be read with one open of an HDF.
+try:
+    from pyhdf.SD import SD, SDC
+except ImportError:
+    SD = None
 
-from external.raster_mask import raster_mask2
+from external.raster_mask import raster_mask2_window, raster_label_window
 from external.helpers import daterange
+import snow_cube
+import station_data
+from time_axis import TimeAxis
+import modis_index
+import modis_grid
 
 import project_settings as settings
 
@@ -29,153 +40,463 @@ log = logging.getLogger('prepare')
 # I'm only interested in these 2 though.
 FRAC_SNOW_COVER_TPL = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_Snow_500m:Fractional_Snow_Cover'
 QA_TPL              = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_Snow_500m:Snow_Spatial_QA'
+# Names of the same datasets, as used by pyhdf.
+FRAC_SNOW_COVER_NAME = 'Fractional_Snow_Cover'
+QA_NAME              = 'Snow_Spatial_QA'
 
 def load_snow_hdf_data(start_date, end_date, tile='h09v05', 
         datasets=('AQUA', 'TERRA'), 
         mask_shape_file="Hydrologic_Units/HUC_Polygons.shp",
-        start_doy=0, end_doy=366):
+        start_doy=0, end_doy=366, compact=False, catchment=None):
     '''Loads HDF files in settings.DATA_DIR for spec. tile and year. 
 
-Caches results, and will load this if it exists if settings.ENABLE_CACHE 
-is True.
+If settings.ENABLE_CACHE is True, the data is stored in a SnowCubeStore
+and only days/datasets that aren't in it, or whose HDF file has changed 
+(based on its mtime and size), are read from HDF files.
 
 Returns a dict: 'dates' is all dates in range, 'data is a
 masked numpy array of shape (duration * 2, mask.shape[0], mask.shape[1]). 
 Mask is determined by mask_shape_file. Each element is a 2D numpy array
 of the catchment area and the default is to order them so as they go:
 [AQUA, TERRA, AQUA, TERRA...]
+'qa' is the same for the QA data.
+
+If compact is True, 'data' and 'qa' are plain uint8 arrays instead, and 
+'mask' is the 2D catchment mask that applies to every element. This uses
+a lot less memory.
+
+catchment: the (catchment_mask, window) to use, as returned by 
+tile_catchment_mask, so that loading many date ranges doesn't work it 
+out each time.
     '''
     log.info("  Loading datasets %s for tile %s"%(str(datasets), tile))
     log.info("  Daterange: %s to %s"%(str(start_date), str(end_date)))
 
-    # Loading all the files can take a while.
-    # Read from a pickled cache if possible.
-    cache_dir = "%s/cache"%settings.DATA_DIR
-    cached_data_file = "%s/load_hdf_data_%s-%s.pkl"%(cache_dir,
-	                                             start_date, end_date)
-    if os.path.exists(cached_data_file) and settings.ENABLE_CACHE:
-        log.info('  Loading data from cache')
-        try:
-            data = pickle.load(open(cached_data_file, 'rb'))
-            return data
-        except:
-            log.warn("  COULDN'T LOAD DATA FROM CACHE")
+    # Each data dir is only listed once, rather than globbing for each day.
+    file_index = modis_index.ModisFileIndex(settings.DATA_DIR)
 
-    all_frac_snow_data = []
-    all_qa_data = []
+    if catchment is None:
+        catchment = tile_catchment_mask(file_index, start_date.year, tile,
+                                        datasets, mask_shape_file)
+    catchment_mask, (ymin, ymax, xmin, xmax) = catchment
 
-    # Generate a mask based on the catchment area.
-    # Pick any hdf file to use as its input.
-    file_search_path = '%s/%s_%s_%s/'%(settings.DATA_DIR, datasets[0], tile, 
-		       start_date.year) + "*.A%04i???.*.hdf"%(start_date.year)
-    file_name = glob.glob(file_search_path)[0]
-    hdf_str = FRAC_SNOW_COVER_TPL%(file_name)
+    dates, file_names = find_snow_files(file_index, start_date, end_date, 
+                                        tile, datasets)
+    file_index.save()
 
-    # Taken from course notes.
-    catchment_mask = raster_mask2(hdf_str, 
-        target_vector_file="%s/%s"%(settings.DATA_DIR, mask_shape_file),
-        attribute_filter=2)
+    # Loading all the files can take a while.
+    # Only read the ones that aren't already in the on disk store.
+    if settings.ENABLE_CACHE:
+        store_dir = "%s/cache/snow_cube_%s_%i-%i_%i-%i"%(settings.DATA_DIR, 
+                                              tile, ymin, ymax, xmin, xmax)
+        store = snow_cube.SnowCubeStore(store_dir, tile, datasets, 
+                                        (ymin, ymax, xmin, xmax), 
+                                        catchment_mask)
+        fingerprints = [snow_cube.file_fingerprint(f) for f in file_names]
+        slices = np.where(store.find_stale(start_date, end_date, 
+                                           fingerprints))[0]
+        log.info('  Using cache for %i of %i days/datasets'%(
+                 len(file_names) - len(slices), len(file_names)))
+    else:
+        slices = np.arange(len(file_names))
+
+    slice_file_names = [file_names[i] for i in slices]
+    log.info("  Reading %i files using %i worker(s)"%(
+             len([f for f in slice_file_names if f is not None]), 
+             settings.HDF_READ_WORKERS))
+    # Files are read straight into these, and the catchment mask is
+    # applied once at the end.
+    shape = (len(slices), ymax - ymin, xmax - xmin)
+    data    = np.zeros(shape, dtype=np.uint8)
+    qa_data = np.zeros(shape, dtype=np.uint8)
+    all_results = load_hdf_files(slice_file_names, xmin, xmax, ymin, ymax,
+                                 data, qa_data, settings.HDF_READ_WORKERS)
+
+    read_flags = []
+    for i, (file_name, result) in enumerate(zip(slice_file_names, 
+                                                all_results)):
+        if isinstance(result, Exception):
+            log.warn('COULD NOT LOAD FILE: %s'%(file_name.split('/')[-1]))
+            log.warn('Exception: %s'%(result))
+
+        if result is True:
+            read_flags.append(snow_cube.READ_FROM_FILE)
+        else:
+            # Files that are there but couldn't be read are left as not 
+            # present, so they're tried again next time.
+            if file_name is None:
+                read_flags.append(snow_cube.FILLED_WITH_DUMMY)
+            else:
+                read_flags.append(snow_cube.NOT_PRESENT)
+            # Only set the values where the mask is False.
+            data[i]    = 0
+            qa_data[i] = 0
+            data[i][~catchment_mask]    = 200 # Missing value code.
+            qa_data[i][~catchment_mask] = 1   # 'Other' quality
+
+    if settings.ENABLE_CACHE:
+        saved = True
+        if len(slices) != 0:
+            try:
+                log.info('  Saving data to cache')
+                store.update(start_date, end_date, slices, data, qa_data,
+                             read_flags, [fingerprints[i] for i in slices])
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                log.error('  Could not save data to cache')
+                log.error('  Exception: %s'%(e))
+                saved = False
+
+        # If every slice was just read, there's nothing to use from it.
+        if saved or len(slices) != len(file_names):
+            log.info('  Loading data from cache')
+            return_data = store.load(start_date, end_date, compact)
+            if not saved:
+                # The store's views are copy on write, so this doesn't 
+                # touch the cache.
+                np.asarray(return_data['data'])[slices] = data
+                np.asarray(return_data['qa'])[slices] = qa_data
+            return return_data
+
+    if compact:
+        return {'dates': np.array(dates), 'data': data, 'qa': qa_data,
+                'mask': catchment_mask}
+
+    # N.B. data and qa_data each need their own mask.
+    return_data = {'dates': np.array(dates)}
+    for key, array in (('data', data), ('qa', qa_data)):
+        mask = np.empty(shape, dtype=bool)
+        mask[:] = catchment_mask
+        return_data[key] = ma.array(array, mask=mask)
+    return return_data
+
+def load_snow_hdf_mosaic(start_date, end_date, tiles, 
+        datasets=('AQUA', 'TERRA'), 
+        mask_shape_file="Hydrologic_Units/HUC_Polygons.shp", feature_id=2,
+        compact=False, catchment=None):
+    '''Like load_snow_hdf_data, but for a catchment that can span many tiles
+
+The catchment mask and its window are worked out on the MODIS grid (see
+modis_grid.catchment_grid_mask), and split into the part on each tile. 
+For each date, only the part of each tile's HDF file that is in the 
+window is read, straight into its place in the catchment's cube, so full
+tiles or mosaics are never made. Parts of the window on tiles not in 
+tiles are treated as missing data. The on disk cache isn't used.
+catchment: the (catchment_mask, window) on the grid to use, as returned
+by modis_grid.catchment_grid_mask.
+
+Returns the same as load_snow_hdf_data.
+'''
+    log.info("  Loading datasets %s for tiles %s"%(str(datasets), 
+                                                   ', '.join(tiles)))
+    log.info("  Daterange: %s to %s"%(str(start_date), str(end_date)))
 
-    # Work out mins and maxes based on mask.
-    mask_bounds = np.where(catchment_mask == False)
-    ymin = int(min(mask_bounds[0]))
-    ymax = int(max(mask_bounds[0]) + 1)
-    xmin = int(min(mask_bounds[1]))
-    xmax = int(max(mask_bounds[1]) + 1)
+    if catchment is None:
+        catchment = modis_grid.catchment_grid_mask(
+            "%s/%s"%(settings.DATA_DIR, mask_shape_file), feature_id)
+    catchment_mask, window = catchment
+    file_index = modis_index.ModisFileIndex(settings.DATA_DIR)
+
+    dates = list(daterange(start_date, end_date))
+    shape = (len(dates) * len(datasets),) + catchment_mask.shape
+    data    = np.zeros(shape, dtype=np.uint8)
+    qa_data = np.zeros(shape, dtype=np.uint8)
+    for tile, (ymin, ymax, xmin, xmax), part_window in \
+            modis_grid.tiles_for_window(window):
+        part = (slice(None), slice(part_window[0], part_window[1]), 
+                slice(part_window[2], part_window[3]))
+        part_mask = catchment_mask[part[1:]]
+        if part_mask.all():
+            # In the window, but the catchment isn't on this tile.
+            continue
+        if tile in tiles:
+            file_names = find_snow_files(file_index, start_date, end_date, 
+                                         tile, datasets)[1]
+        else:
+            log.warn("  Catchment is on tile %s which isn't in %s, it will "
+                     "be missing"%(tile, str(tiles)))
+            file_names = [None] * shape[0]
+
+        log.info("  Reading %i files for tile %s using %i worker(s)"%(
+                 len([f for f in file_names if f is not None]), tile,
+                 settings.HDF_READ_WORKERS))
+        # data[part] is a view of the cube, so files are read into it.
+        all_results = load_hdf_files(file_names, xmin, xmax, ymin, ymax,
+                                     data[part], qa_data[part], 
+                                     settings.HDF_READ_WORKERS)
+        for i, (file_name, result) in enumerate(zip(file_names, 
+                                                    all_results)):
+            if isinstance(result, Exception):
+                log.warn('COULD NOT LOAD FILE: %s'%(file_name.split('/')[-1]))
+                log.warn('Exception: %s'%(result))
+
+            if result is not True:
+                # Only set the values where the mask is False.
+                data[part][i]    = 0
+                qa_data[part][i] = 0
+                data[part][i][~part_mask]    = 200 # Missing value code.
+                qa_data[part][i][~part_mask] = 1   # 'Other' quality
+    file_index.save()
+
+    if compact:
+        return {'dates': np.array(dates), 'data': data, 'qa': qa_data,
+                'mask': catchment_mask}
+
+    # N.B. data and qa_data each need their own mask.
+    return_data = {'dates': np.array(dates)}
+    for key, array in (('data', data), ('qa', qa_data)):
+        mask = np.empty(shape, dtype=bool)
+        mask[:] = catchment_mask
+        return_data[key] = ma.array(array, mask=mask)
+    return return_data
 
-    # Reduce size of mask so it will fit data I read from HDFs.
-    catchment_mask = catchment_mask[ymin:ymax, xmin:xmax]
+def find_snow_files(file_index, start_date, end_date, tile, datasets):
+    '''Works out which file (if any) to use for each date and dataset
 
+Returns a tuple (dates, file_names), file_names is in the order
+[AQUA, TERRA, AQUA, TERRA...] with None for missing files.'''
     dates = []
+    file_names = []
     for date in daterange(start_date, end_date):
         dates.append(date)
         year = date.year
         doy = date.timetuple().tm_yday
 
         if doy % 10 == 0:
-            log.info("    Processing year, doy: %04i, %03i"%(year, doy))
+            log.info("    Finding files for year, doy: %04i, %03i"%(year, doy))
 
         for dataset in datasets:
-            # e.g. '/path/to/data/AQUA_h09v05_2005/
-            data_dir  = '%s/%s_%s_%s/'%(settings.DATA_DIR, dataset, tile, year)
-
-            file_names = glob.glob(data_dir + "*.A%04i%03i.*"%(year, doy))
-            read_data_successful = False
-            if len(file_names) == 0:
-		log.info("MISSING %s year, doy: %04i, %03i"%(dataset, 
-		                                             year, doy))
-            else:
-                try:
-                    file_name = file_names[0]
-                    frac_snow_data, qa_data = load_hdf_file(file_name, 
-			                 catchment_mask, xmin, xmax, ymin, ymax)
-                    all_frac_snow_data.append(frac_snow_data)
-                    all_qa_data.append(qa_data)
-                    read_data_successful = True
-                except KeyboardInterrupt:
-                    # So as ctrl-c works.
-                    raise
-                except Exception, e:
-		    file_name = file_name.split('/')[-1]
-                    log.warn('COULD NOT LOAD FILE: %s'%(file_name))
-                    log.warn('Exception: %s'%(e))
-
-            if not read_data_successful:
-                dummy_data = \
-		    ma.array(np.zeros((ymax - ymin, xmax - xmin)).astype(int), 
-                                      mask=catchment_mask)
-                dummy_qa_data = \
-		    ma.array(np.zeros((ymax - ymin, xmax - xmin)).astype(int), 
-                                      mask=catchment_mask)
-		# Note to self: settings dummy_data[:, :] = 200 will 
-		# get rid of mask entirely and leave you scratching your
-		# head as to why this mask doesn't work.
-		# Only set the values where the mask is False.
-                dummy_data[~catchment_mask]    = 200 # Missing value code.
-                dummy_qa_data[~catchment_mask] = 1   # 'Other' quality
-                all_frac_snow_data.append(dummy_data)
-                all_qa_data.append(dummy_qa_data)
-
-
-    dates   = np.array(dates)
-    data    = ma.array(all_frac_snow_data)
-    qa_data = ma.array(all_qa_data)
-    return_data = {'dates': dates, 'data': data, 'qa': qa_data}
+            # e.g. '/path/to/data/AQUA_h09v05_2005/<file_name>
+            file_name = file_index.lookup(dataset, tile, date)
+            if file_name is None:
+                log.info("MISSING %s year, doy: %04i, %03i"%(dataset, 
+                                                             year, doy))
+            file_names.append(file_name)
+    if all(file_name is None for file_name in file_names):
+        log.warn("  NO FILES for tile %s from %s to %s, it will be missing "
+                 "data"%(tile, start_date, end_date))
+    return dates, file_names
+
+def tile_catchment_mask(file_index, year, tile='h09v05', 
+        datasets=('AQUA', 'TERRA'), 
+        mask_shape_file="Hydrologic_Units/HUC_Polygons.shp", feature_id=2):
+    '''Works out the catchment mask and its window in tile
+
+Uses any of tile's HDF files for year as the reference, see 
+load_catchment_mask.'''
+    # Generate a mask based on the catchment area.
+    # Pick any hdf file to use as its input.
+    file_name = file_index.any_file(datasets[0], tile, year)
+
+    # Mask is reduced in size so it will fit data I read from HDFs.
+    return load_catchment_mask(file_name, tile, 
+        "%s/%s"%(settings.DATA_DIR, mask_shape_file), feature_id)
+
+def load_catchment_mask(reference_file_name, tile, shape_file, feature_id):
+    '''Works out the mask for a catchment and its window in a tile
+
+reference_file_name: any HDF file for the tile.
+shape_file, feature_id: the catchment's polygon.
+
+Returns a tuple (catchment_mask, (ymin, ymax, xmin, xmax)), the mask is 
+cropped to the window. If settings.ENABLE_CACHE is True, results are cached 
+keyed on shape_file (path and mtime), feature_id, tile and the geotransform
+and projection of the reference raster, so only the raster's header is read.
+'''
+    hdf_str = FRAC_SNOW_COVER_TPL%(reference_file_name)
 
     if settings.ENABLE_CACHE:
-        try:
-            log.info('  Saving data to cache')
-            if not os.path.exists(cache_dir):
-                os.makedirs(cache_dir)
-            pickle.dump(return_data, open(cached_data_file, 'wb'))
-        except:
-            log.error('  Could not save data to cache')
-    return return_data
+        cached_mask_file = catchment_cache_file('catchment_mask', hdf_str, 
+                                                tile, shape_file, feature_id)
+        if os.path.exists(cached_mask_file):
+            log.info('  Loading catchment mask from cache')
+            try:
+                cached_mask = np.load(cached_mask_file)
+                return (cached_mask['mask'], 
+                        tuple(int(v) for v in cached_mask['window']))
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                log.warn("  COULDN'T LOAD CATCHMENT MASK FROM CACHE")
+                log.warn('  Exception: %s'%(e))
 
-def load_hdf_file(file_name, catchment_mask, xmin, xmax, ymin, ymax):
-    '''Loads in the snow and QC data from an individual HDF file
+    # Taken from course notes.
+    catchment_mask, window = raster_mask2_window(hdf_str, 
+        target_vector_file=shape_file, attribute_filter=feature_id)
 
-Returns a tuple: (snow_data, qc_data)'''
-    array_data = []
-    for tpl in (FRAC_SNOW_COVER_TPL, QA_TPL):
-        hdf_str = tpl%(file_name)
+    if settings.ENABLE_CACHE:
+        try:
+            if not os.path.exists(os.path.dirname(cached_mask_file)):
+                os.makedirs(os.path.dirname(cached_mask_file))
+            np.savez(cached_mask_file, mask=catchment_mask, window=window)
+        except KeyboardInterrupt:
+            raise
+        except Exception, e:
+            log.error('  Could not save catchment mask to cache')
+            log.error('  Exception: %s'%(e))
+    return catchment_mask, window
+
+def load_catchment_labels(reference_file_name, tile, shape_file, feature_ids):
+    '''Works out the label raster for many catchments and its window in a tile
+
+Like load_catchment_mask, but returns a tuple (labels, (ymin, ymax, xmin, 
+xmax)), where labels is i + 1 for pixels in catchment feature_ids[i] and 0 
+elsewhere (see raster_label_window), cropped to the window around all of 
+them. Cached in the same way if settings.ENABLE_CACHE is True.
+'''
+    hdf_str = FRAC_SNOW_COVER_TPL%(reference_file_name)
 
-        g = gdal.Open(hdf_str)
+    if settings.ENABLE_CACHE:
+        cached_labels_file = catchment_cache_file('catchment_labels', hdf_str, 
+                                                  tile, shape_file, 
+                                                  list(feature_ids))
+        if os.path.exists(cached_labels_file):
+            log.info('  Loading catchment labels from cache')
+            try:
+                cached_labels = np.load(cached_labels_file)
+                return (cached_labels['labels'], 
+                        tuple(int(v) for v in cached_labels['window']))
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                log.warn("  COULDN'T LOAD CATCHMENT LABELS FROM CACHE")
+                log.warn('  Exception: %s'%(e))
+
+    labels, window = raster_label_window(hdf_str, 
+        target_vector_file=shape_file, attribute_filters=feature_ids)
 
-        # Only read the data I want based on mins/maxes.
-        data = g.ReadAsArray(yoff=ymin, ysize=ymax-ymin, 
-                                       xoff=xmin, xsize=xmax-xmin)
-        # alternative, reads whole dataset and slower.
-        # frac_snow_data = g.ReadAsArray() 
-        masked_data = ma.array(data, mask=catchment_mask)
-        array_data.append(masked_data)
+    if settings.ENABLE_CACHE:
+        try:
+            if not os.path.exists(os.path.dirname(cached_labels_file)):
+                os.makedirs(os.path.dirname(cached_labels_file))
+            np.savez(cached_labels_file, labels=labels, window=window)
+        except KeyboardInterrupt:
+            raise
+        except Exception, e:
+            log.error('  Could not save catchment labels to cache')
+            log.error('  Exception: %s'%(e))
+    return labels, window
+
+def catchment_cache_file(name, hdf_str, tile, shape_file, feature_id):
+    '''Returns the name of the cache file for a catchment mask/labels
+
+Keyed on shape_file (path and mtime), feature_id, tile and the 
+geotransform and projection of the reference raster hdf_str.'''
+    g = gdal.Open(hdf_str)
+    key = {'shape_file': os.path.abspath(shape_file),
+           'shape_file_mtime': os.path.getmtime(shape_file),
+           'feature_id': feature_id,
+           'tile': tile,
+           'geotransform': g.GetGeoTransform(),
+           'projection': g.GetProjectionRef()}
+    key_hash = hashlib.md5(json.dumps(key, sort_keys=True)).hexdigest()
+    return "%s/cache/%s_%s.npz"%(settings.DATA_DIR, name, key_hash)
+
+def load_hdf_files(file_names, xmin, xmax, ymin, ymax, snow_out, qa_out,
+                   num_workers=1):
+    '''Reads the snow and QC data from many HDF files into snow_out and qa_out
+
+file_names can contain None for missing files. Data from file i is read into
+snow_out[i] and qa_out[i]. If num_workers > 1, files are read in parallel 
+using a pool of that many processes.
+
+Returns a list in the same order as file_names, each element is either 
+True if the file was read, None for missing files, or the exception raised
+when reading the file.'''
+    if num_workers <= 1:
+        results = []
+        for i, file_name in enumerate(file_names):
+            result = _read_hdf_file_or_exception((file_name, xmin, xmax, 
+                                     ymin, ymax, snow_out[i], qa_out[i]))
+            results.append(True if isinstance(result, tuple) else result)
+        return results
+
+    args = [(file_name, xmin, xmax, ymin, ymax) for file_name in file_names]
+    results = []
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # Worker processes can't write to snow_out/qa_out, so copy in
+        # their data as it arrives.
+        # N.B. next(timeout) is used instead of next() so as ctrl-c works,
+        # which needs chunksize=1. Timeout is just a large number.
+        result_iter = pool.imap(_read_hdf_file_or_exception, args)
+        for i in range(len(args)):
+            result = result_iter.next(999999)
+            if isinstance(result, tuple):
+                snow_out[i], qa_out[i] = result
+                result = True
+            results.append(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def _read_hdf_file_or_exception(args):
+    '''Calls read_hdf_file(*args), returns any exceptions instead of raising
+
+Module level so that it can be used by a multiprocessing.Pool.'''
+    if args[0] is None:
+        return None
+    try:
+        return read_hdf_file(*args)
+    except KeyboardInterrupt:
+        # So as ctrl-c works.
+        raise
+    except Exception, e:
+        return e
+
+def read_hdf_file(file_name, xmin, xmax, ymin, ymax, snow_out=None, 
+                  qa_out=None):
+    '''Reads in the snow and QC data from an individual HDF file
+
+Only the window given by the mins/maxes is read. If pyhdf is installed,
+the file is opened once and both datasets are read from it, otherwise GDAL
+opens each dataset separately. If snow_out and qa_out are given, the data 
+is written into them.
 
+Returns a tuple: (snow_data, qc_data)'''
+    if SD is not None:
+        hdf = SD(file_name, SDC.READ)
+        try:
+            array_data = [hdf.select(name)[ymin:ymax, xmin:xmax]
+                          for name in (FRAC_SNOW_COVER_NAME, QA_NAME)]
+        finally:
+            hdf.end()
+    else:
+        array_data = []
+        for tpl in (FRAC_SNOW_COVER_TPL, QA_TPL):
+            hdf_str = tpl%(file_name)
+
+            g = gdal.Open(hdf_str)
+
+            # Only read the data I want based on mins/maxes.
+            data = g.ReadAsArray(yoff=ymin, ysize=ymax-ymin, 
+                                           xoff=xmin, xsize=xmax-xmin)
+            # alternative, reads whole dataset and slower.
+            # frac_snow_data = g.ReadAsArray() 
+            array_data.append(data)
+
+    for i, out in enumerate((snow_out, qa_out)):
+        if out is not None:
+            out[:] = array_data[i]
+            array_data[i] = out
     return array_data[0], array_data[1]
 
-def interp_data_over_time(masked_data, qa_data, orig_mask):
+def interp_data_over_time(masked_data, qa_data, orig_mask, engine='fast',
+                          block_size=2000):
     '''Takes in masked_data and applies interpolation over the first axis
 
 First axis is time. 
+
+engine: 'fast' interpolates blocks of block_size pixels at once, and 
+only pixels that are in the catchment area (not masked at all times by 
+orig_mask). 'loop' uses interp1d for each pixel in turn.
+Both give NaN outside the first/last unmasked value for each pixel, and
+leave pixels with 2 or fewer unmasked values as 0.
     '''
     # Make an array to stick all the interpolated results into.
     # Note it gets *just* the catchment area mask, not the QC mask.
@@ -183,6 +504,20 @@ First axis is time.
     qa_mask = qa_data == 1
     masked_data.mask |= qa_mask
 
+    if engine == 'fast':
+        catchment_mask = ma.getmaskarray(interp_masked_data).all(axis=0)
+        all_valid = ~ma.getmaskarray(masked_data)
+        pixels = np.where(~catchment_mask & (all_valid.sum(axis=0) > 2))
+        for start in range(0, len(pixels[0]), block_size):
+            block = (slice(None), pixels[0][start:start + block_size],
+                     pixels[1][start:start + block_size])
+            interp_masked_data[block] = interp_pixels_over_time(
+                masked_data.data[block], all_valid[block])
+            log.info("    Done %2.1f%%"%(100.0 * min(start + block_size, 
+                                                     len(pixels[0])) / 
+                                         len(pixels[0])))
+        return interp_masked_data
+
     x = np.arange(len(masked_data))
 
     # For each pixel in array work out its full interpolated time series.
@@ -209,6 +544,219 @@ First axis is time.
             log.info("    Done %2.1f%%"%(100.0 * i / masked_data.shape[1]))
     return interp_masked_data
 
+def interp_pixels_over_time(values, valid):
+    '''Linearly interpolates each column of values over the first axis
+
+values and valid are (time, num_pixels) arrays, only elements of values 
+where valid is True are used. Gives the same results as using interp1d 
+with bounds_error=False on each column: NaN before the first and after the 
+last valid element.
+    '''
+    num_times = values.shape[0]
+    t = np.arange(num_times)[:, np.newaxis]
+
+    # For each element, find the index of the previous and next valid ones.
+    prev_t = np.maximum.accumulate(np.where(valid, t, -1), axis=0)
+    next_t = np.minimum.accumulate(np.where(valid, t, num_times)[::-1], 
+                                   axis=0)[::-1]
+    out_of_bounds = (prev_t < 0) | (next_t >= num_times)
+    prev_t = prev_t.clip(0, num_times - 1)
+    next_t = next_t.clip(0, num_times - 1)
+
+    columns = np.arange(values.shape[1])[np.newaxis, :]
+    prev_values = values[prev_t, columns].astype(float)
+    next_values = values[next_t, columns].astype(float)
+
+    # Valid elements have prev_t == next_t == t, and so keep their value.
+    weights = (t - prev_t) / np.maximum(next_t - prev_t, 1).astype(float)
+    interp_values = prev_values + (next_values - prev_values) * weights
+    interp_values[out_of_bounds] = np.nan
+
+    return interp_values
+
+class ChunkedTimeInterp:
+    """Interpolates snow data over time one chunk of days at a time
+
+Gives the same values as interp_data_over_time (with the 'fast' engine)
+does for the whole record, but only needs one chunk in memory at once.
+For each pixel the last valid day and value seen so far are carried over
+to the next chunk, so each day can be interpolated from the previous 
+valid value however many chunks back it was. Days after a pixel's last 
+valid value in a chunk have to wait for its next valid value, and are
+filled in when it turns up in a later chunk. In effect chunks overlap 
+by as much as each pixel's gap, but only one (day, value) per pixel is
+kept for it.
+
+The total over the catchment of each day is kept (see totals). Pixels 
+with 2 or fewer valid values end up as 0, so until a pixel has its 3rd
+valid value it is left out of the totals, and when it turns up the 
+pixel's earlier days are added to them. If cube is given, e.g. a memmap of shape (num_days, h, w), the interpolated 
+values are also written to it.
+"""
+    def __init__(self, num_days, catchment_mask, cube=None):
+        self.num_days = num_days
+        self.rows, self.cols = np.where(~catchment_mask)
+        self.cube = cube
+        num_pixels = len(self.rows)
+        # Last valid day so far (-1 if none) and its value for each pixel.
+        self.last_t = -np.ones(num_pixels, dtype=int)
+        self.last_v = np.zeros(num_pixels)
+        # Number of valid values, and the days and values of the first 2.
+        self.count = np.zeros(num_pixels, dtype=int)
+        self.first_t = -np.ones((2, num_pixels), dtype=int)
+        self.first_v = np.zeros((2, num_pixels))
+        # Sum of the values and number of NaNs for each day, of pixels with 
+        # 3 or more valid values so far.
+        self.sums = np.zeros(num_days)
+        self.num_nans = np.zeros(num_days, dtype=int)
+        self.num_done = 0
+        self.finished = False
+
+    def add(self, masked_data, qa_data):
+        '''Adds the next chunk of days
+
+masked_data, qa_data: as passed to interp_data_over_time, for the chunk.'''
+        num_times = masked_data.shape[0]
+        t0 = self.num_done
+        if t0 + num_times > self.num_days:
+            raise Exception('Too many days added, expected %i'%self.num_days)
+
+        qa_mask = qa_data == 1
+        masked_data.mask |= qa_mask
+        pixels = (slice(None), self.rows, self.cols)
+        values = masked_data.data[pixels]
+        valid = ~ma.getmaskarray(masked_data)[pixels]
+
+        t = t0 + np.arange(num_times)[:, np.newaxis]
+        columns = np.arange(values.shape[1])[np.newaxis, :]
+        # As interp_pixels_over_time, but the previous valid day can be in 
+        # an earlier chunk.
+        prev_t = np.maximum.accumulate(np.where(valid, t, -1), axis=0)
+        prev_t = np.where(prev_t < 0, self.last_t, prev_t)
+        next_t = np.minimum.accumulate(np.where(valid, t, self.num_days)[::-1],
+                                       axis=0)[::-1]
+        no_prev = prev_t < 0
+        no_next = next_t >= self.num_days
+
+        prev_values = np.where(prev_t >= t0, 
+                               values[(prev_t - t0).clip(0, num_times - 1), 
+                                      columns].astype(float),
+                               self.last_v)
+        next_values = values[(next_t - t0).clip(0, num_times - 1), 
+                             columns].astype(float)
+        weights = (t - prev_t) / np.maximum(next_t - prev_t, 1).astype(float)
+        interp_values = prev_values + (next_values - prev_values) * weights
+        # Days with no next value yet are filled in by a later chunk.
+        interp_values[no_prev | no_next] = np.nan
+        if self.cube is not None:
+            self.cube[t0:t0 + num_times][pixels] = interp_values
+
+        counts = valid.cumsum(axis=0)
+        enough = self.count + counts[-1] > 2
+        self.sums[t0:t0 + num_times] += np.nansum(interp_values[:, enough], 
+                                                  axis=1)
+        self.num_nans[t0:t0 + num_times] += no_prev[:, enough].sum(axis=1)
+
+        # Add the earlier days of pixels that now have enough values: NaN
+        # before the first valid value, and up to the last one so far 
+        # interpolated between the first 2.
+        new = np.where(enough & (self.count <= 2))[0]
+        nan_stops = np.where(self.count[new] > 0, self.first_t[0, new], t0)
+        self.num_nans += np.bincount(nan_stops, minlength=self.num_days + 1
+                                     )[::-1].cumsum()[::-1][1:]
+        new = new[self.count[new] > 0]
+        if len(new):
+            last = self.count[new] - 1
+            self._add_days(new, self.first_t[0, new], self.first_v[0, new],
+                           self.first_t[last, new], self.first_v[last, new],
+                           self.first_t[0, new], self.last_t[new] + 1)
+
+        # Fill in days in earlier chunks that were waiting for this one.
+        first_t = next_t[0]
+        waiting = np.where(enough & (self.last_t >= 0) & 
+                           (self.last_t < t0 - 1) & 
+                           (first_t < self.num_days))[0]
+        if len(waiting):
+            self._add_days(waiting, self.last_t[waiting], 
+                           self.last_v[waiting], first_t[waiting],
+                           values[first_t[waiting] - t0, 
+                                  waiting].astype(float), 
+                           self.last_t[waiting] + 1, t0)
+
+        # Carry the last valid value over to the next chunk.
+        last_t = prev_t[-1]
+        self.last_v = np.where(last_t >= t0, 
+                               values[(last_t - t0).clip(0, num_times - 1),
+                                      columns[0]].astype(float),
+                               self.last_v)
+        self.last_t = last_t
+
+        # Keep each pixel's first 2 valid values, for when it has enough.
+        for i in range(2):
+            # Its (i + 1)th valid value is the nth in this chunk.
+            n = i + 1 - self.count
+            new = np.where((n >= 1) & (counts[-1] >= n))[0]
+            index = np.argmax(counts[:, new] >= n[new], axis=0)
+            self.first_t[i, new] = t0 + index
+            self.first_v[i, new] = values[index, new]
+        self.count += counts[-1]
+        self.num_done += num_times
+
+    def _add_days(self, pixels, prev_t, prev_v, next_t, next_v, start, stop):
+        '''Interpolates days start to stop - 1 of each of pixels, and adds 
+them to the totals'''
+        lengths = stop - start
+        offsets = np.arange(lengths.sum()) - np.repeat(lengths.cumsum() - 
+                                                       lengths, lengths)
+        pixels, prev_t, prev_v, next_t, next_v, start = [np.repeat(a, lengths) 
+                for a in (pixels, prev_t, prev_v, next_t, next_v, start)]
+        t = start + offsets
+        weights = (t - prev_t) / np.maximum(next_t - prev_t, 1).astype(float)
+        interp_values = prev_v + (next_v - prev_v) * weights
+
+        self.sums += np.bincount(t, weights=interp_values, 
+                                 minlength=self.num_days)
+        if self.cube is not None:
+            self.cube[t, self.rows[pixels], self.cols[pixels]] = interp_values
+
+    def num_final_days(self):
+        '''Returns how many days from the start have totals that won't change
+
+These are the days up to the last valid value so far of every pixel with
+3 or more valid values. The totals of these days can still change if a 
+pixel with 2 or fewer gets its 3rd, see add.'''
+        enough = self.count > 2
+        if self.finished or not enough.any():
+            return self.num_done
+        return min(self.last_t[enough].min() + 1, self.num_done)
+
+    def finish(self):
+        '''Deals with the ends of the record once all days have been added
+
+Days after each pixel's last valid value are NaN, and pixels with 2 or 
+fewer valid values are set to 0, as in interp_data_over_time.'''
+        if self.num_done != self.num_days:
+            raise Exception('Only %i of %i days have been added'%(
+                            self.num_done, self.num_days))
+        # These were left as NaN in the cube, but not counted yet.
+        ended = self.last_t[self.count > 2] + 1
+        self.num_nans += np.bincount(ended, minlength=self.num_days + 1
+                                     )[:self.num_days].cumsum()
+
+        # These were left out of the totals, but not the cube.
+        few = np.where(self.count <= 2)[0]
+        if self.cube is not None and len(few):
+            self.cube[:, self.rows[few], self.cols[few]] = 0
+        self.finished = True
+
+    def totals(self, num_days=None):
+        '''Returns the total snow cover of the first num_days (default all)
+days, NaN where any pixel is'''
+        if num_days is None:
+            num_days = self.num_days
+        return np.where(self.num_nans[:num_days] > 0, np.nan, 
+                        self.sums[:num_days])
+
 def apply_MODIS_snow_quality_control(data, qa_data):
     '''fractional_snow_data key taken from page 11 of this document:
 http://modis-snow-ice.gsfc.nasa.gov/uploads/sug_c5.pdf
@@ -259,6 +807,78 @@ Snow_Cover_Pixel_QA key:
 
     return ma.array(data, mask=(data > 100) | qa_mask)
 
+def combine_snow_data(snow_data, qa_data, block_days=None):
+    '''Combines AQUA and TERRA data into a daily mean
+
+snow_data, qa_data: masked arrays as returned by load_snow_hdf_data.
+Returns (data, masked_data, qa_data): the daily means of snow_data, of
+snow_data with the MODIS QC rules applied and of qa_data.
+
+Gives the same results as averaging over each pair of days with masked
+arrays and apply_MODIS_snow_quality_control (which also sets saturated 
+values in snow_data to 100), but does the QC, its stats and the means 
+block_days (default settings.COMBINE_BLOCK_DAYS) day pairs at a time, 
+with plain arrays, straight into the outputs. So no full size masked
+temporaries are made.
+'''
+    if block_days is None:
+        block_days = settings.COMBINE_BLOCK_DAYS
+    # snow_data is filled with data from AQUA and TERRA, as in e.g.:
+    # AQUA, TERRA, AQUA, TERRA... with e.g. 
+    # shape == (2 * (31 + 365*2 + 31), h, w)
+    # i.e. 2 years plus 2 months either side
+    # Each pair is combined in a way that preserves the mask: if either 
+    # of the datasets has a value this will be used.
+    num_days = snow_data.shape[0] / 2
+    shape = (num_days,) + snow_data.shape[1:]
+    means = dict((key, np.empty(shape)) for key in ('data', 'masked', 'qa'))
+    means_masks = dict((key, np.empty(shape, dtype=bool)) 
+                       for key in ('data', 'masked', 'qa'))
+    outside = ma.getmaskarray(snow_data)
+    qa_outside = ma.getmaskarray(qa_data)
+    # Saturated, hi and low quality counts.
+    counts = np.zeros(3, dtype=int)
+
+    for start in range(0, num_days, block_days):
+        days = slice(start, min(start + block_days, num_days))
+        pairs = slice(2 * days.start, 2 * days.stop)
+        snow = snow_data.data[pairs]
+        qa = qa_data.data[pairs]
+        inside = ~outside[pairs]
+        qa_inside = ~qa_outside[pairs]
+
+        # Means are worked out as the masked array ones are: sum of the 
+        # values / number of them, or masked (with 0) if there are none.
+        for key, values, valid in (('data', snow, inside), 
+                                   ('qa', qa, qa_inside)):
+            valid = valid.reshape((-1, 2) + shape[1:])
+            values = values.reshape(valid.shape)
+            num_valid = valid.sum(axis=1)
+            means[key][days] = np.where(valid, values, 0).sum(axis=1) * 1. / \
+                               np.maximum(num_valid, 1)
+            means_masks[key][days] = num_valid == 0
+
+        # MODIS QC rules, see apply_MODIS_snow_quality_control.
+        saturated = (snow == 254) & inside
+        counts[0] += saturated.sum()
+        snow[saturated] = 100
+        low_qual = qa == 1
+        counts[1] += ((qa == 0) & qa_inside).sum()
+        counts[2] += (low_qual & qa_inside).sum()
+        valid = (inside & (snow <= 100) & ~low_qual).reshape((-1, 2) + 
+                                                             shape[1:])
+        num_valid = valid.sum(axis=1)
+        means['masked'][days] = np.where(valid, snow.reshape(valid.shape), 
+                                         0).sum(axis=1) * 1. / \
+                                np.maximum(num_valid, 1)
+        means_masks['masked'][days] = num_valid == 0
+
+    log.info("  Saturated value count: %d"%counts[0])
+    hi, lo = counts[1], counts[2]
+    log.info("  Hi qual: %d, Low qual: %d, hi/lo: %4.1f"%(hi, lo, 1. * hi / lo))
+    return [ma.array(means[key], mask=means_masks[key]) 
+            for key in ('data', 'masked', 'qa')]
+
 def prepare_all_snow_data(start_date, end_date):
     '''Loads and prepares all snow data between date range.
 
@@ -270,9 +890,24 @@ interpolated over to fill in all values for e.g. cloud cover.
 Also produces a summed percent snow cover.
 
 Returns a dictionary with all relevant data in it.
+
+If settings.SNOW_CHUNK_DAYS is set, prepare_all_snow_data_chunked is
+used instead.
 '''
+    if settings.SNOW_CHUNK_DAYS:
+        return prepare_all_snow_data_chunked(start_date, end_date)
+
     log.info('Preparing all snow data')
-    all_data = load_snow_hdf_data(start_date, end_date)
+    if settings.TILES is None:
+        all_data = load_snow_hdf_data(start_date, end_date, settings.TILE)
+    else:
+        all_data = load_snow_hdf_mosaic(start_date, end_date, 
+                                        modis_grid.settings_tiles())
+    return prepare_snow_data(all_data)
+
+def prepare_snow_data(all_data):
+    '''Does the work of prepare_all_snow_data on all_data, as returned by
+load_snow_hdf_data'''
     snow_data = all_data['data']
     qa_data = all_data['qa']
     dates = all_data['dates']
@@ -287,33 +922,15 @@ Returns a dictionary with all relevant data in it.
             data = snow_data[1::2, :, :] # TERRA
             masked_data = apply_MODIS_snow_quality_control(data, qa_data)
         elif dataset == 'COMBINED':
-	    # snow_data is filled with data from AQUA and TERRA, as in e.g.:
-	    # AQUA, TERRA, AQUA, TERRA... with e.g. 
-	    # shape == (2 * (31 + 365*2 + 31), h, w)
-	    # i.e. 2 years plus 2 months either side
-	    # What I want is to first double up the data so as its shape
-	    # becomes ((31 + 365*2 + 31), 2, w, h), then take a mean over the 2nd axis.
-	    # This combines the 2 datasets in a way that preserves the mask,
-	    # and if either of the datasets has a value this will be used.
-            data = snow_data.reshape(snow_data.shape[0] / 2, 2, 
-		     snow_data.shape[1], snow_data.shape[2]).mean(axis=1)
-
-	    # Apply the MODIS QC rules.
-            masked_data = apply_MODIS_snow_quality_control(snow_data, qa_data)
-
-	    # Same trick as above.
-            masked_data = masked_data.reshape(masked_data.shape[0] / 2, 2, 
-		      masked_data.shape[1], masked_data.shape[2]).mean(axis=1)
-
-	    # Same trick as above.
-            qa_data = qa_data.reshape(qa_data.shape[0] / 2, 2,
-		               qa_data.shape[1], qa_data.shape[2]).mean(axis=1)
+            data, masked_data, qa_data = combine_snow_data(snow_data, qa_data)
 
         # N.B masked_data has a mask that will has filtered out
         # QC values. I don't want this, so use the original mask.
         log.info('  Interpolating %s data', dataset)
         interp_masked_data = interp_data_over_time(masked_data, 
-		                                   qa_data, data.mask)
+		                                   qa_data, data.mask,
+                                                   settings.INTERP_ENGINE,
+                                                   settings.INTERP_BLOCK_SIZE)
 
         all_data[dataset] = interp_masked_data
 
@@ -336,19 +953,254 @@ Returns a dictionary with all relevant data in it.
 
     return all_data
 
-def prepare_temperature_data(start_date, end_date):
-    '''Loads in temperature data between dates provided.'''
+def send_new_totals(callback, dates, sent, totals):
+    '''Calls callback with the dates and totals from the first one that
+differs from sent (the totals it was last called with), and returns totals
+'''
+    num_same = min(len(sent), len(totals))
+    same = (sent[:num_same] == totals[:num_same]) | \
+           (np.isnan(sent[:num_same]) & np.isnan(totals[:num_same]))
+    first = num_same if same.all() else np.argmin(same)
+    if first < len(totals):
+        callback(dates[first:len(totals)], totals[first:])
+    return totals
+
+def prepare_all_snow_data_chunked(start_date, end_date, chunk_days=None, 
+                                  cube_file=None, callback=None):
+    '''Prepares the COMBINED snow data chunk_days days at a time
+
+Does the same as prepare_all_snow_data, but the HDF data is loaded, QC'd,
+combined and interpolated one chunk of days at a time, so the memory 
+used depends on chunk_days rather than on the length of the record. The
+interpolation is the same as for the whole record, see ChunkedTimeInterp.
+
+chunk_days, cube_file default to settings.SNOW_CHUNK_DAYS/SNOW_CUBE_FILE.
+cube_file: if given, the interpolated data is written to it chunk by 
+           chunk, as a .npy file of shape (num_days, h, w).
+callback: if given, is called after each chunk with the dates and totals
+          of days whose totals have become final (see 
+          ChunkedTimeInterp.num_final_days) or changed since the last 
+          call, e.g. to plot or save the totals as they come in. Nothing
+          in this project passes one, it's for other callers.
+
+Returns a dict with 'dates', 'mask' (the 2D catchment mask), 
+'COMBINED_total_snow', 'COMBINED_percent_snow' and, if there is one,
+'COMBINED_file', the cube_file.
+'''
+    if chunk_days is None:
+        chunk_days = settings.SNOW_CHUNK_DAYS
+    if cube_file is None:
+        cube_file = settings.SNOW_CUBE_FILE
+    dates = np.array(list(daterange(start_date, end_date)))
+    log.info('Preparing all snow data, %i days at a time'%chunk_days)
+
+    # The catchment is the same for every chunk, so only work it out once.
+    if settings.TILES is None:
+        catchment = tile_catchment_mask(
+            modis_index.ModisFileIndex(settings.DATA_DIR), start_date.year,
+            settings.TILE)
+    else:
+        tiles = modis_grid.settings_tiles()
+        catchment = modis_grid.catchment_grid_mask(
+            "%s/Hydrologic_Units/HUC_Polygons.shp"%settings.DATA_DIR, 2)
+
+    interp = None
+    sent = np.zeros(0)
+    for start in range(0, len(dates), chunk_days):
+        chunk_dates = dates[start:start + chunk_days]
+        if settings.TILES is None:
+            all_data = load_snow_hdf_data(chunk_dates[0], chunk_dates[-1], 
+                                          settings.TILE, compact=True, 
+                                          catchment=catchment)
+        else:
+            all_data = load_snow_hdf_mosaic(chunk_dates[0], chunk_dates[-1], 
+                                            tiles, compact=True,
+                                            catchment=catchment)
+        catchment_mask = all_data['mask']
+        # N.B. data and qa each need their own mask.
+        snow_data, qa_data = [ma.array(all_data[key], 
+                                       mask=np.resize(catchment_mask, 
+                                                      all_data[key].shape))
+                              for key in ('data', 'qa')]
+        del all_data
+        data, masked_data, qa_data = combine_snow_data(snow_data, qa_data)
+
+        if interp is None:
+            cube = None
+            if cube_file is not None:
+                if not os.path.exists(os.path.dirname(cube_file) or '.'):
+                    os.makedirs(os.path.dirname(cube_file))
+                cube = np.lib.format.open_memmap(cube_file, mode='w+', 
+                        dtype=float, shape=(len(dates),) + catchment_mask.shape)
+            interp = ChunkedTimeInterp(len(dates), catchment_mask, cube)
+        log.info('  Interpolating %s to %s'%(chunk_dates[0], chunk_dates[-1]))
+        interp.add(masked_data, qa_data)
+
+        if callback is not None:
+            sent = send_new_totals(callback, dates, sent, 
+                                   interp.totals(interp.num_final_days()))
+
+    interp.finish()
+    total_snow_cover = interp.totals()
+    if callback is not None:
+        send_new_totals(callback, dates, sent, total_snow_cover)
+
+    snow = {'dates': dates, 'mask': catchment_mask, 
+            'COMBINED_total_snow': total_snow_cover}
+    if cube_file is not None:
+        interp.cube.flush()
+        snow['COMBINED_file'] = cube_file
+    try:
+        snow['COMBINED_percent_snow'] = 100. * total_snow_cover / \
+                np.max(total_snow_cover[~np.isnan(total_snow_cover)])
+    except:
+        log.warn('Could not produce percent snow cover for COMBINED')
+    return snow
+
+def prepare_basin_snow_data(start_date, end_date, feature_ids, tile='h09v05', 
+        datasets=('AQUA', 'TERRA'), 
+        mask_shape_file="Hydrologic_Units/HUC_Polygons.shp",
+        files_per_read=128, tiles=None):
+    '''Prepares snow data for many catchments (basins) in one pass
+
+All the feature_ids polygons in mask_shape_file are rasterized into one 
+label raster (see load_catchment_labels). The window of each HDF file 
+that covers all of them is read once, and only pixels in one of the 
+basins are kept, so the amount read doesn't depend on how many basins
+there are. These pixels are quality controlled, combined and interpolated 
+over time together, as in prepare_all_snow_data. Files are read 
+files_per_read at a time, so only that many windows are held at once.
+
+tiles: None to read the basins from tile. Otherwise a list of tiles, or 
+       'auto' for all the tiles the basins are on (see 
+       modis_grid.catchments_tiles): the label raster is 
+       made on the MODIS grid (see modis_grid.catchment_grid_labels) and
+       the part of the window on each tile read from its files, as in
+       load_snow_hdf_mosaic, so basins can span many tiles.
+
+Returns a dict with 'dates', 'labels' and 'window' (the label raster and 
+its window in the tile, or on the grid if tiles is given), and 'basins', 
+a dict of feature id -> dict with:
+ 'pixels': (rows, cols) of the basin's pixels in the window.
+ 'COMBINED': interpolated snow cover, shape (num_days, num_pixels).
+ 'COMBINED_total_snow', 'COMBINED_percent_snow': as for 
+ prepare_all_snow_data.
+'''
+    log.info('Preparing snow data for %i basins'%len(feature_ids))
+    file_index = modis_index.ModisFileIndex(settings.DATA_DIR)
+    if tiles is None:
+        labels, window = load_catchment_labels(
+            file_index.any_file(datasets[0], tile, start_date.year), tile, 
+            "%s/%s"%(settings.DATA_DIR, mask_shape_file), feature_ids)
+        ymin, ymax, xmin, xmax = window
+        parts = [(tile, window, (0, ymax - ymin, 0, xmax - xmin))]
+        tiles = [tile]
+    else:
+        labels, window = modis_grid.catchment_grid_labels(
+            "%s/%s"%(settings.DATA_DIR, mask_shape_file), feature_ids)
+        parts = modis_grid.tiles_for_window(window)
+        if tiles == 'auto':
+            tiles = modis_grid.catchments_tiles(
+                "%s/%s"%(settings.DATA_DIR, mask_shape_file), feature_ids)
+    dates = list(daterange(start_date, end_date))
+
+    # Pixels in any basin, ordered by basin.
+    rows, cols = np.where(labels != 0)
+    order = np.argsort(labels[rows, cols], kind='mergesort')
+    rows, cols = rows[order], cols[order]
+    basin_starts = np.searchsorted(labels[rows, cols], 
+                                   np.arange(1, len(feature_ids) + 2))
+    log.info('  Window %s, %i pixels in basins'%(str(window), len(rows)))
+
+    num_files = len(dates) * len(datasets)
+    data    = np.empty((num_files, len(rows)), dtype=np.uint8)
+    qa_data = np.empty((num_files, len(rows)), dtype=np.uint8)
+    for part_tile, (ymin, ymax, xmin, xmax), part_window in parts:
+        # Basin pixels on this part of the window.
+        on_part = np.where((rows >= part_window[0]) & 
+                           (rows < part_window[1]) &
+                           (cols >= part_window[2]) & 
+                           (cols < part_window[3]))[0]
+        if len(on_part) == 0:
+            continue
+        part_rows = rows[on_part] - part_window[0]
+        part_cols = cols[on_part] - part_window[2]
+        if part_tile not in tiles:
+            log.warn("  Basins are on tile %s which isn't in %s, they will "
+                     "be missing there"%(part_tile, str(tiles)))
+            data[:, on_part]    = 200 # Missing value code.
+            qa_data[:, on_part] = 1   # 'Other' quality
+            continue
+        file_names = find_snow_files(file_index, start_date, end_date, 
+                                     part_tile, datasets)[1]
+
+        window_shape = (min(files_per_read, num_files), ymax - ymin, 
+                        xmax - xmin)
+        window_data = np.zeros(window_shape, dtype=np.uint8)
+        window_qa   = np.zeros(window_shape, dtype=np.uint8)
+        for start in range(0, num_files, files_per_read):
+            read_file_names = file_names[start:start + files_per_read]
+            log.info("  Reading files %i-%i of %i for tile %s"%(start + 1, 
+                     start + len(read_file_names), num_files, part_tile))
+            results = load_hdf_files(read_file_names, xmin, xmax, ymin, ymax,
+                                     window_data, window_qa, 
+                                     settings.HDF_READ_WORKERS)
+            for i, (file_name, result) in enumerate(zip(read_file_names, 
+                                                        results)):
+                if isinstance(result, Exception):
+                    log.warn('COULD NOT LOAD FILE: %s'%(
+                             file_name.split('/')[-1]))
+                    log.warn('Exception: %s'%(result))
+
+                if result is True:
+                    data[start + i, on_part] = \
+                        window_data[i][part_rows, part_cols]
+                    qa_data[start + i, on_part] = \
+                        window_qa[i][part_rows, part_cols]
+                else:
+                    data[start + i, on_part]    = 200 # Missing value code.
+                    qa_data[start + i, on_part] = 1   # 'Other' quality
+    file_index.save()
+
+    # Pixels are laid out as a (num_pixels, 1) image, so they can be 
+    # prepared in the same way as a catchment's window.
+    shape = data.shape + (1,)
+    snow_data = prepare_snow_data({
+        'dates': np.array(dates),
+        'data': ma.array(data.reshape(shape), mask=np.zeros(shape, bool)),
+        'qa': ma.array(qa_data.reshape(shape), mask=np.zeros(shape, bool))})
+    combined = snow_data['COMBINED'][:, :, 0]
+
+    basins = {}
+    for i, feature_id in enumerate(feature_ids):
+        basin = slice(basin_starts[i], basin_starts[i + 1])
+        basin_data = {'pixels': (rows[basin], cols[basin]),
+                      'COMBINED': combined[:, basin]}
+        if basin.stop == basin.start:
+            log.warn('  No pixels in basin %s'%feature_id)
+        else:
+            total_snow_cover = combined[:, basin].sum(axis=1)
+            basin_data['COMBINED_total_snow'] = total_snow_cover
+            basin_data['COMBINED_percent_snow'] = 100. * total_snow_cover / \
+                np.max(total_snow_cover[~np.isnan(total_snow_cover)])
+        basins[feature_id] = basin_data
+
+    return {'dates': np.array(dates), 'labels': labels, 
+            'window': window, 'basins': basins}
+
+def prepare_temperature_data(start_date, end_date, time_axis=None):
+    '''Loads in temperature data between dates provided.
+
+If time_axis is given, the data is added to it as 'temperature'.'''
     log.info('Preparing temperature data')
-    temp_data = np.loadtxt('%s/delnorteT.dat'%settings.DATA_DIR, 
-                           unpack=True, 
-                           dtype=str)[:, 1:] # First val should be skipped.
-    dates = []
-    for i in range(temp_data.shape[1]):
-        dates.append("-".join(temp_data[:3, i]))
-    dates = np.array(dates)
+    temp_data = station_data.load_temperature_data()
 
-    date_range = np.where(vec_is_in_date_range(dates, start_date, end_date))[0]
-    temp_data_in_range = temp_data[3:5, date_range].astype(float)
+    date_range = station_data.date_range_index(temp_data['dates'],
+                                               start_date, end_date)
+    temp_data_in_range = temp_data['temp'][date_range].T
+    if time_axis is not None:
+        time_axis.add_dated_series('temperature', 
+                                   temp_data['dates'][date_range])
 
     # temp_data_for_year is a min and max: take its average.
     av_temp_data_in_range = temp_data_in_range.mean(axis=0)
@@ -371,49 +1223,41 @@ def prepare_temperature_data(start_date, end_date):
 
     return interp_av_data_in_range
 
-def is_in_date_range(date_string, start_date, end_date):
-    '''Compares a datestring in format %Y-%m-%d with a date range'''
-    date = dt.datetime.strptime(date_string, '%Y-%m-%d')
-    return start_date <= date <= end_date
+def prepare_discharge_data(start_date, end_date, time_axis=None):
+    '''Loads in discharge data between dates provided.
 
-# np.where(...) won't work unless you vectorise it first.
-vec_is_in_date_range = np.vectorize(is_in_date_range)
-
-def prepare_discharge_data(start_date, end_date):
-    '''Loads in discharge data between dates provided.'''
+If time_axis is given, the data is added to it as 'discharge'.'''
     log.info('Preparing discharge data')
-    discharge_data = np.loadtxt('%s/delnorte.dat'%settings.DATA_DIR, 
-	                        usecols=(2, 3), unpack=True, dtype=str)
+    discharge_data = station_data.load_discharge_data()
 
-    date_range = np.where(vec_is_in_date_range(discharge_data[0], 
-	                                       start_date, end_date))[0]
+    date_range = station_data.date_range_index(discharge_data['dates'],
+	                                       start_date, end_date)
+    discharge = discharge_data['discharge'][date_range]
+    discharge_masked = np.ma.array(discharge, 
+                          mask=discharge == station_data.DISCHARGE_MISSING)
     # Convert from cubic feet to m^3
-    discharge_data_in_range = discharge_data[1, date_range].astype(float)\
-	                      * 0.028316846 
+    discharge_data_in_range = discharge_masked * 0.028316846
+    if time_axis is not None:
+        time_axis.add_dated_series('discharge', 
+                                   discharge_data['dates'][date_range])
 
     return discharge_data_in_range
 
-def prepare_precip_data(start_date, end_date):
-    '''Loads in precipitation data between dates provided.'''
-    log.info('Preparing precipitation data')
-    def convert_date(date_str):
-        return dt.datetime.strptime(date_str, '%Y%m%d')
-    vec_c_d = np.vectorize(convert_date)
+def prepare_precip_data(start_date, end_date, time_axis=None):
+    '''Loads in precipitation data between dates provided.
 
-    csvr = csv.reader(open('data_files/creede_water_treatment_data.csv', 'r'))
-
-    lines = []
-    for line in csvr:
-        lines.append(line)
-        
-    lines = np.array(lines)
-
-    precip = lines[1:, 21].astype(int)
-    precip_masked = np.ma.array(precip, mask=precip == -9999)
+If time_axis is given, the data is added to it as 'precip'.'''
+    log.info('Preparing precipitation data')
+    precip_data = station_data.load_precip_data()
 
-    dates = vec_c_d(lines[1:, 5])
+    precip = precip_data['precip']
+    precip_masked = np.ma.array(precip, 
+                                mask=precip == station_data.PRECIP_MISSING)
 
-    date_mask = (dates >= start_date) & (dates <= end_date)
+    date_mask = station_data.date_range_index(precip_data['dates'],
+                                              start_date, end_date)
+    if time_axis is not None:
+        time_axis.add_dated_series('precip', precip_data['dates'][date_mask])
 
     x = np.arange(len(precip_masked[date_mask]))
     y_masked = precip_masked[date_mask].data[~precip_masked[date_mask].mask]
@@ -423,22 +1267,96 @@ def prepare_precip_data(start_date, end_date):
 
     return y
 
+def prepare_input_files(start_date, end_date, tiles=None, 
+                        datasets=('AQUA', 'TERRA'),
+                        mask_shape_file="Hydrologic_Units/HUC_Polygons.shp"):
+    '''Returns the names of all files that prepare_all_data reads
+
+These are the station data files, the catchment shape file (and its
+.shx, .dbf... files) and the HDF files for each day on each of tiles 
+(by default the tiles from settings, see modis_grid.settings_tiles), so
+that they can be fingerprinted (see checkpoint.py). Missing HDF files 
+are left out.
+'''
+    if tiles is None:
+        tiles = modis_grid.settings_tiles()
+    file_names = ['%s/%s'%(settings.DATA_DIR, station_data.DISCHARGE_FILE),
+                  '%s/%s'%(settings.DATA_DIR, station_data.TEMPERATURE_FILE),
+                  station_data.PRECIP_FILE]
+    file_names.extend(sorted(glob.glob('%s/%s.*'%(settings.DATA_DIR, 
+                                     os.path.splitext(mask_shape_file)[0]))))
+
+    file_index = modis_index.ModisFileIndex(settings.DATA_DIR)
+    for tile in tiles:
+        for date in daterange(start_date, end_date):
+            for dataset in datasets:
+                file_name = file_index.lookup(dataset, tile, date)
+                if file_name is not None:
+                    file_names.append(file_name)
+    file_index.save()
+    return file_names
+
 def prepare_all_data():
     """Prepares MODIS, temperature, discharge and snow data
 uses settings to get its date ranve. 
 
-returns a dict with the following keys: precip, temperature, discharge and snow.
+returns a dict with the following keys: precip, temperature, discharge and snow,
+and time_axis, a TimeAxis which says which days each of the others covers.
+If settings.SNOW_BASIN_IDS is set, basin_snow has snow data for each of
+those catchments (see prepare_basin_snow_data).
 """
     start_date = settings.START_DATE
     end_date = settings.END_DATE
 
     data = {}
-
-    data['precip']      = prepare_precip_data(start_date, end_date)
-    data['temperature'] = prepare_temperature_data(start_date, end_date)
-    data['discharge']   = prepare_discharge_data(start_date, end_date)
+    time_axis = TimeAxis(start_date, end_date)
+    data['time_axis'] = time_axis
+
+    data['precip']      = prepare_precip_data(start_date, end_date, time_axis)
+    data['temperature'] = prepare_temperature_data(start_date, end_date, 
+                                                   time_axis)
+    data['discharge']   = prepare_discharge_data(start_date, end_date, 
+                                                 time_axis)
     data['snow']        = prepare_all_snow_data(start_date, end_date)
+    time_axis.add_series('snow', data['snow']['dates'][0], 
+                         len(data['snow']['dates']))
+    if settings.SNOW_BASIN_IDS:
+        basin_tiles = None
+        if settings.TILES is not None:
+            basin_tiles = modis_grid.settings_tiles()
+        data['basin_snow'] = prepare_basin_snow_data(start_date, end_date,
+                                                     settings.SNOW_BASIN_IDS,
+                                                     settings.TILE, 
+                                                     tiles=basin_tiles)
+
+    return data
 
+def detach_snow_cubes(data, file_prefix):
+    '''Moves the snow cubes in data (from prepare_all_data) out to files
+
+So that data can be pickled (e.g. as a checkpoint) without them. The raw 
+snow 'data' and 'qa' stacks are dropped, nothing after preparation uses
+them. The COMBINED cube is saved to <file_prefix>_snow.npy and replaced by
+'COMBINED_file' and the 2D 'mask', as prepare_all_snow_data_chunked does
+with a cube_file, and each basin's to <file_prefix>_basin_<id>.npy.
+Returns data.'''
+    if not os.path.exists(os.path.dirname(file_prefix)):
+        os.makedirs(os.path.dirname(file_prefix))
+    snow = data['snow']
+    if 'COMBINED' in snow:
+        cube = snow.pop('COMBINED')
+        # The catchment mask, which is the same for every element.
+        snow['mask'] = ma.getmaskarray(snow['data'][0])
+        snow['COMBINED_file'] = '%s_snow.npy'%file_prefix
+        np.save(snow['COMBINED_file'], ma.getdata(cube))
+    for key in ('data', 'qa'):
+        snow.pop(key, None)
+
+    if 'basin_snow' in data:
+        for feature_id, basin in data['basin_snow']['basins'].items():
+            basin['COMBINED_file'] = '%s_basin_%s.npy'%(file_prefix, 
+                                                        feature_id)
+            np.save(basin['COMBINED_file'], basin.pop('COMBINED'))
     return data
 
 if __name__ == "__main__":
@@ -71,7 +71,16 @@ Produces on image with 4 separate figs, each fig is a
 represenation of the catchment one for each season.
 '''
 	data = self.preparation_data
-	snow_data = data['snow']['COMBINED']
+	if 'COMBINED' in data['snow']:
+	    snow_data = data['snow']['COMBINED']
+	elif 'COMBINED_file' in data['snow']:
+	    # Prepared in chunks, only the days shown are read from disk.
+	    cube = np.load(data['snow']['COMBINED_file'], mmap_mode='r')
+	    mask = data['snow']['mask']
+	    snow_data = [np.ma.array(day, mask=mask) for day in cube]
+	else:
+	    log.warn('  No snow data kept (see SNOW_CUBE_FILE), not plotting it')
+	    return
 	dates = data['snow']['dates']
 
 	im_dates = [dt.datetime(2008, 01, 01),
@@ -238,6 +247,12 @@ with a linear regression fitted.
 	    # Make sure plt_dates is same length as discharge_for_year.
 	    ax1.plot_date(plt_dates[:len(discharge_for_year)], discharge_for_year, 'k', label='observed')
 	    ax1.plot_date(plt_dates, func(p_est, model_data), 'k--', label='modelled')
+	    if 'ensemble' in apply_data:
+		ens = apply_data['ensemble']
+		ax1.fill_between(plt_dates, ens['bands'].min(axis=0), 
+			         ens['bands'].max(axis=0), color='0.8', 
+				 label='%s-%s%% of ensemble'%(min(ens['percentiles']),
+				                              max(ens['percentiles'])))
 	    ax1.set_ylabel(r'Discharge ($m^3/s$)')
 	    date_fmt = matplotlib.dates.DateFormatter("%b")
 	    ax1.xaxis.set_major_formatter(date_fmt)
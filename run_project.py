@@ -32,12 +32,36 @@ copy the file 'default_settings.py' to 'project_settings.py'""")
 # Import all local dependencies.
 import download
 import prepare
+import station_data
+import time_axis
+import snow_cube
+import modis_index
+import modis_grid
 import calibrate
+import ensemble
 import apply_model
+from external import raster_mask, helpers, snow_model_accum
 from results import Results
+from checkpoint import Checkpointer
 
 log = logging.getLogger('run_project')
 
+# Settings and modules that the output of each checkpointed stage depends 
+# on (see checkpoint.py). Settings that only change how fast a stage runs 
+# (e.g. HDF_READ_WORKERS) or how results are shown are left out.
+PREPARE_SETTINGS = ('DATA_DIR', 'START_DATE', 'END_DATE', 'TILE', 'TILES', 
+                    'SNOW_BASIN_IDS', 'SNOW_CHUNK_DAYS', 'SNOW_CUBE_FILE')
+PREPARE_MODULES = (prepare, station_data, time_axis, snow_cube, modis_index,
+                   modis_grid, raster_mask, helpers)
+CALIBRATE_SETTINGS = ('CAL_START_DATE', 'CAL_END_DATE', 'CAL_METHOD', 
+                      'CAL_GLOBAL_SEARCH', 'CAL_NUM_STARTS', 'NRF_ENGINE')
+CALIBRATE_MODULES = (calibrate, snow_model_accum)
+APPLY_SETTINGS = ('APP_START_DATE', 'APP_END_DATE', 'ENSEMBLE_SIZE', 
+                  'ENSEMBLE_SAMPLING', 'ENSEMBLE_SPREAD', 
+                  'ENSEMBLE_PERCENTILES', 'ENSEMBLE_RESIDUAL_NOISE', 
+                  'NRF_ENGINE')
+APPLY_MODULES = (apply_model, ensemble, calibrate, snow_model_accum)
+
 def run():
     '''Entry point for project. 
 
@@ -49,6 +73,12 @@ def run():
 * Applies model to data
 * Checks model against (dfferent) data
 * Outputs results (graphs/stats etc.)
+
+The outputs of preparation, calibration and application are checkpointed
+(see checkpoint.Checkpointer), so only stages whose inputs have changed 
+are rerun. Turning off a stage with its RUN_* setting uses its last
+checkpoint. If checkpoints are disabled (settings.ENABLE_CHECKPOINTS), 
+stages that are turned off are just skipped.
 '''
     results_dir = 'results'
     output_dir = '%s/%s'%(results_dir,
@@ -101,22 +131,52 @@ def run():
         log.info('Downloading MODIS files') 
         download.download_all_modis_files()
     
-    if settings.RUN_DATA_PREPARATION:
-        log.info('Preparing data') 
-        data = prepare.prepare_all_data()
-	results.set_preparation_data(data)
+    checkpointer = Checkpointer()
+    prepare_key = cal_key = None
 
-    if settings.RUN_MODEL_CALIBRATION:
+    if checkpointer.enabled or settings.RUN_DATA_PREPARATION:
+        log.info('Preparing data') 
+        input_files = []
+        if checkpointer.enabled:
+            input_files = prepare.prepare_input_files(settings.START_DATE, 
+                                                      settings.END_DATE)
+        prepare_key = checkpointer.key('prepare', PREPARE_SETTINGS, 
+                                       input_files, PREPARE_MODULES)
+        def prepare_data():
+            data = prepare.prepare_all_data()
+            if checkpointer.enabled:
+                # Only references to the snow cubes are checkpointed.
+                prepare.detach_snow_cubes(data, checkpointer.file_prefix(
+                                          'prepare', prepare_key))
+            return data
+        data, prepare_key = checkpointer.run('prepare', prepare_key, 
+                                    prepare_data, 
+                                    recompute=settings.RUN_DATA_PREPARATION)
+        results.set_preparation_data(data)
+
+    if checkpointer.enabled or settings.RUN_MODEL_CALIBRATION:
         log.info('Calibrating model')
-        cal_data = calibrate.calibrate_model(data, 
-		       settings.CAL_START_DATE, settings.CAL_END_DATE)
-	results.set_cal_data(cal_data)
-
-    if settings.RUN_MODEL_APPLICATION:
+        cal_key = checkpointer.key('calibrate', CALIBRATE_SETTINGS, 
+                                   modules=CALIBRATE_MODULES, 
+                                   upstream_keys=[prepare_key])
+        cal_data, cal_key = checkpointer.run('calibrate', cal_key, 
+                                    calibrate.calibrate_model, 
+                                    (data, settings.CAL_START_DATE, 
+                                     settings.CAL_END_DATE),
+                                    recompute=settings.RUN_MODEL_CALIBRATION)
+        results.set_cal_data(cal_data)
+
+    if checkpointer.enabled or settings.RUN_MODEL_APPLICATION:
         log.info('Applying model to new data')
-        apply_data = apply_model.apply_model(data, cal_data, 
-		         settings.APP_START_DATE, settings.APP_END_DATE)
-	results.set_apply_data(apply_data)
+        apply_key = checkpointer.key('apply', APPLY_SETTINGS, 
+                                     modules=APPLY_MODULES, 
+                                     upstream_keys=[prepare_key, cal_key])
+        apply_data, apply_key = checkpointer.run('apply', apply_key, 
+                                    apply_model.apply_model,
+                                    (data, cal_data, settings.APP_START_DATE, 
+                                     settings.APP_END_DATE),
+                                    recompute=settings.RUN_MODEL_APPLICATION)
+        results.set_apply_data(apply_data)
 
     results.generate_results()
     return results
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+import os
+import json
+import shutil
+import logging
+import datetime as dt
+
+import numpy as np
+import numpy.ma as ma
+
+log = logging.getLogger('snow_cube')
+
+# Values used in present.dat for each day and dataset.
+NOT_PRESENT = 0       # Nothing stored for this day yet, or its file
+                      # couldn't be read.
+READ_FROM_FILE = 1    # Data read from an HDF file.
+FILLED_WITH_DUMMY = 2 # File was missing, holds dummy data.
+
+INDEX_FILE = 'index.json'
+MASK_FILE = 'mask.npy'
+CUBE_FILES = ('snow.dat', 'qa.dat')
+PRESENT_FILE = 'present.dat'
+SOURCES_FILE = 'sources.dat'
+
+# Fingerprint used for files that don't exist.
+NO_FILE = (-1., -1.)
+
+class SnowCubeStore:
+    """On disk, memory-mapped store of the cropped snow and QA data
+
+Everything is stored in store_dir:
+index.json: tile, datasets, window, first date and number of days stored.
+mask.npy: 2D catchment mask, stored once.
+snow.dat, qa.dat: uint8 arrays of shape (num_days * num_datasets, h, w),
+                  one slice per day and dataset, ordered like the data from
+                  load_snow_hdf_data: [AQUA, TERRA, AQUA, TERRA...]
+present.dat: int8 array of shape (num_days, num_datasets), says what is
+             stored in each slice (see NOT_PRESENT etc. above).
+sources.dat: float64 array of shape (num_days, num_datasets, 2), the
+             fingerprint (mtime, size) of the HDF file each slice came from,
+             used to tell if a slice is out of date.
+
+The files grow as dates are added, and any date range can be opened as
+a memory-mapped view without reading in the whole store.
+"""
+    def __init__(self, store_dir, tile, datasets, window, catchment_mask):
+        """Opens the store in store_dir, creating it if necessary
+
+If a store exists but was made with a different tile, datasets,
+window (ymin, ymax, xmin, xmax) or mask, it is emptied.
+        """
+        self.store_dir = store_dir
+        self.tile = tile
+        self.datasets = tuple(datasets)
+        self.window = tuple(int(v) for v in window)
+        self.catchment_mask = np.asarray(catchment_mask, dtype=bool)
+        self.shape = self.catchment_mask.shape
+
+        self.first_date = None
+        self.num_days = 0
+
+        index_file = os.path.join(store_dir, INDEX_FILE)
+        if os.path.exists(index_file):
+            try:
+                index = json.load(open(index_file, 'r'))
+                mask = np.load(os.path.join(store_dir, MASK_FILE))
+                if (index['tile'] == self.tile and
+                    tuple(index['datasets']) == self.datasets and
+                    tuple(index['window']) == self.window and
+                    mask.shape == self.shape and
+                    (mask == self.catchment_mask).all()):
+                    self.first_date = dt.datetime.strptime(
+                        index['first_date'], '%Y-%m-%d')
+                    self.num_days = index['num_days']
+                else:
+                    log.info('  Snow cube store does not match, emptying it')
+                    self._empty()
+            except KeyboardInterrupt:
+                raise
+            except Exception, e:
+                log.warn("  COULDN'T OPEN SNOW CUBE STORE, emptying it")
+                log.warn('  Exception: %s'%(e))
+                self._empty()
+        else:
+            self._empty()
+
+    def _empty(self):
+        '''Removes all data from the store, and writes out the mask'''
+        if os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        os.makedirs(self.store_dir)
+        np.save(os.path.join(self.store_dir, MASK_FILE), self.catchment_mask)
+        self.first_date = None
+        self.num_days = 0
+        self._write_index()
+
+    def _write_index(self):
+        index = {'tile': self.tile,
+                 'datasets': self.datasets,
+                 'window': self.window,
+                 'first_date': self.first_date and
+                               self.first_date.strftime('%Y-%m-%d'),
+                 'num_days': self.num_days}
+        index_file = os.path.join(self.store_dir, INDEX_FILE)
+        json.dump(index, open(index_file + '.tmp', 'w'))
+        os.rename(index_file + '.tmp', index_file)
+
+    def _slice_size(self):
+        '''Number of bytes for one day in each cube file'''
+        return len(self.datasets) * self.shape[0] * self.shape[1]
+
+    def extend(self, start_date, end_date):
+        '''Makes sure the store can hold all days from start_date to end_date
+
+Adding later dates just extends the files, adding earlier dates means
+they have to be rewritten.'''
+        if self.first_date is None:
+            self.first_date = start_date
+        elif start_date < self.first_date:
+            num_new_days = (self.first_date - start_date).days
+            log.info('  Adding %i days to start of snow cube store'%
+                     num_new_days)
+            for file_name, size in self._file_sizes(num_new_days):
+                path = os.path.join(self.store_dir, file_name)
+                with open(path + '.tmp', 'wb') as new_file:
+                    new_file.truncate(size)
+                    new_file.seek(size)
+                    with open(path, 'rb') as old_file:
+                        shutil.copyfileobj(old_file, new_file)
+                os.rename(path + '.tmp', path)
+            self.first_date = start_date
+            self.num_days += num_new_days
+
+        num_days = (end_date - self.first_date).days + 1
+        if num_days > self.num_days:
+            self.num_days = num_days
+            for file_name, size in self._file_sizes(self.num_days):
+                # Extends file with zeros.
+                with open(os.path.join(self.store_dir, file_name), 'ab') as f:
+                    f.truncate(size)
+        self._write_index()
+
+    def _file_sizes(self, num_days):
+        '''Size in bytes of each file needed to hold num_days'''
+        sizes = [(file_name, num_days * self._slice_size())
+                 for file_name in CUBE_FILES]
+        sizes.append((PRESENT_FILE, num_days * len(self.datasets)))
+        sizes.append((SOURCES_FILE, num_days * len(self.datasets) * 2 * 8))
+        return sizes
+
+    def _day_range(self, start_date, end_date):
+        '''Indices of first and one past last days in the store'''
+        return ((start_date - self.first_date).days,
+                (end_date - self.first_date).days + 1)
+
+    def contains(self, start_date, end_date):
+        '''Whether the store covers all days from start_date to end_date'''
+        return (self.first_date is not None and
+                self.first_date <= start_date and
+                (end_date - self.first_date).days < self.num_days)
+
+    def open(self, start_date, end_date, mode='c'):
+        '''Opens views of the days from start_date to end_date
+
+mode is passed to np.memmap: 'c' (default) means that changes to the
+views are not written back to disk, 'r+' means that they are.
+
+Returns a tuple (snow, qa, present, sources) of memory-mapped arrays.'''
+        if not self.contains(start_date, end_date):
+            raise Exception('Snow cube store does not contain %s to %s'%(
+                            start_date, end_date))
+        start, end = self._day_range(start_date, end_date)
+        num_datasets = len(self.datasets)
+
+        views = []
+        for file_name in CUBE_FILES:
+            cube = np.memmap(os.path.join(self.store_dir, file_name),
+                             dtype=np.uint8, mode=mode,
+                             shape=(self.num_days * num_datasets,) +
+                                   self.shape)
+            views.append(cube[start * num_datasets:end * num_datasets])
+        present = np.memmap(os.path.join(self.store_dir, PRESENT_FILE),
+                            dtype=np.int8, mode=mode,
+                            shape=(self.num_days, num_datasets))
+        views.append(present[start:end])
+        sources = np.memmap(os.path.join(self.store_dir, SOURCES_FILE),
+                            dtype=np.float64, mode=mode,
+                            shape=(self.num_days, num_datasets, 2))
+        views.append(sources[start:end])
+        return tuple(views)
+
+    def find_stale(self, start_date, end_date, fingerprints):
+        '''Works out which slices from start_date to end_date need reading
+
+fingerprints: array of shape (num_days * num_datasets, 2), the current
+(mtime, size) of each slice's HDF file (see file_fingerprint).
+
+Returns a bool array, True for slices that aren't stored yet, or were 
+stored from a file that has since changed, appeared or disappeared.'''
+        self.extend(start_date, end_date)
+        present, sources = self.open(start_date, end_date, mode='r')[2:]
+        fingerprints = np.asarray(fingerprints, dtype=np.float64)
+        return ((present.ravel() == NOT_PRESENT) | 
+                (sources.reshape(-1, 2) != fingerprints).any(axis=1))
+
+    def update(self, start_date, end_date, slices, snow, qa, present, sources):
+        '''Writes some slices for days start_date to end_date into the store
+
+slices: indices of the slices in the date range to write, where slice 
+        i is day i / num_datasets and dataset i % num_datasets.
+snow, qa: arrays of shape (len(slices), h, w).
+present, sources: flag and fingerprint for each slice.
+'''
+        self.extend(start_date, end_date)
+        views = self.open(start_date, end_date, mode='r+')
+        snow_view, qa_view = views[:2]
+        present_view = views[2].reshape(-1)
+        sources_view = views[3].reshape(-1, 2)
+
+        slices = np.asarray(slices, dtype=int)
+        snow_view[slices] = ma.getdata(snow)
+        qa_view[slices] = ma.getdata(qa)
+        present_view[slices] = present
+        sources_view[slices] = sources
+        for view in views:
+            view.flush()
+
+    def load(self, start_date, end_date, compact=False):
+        '''Loads the data for days start_date to end_date
+
+Returns a dict like load_snow_hdf_data's: 'dates', and masked arrays 'data'
+and 'qa', or if compact is True plain arrays 'data' and 'qa' and the 2D
+'mask'. The arrays are memory-mapped, changes are not written to disk.
+'''
+        snow, qa, present = self.open(start_date, end_date)[:3]
+        dates = np.array([start_date + dt.timedelta(i)
+                          for i in range(len(present))])
+        if compact:
+            return {'dates': dates, 'data': np.asarray(snow), 
+                    'qa': np.asarray(qa), 'mask': self.catchment_mask.copy()}
+
+        return_data = {'dates': dates}
+        for key, array in (('data', snow), ('qa', qa)):
+            # Each needs its own mask.
+            mask = np.empty(array.shape, dtype=bool)
+            mask[:] = self.catchment_mask
+            return_data[key] = ma.array(np.asarray(array), mask=mask)
+        return return_data
+
+def file_fingerprint(file_name):
+    '''Returns (mtime, size) of file_name, or NO_FILE if it is None'''
+    if file_name is None:
+        return NO_FILE
+    stat = os.stat(file_name)
+    return (stat.st_mtime, stat.st_size)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+import os
+import logging
+
+import numpy as np
+
+import project_settings as settings
+
+log = logging.getLogger('station_data')
+
+# Bump if the parsed columns change, so old caches aren't used.
+CACHE_VERSION = 2
+
+DISCHARGE_FILE = 'delnorte.dat'
+TEMPERATURE_FILE = 'delnorteT.dat'
+PRECIP_FILE = 'data_files/creede_water_treatment_data.csv'
+
+# Columns in the Creede CSV file.
+PRECIP_DATE_COL = 5
+PRECIP_PRCP_COL = 21
+
+# Values used where values are missing or can't be parsed.
+DISCHARGE_MISSING = -9999.
+TEMPERATURE_MISSING = 9999.
+PRECIP_MISSING = -9999
+
+def load_discharge_data(file_name=None):
+    '''Loads delnorte.dat
+
+Returns a dict with 'dates' (datetime64[D]) and 'discharge' (cubic feet/s,
+DISCHARGE_MISSING where missing).'''
+    if file_name is None:
+        file_name = '%s/%s'%(settings.DATA_DIR, DISCHARGE_FILE)
+    return load_columns(file_name, parse_discharge_file)
+
+def load_temperature_data(file_name=None):
+    '''Loads delnorteT.dat
+
+Returns a dict with 'dates' (datetime64[D]) and 'temp', an array of shape
+(num_days, 2) with the min and max temperature (F) for each day 
+(TEMPERATURE_MISSING where missing).'''
+    if file_name is None:
+        file_name = '%s/%s'%(settings.DATA_DIR, TEMPERATURE_FILE)
+    return load_columns(file_name, parse_temperature_file)
+
+def load_precip_data(file_name=None):
+    '''Loads the Creede water treatment CSV file
+
+Returns a dict with 'dates' (datetime64[D]) and 'precip' (tenths of mm,
+PRECIP_MISSING where missing).'''
+    if file_name is None:
+        file_name = PRECIP_FILE
+    return load_columns(file_name, parse_precip_file)
+
+def parse_discharge_file(file_name):
+    '''Parses columns of delnorte.dat, e.g. USGS 08220000 2005-01-01 123 A'''
+    columns = parse_typed_columns(file_name, (('date', 'S10'), 
+                                              ('discharge', float)),
+                                  DISCHARGE_MISSING, usecols=(2, 3))
+    return {'dates': columns['date'].astype('datetime64[D]'),
+            'discharge': columns['discharge']}
+
+def parse_temperature_file(file_name):
+    '''Parses columns of delnorteT.dat: year, month, day, min/max temp'''
+    # First line should be skipped.
+    columns = parse_typed_columns(file_name, (('year', int), ('month', int), 
+                                              ('day', int), ('min', float), 
+                                              ('max', float)),
+                                  TEMPERATURE_MISSING, usecols=range(5), 
+                                  skip_header=1)
+    return {'dates': ymd_to_datetime64(columns['year'], columns['month'], 
+                                       columns['day']),
+            'temp': np.column_stack((columns['min'], columns['max']))}
+
+def parse_precip_file(file_name):
+    '''Parses the DATE (%Y%m%d) and PRCP columns of the Creede CSV file'''
+    columns = parse_typed_columns(file_name, (('date', int), 
+                                              ('precip', float)),
+                                  PRECIP_MISSING, delimiter=',', 
+                                  skip_header=1, 
+                                  usecols=(PRECIP_DATE_COL, PRECIP_PRCP_COL))
+    dates = columns['date']
+    return {'dates': ymd_to_datetime64(dates / 10000, dates / 100 % 100,
+                                       dates % 100),
+            'precip': columns['precip'].astype(int)}
+
+def parse_typed_columns(file_name, columns, missing, **kwargs):
+    '''Parses columns of file_name with np.genfromtxt
+
+columns: (name, dtype) of each column read (see usecols in kwargs).
+Float values that are empty or can't be parsed are set to missing, and
+how many there were is logged.
+
+Returns a dict of name -> array.'''
+    table = np.atleast_1d(np.genfromtxt(file_name, dtype=list(columns), 
+                                        **kwargs))
+    parsed = {}
+    for name, dtype in columns:
+        parsed[name] = table[name].copy()
+        if parsed[name].dtype.kind == 'f':
+            bad = np.isnan(parsed[name])
+            if bad.any():
+                log.warn('  %i %s values in %s are missing or could not be '
+                         'parsed, set to %s'%(bad.sum(), name, file_name, 
+                                              missing))
+                parsed[name][bad] = missing
+    return parsed
+
+def ymd_to_datetime64(years, months, days):
+    '''Turns arrays of year, month and day into a datetime64[D] array'''
+    return ((np.asarray(years) - 1970).astype('datetime64[Y]') +
+            (np.asarray(months) - 1).astype('timedelta64[M]')
+           ).astype('datetime64[D]') + (np.asarray(days) - 1)
+
+def load_columns(file_name, parse):
+    '''Loads the columns of file_name using parse, caching them if enabled
+
+The parsed columns are saved in <data_dir>/cache/station_<file name>.npz,
+and only reparsed if file_name has changed since they were saved.'''
+    if not settings.CACHE_STATION_DATA:
+        return parse(file_name)
+
+    stat = os.stat(file_name)
+    fingerprint = np.array([CACHE_VERSION, stat.st_mtime, stat.st_size])
+    cache_file = '%s/cache/station_%s.npz'%(settings.DATA_DIR,
+                                            os.path.basename(file_name))
+    if os.path.exists(cache_file):
+        try:
+            cache = np.load(cache_file)
+            if (cache['fingerprint'] == fingerprint).all():
+                log.debug('  Loaded %s from cache'%file_name)
+                return dict((k, cache[k]) for k in cache.files
+                            if k != 'fingerprint')
+        except KeyboardInterrupt:
+            raise
+        except Exception, e:
+            log.warn("  COULDN'T LOAD STATION DATA CACHE, reparsing")
+            log.warn('  Exception: %s'%(e))
+
+    columns = parse(file_name)
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    # N.B. np.savez adds .npz if it's not there.
+    np.savez(cache_file + '.tmp.npz', fingerprint=fingerprint, **columns)
+    os.rename(cache_file + '.tmp.npz', cache_file)
+    return columns
+
+def date_range_index(dates, start_date, end_date):
+    '''Selects dates between start_date and end_date (inclusive)
+
+dates: datetime64[D] array.
+start_date, end_date: datetime or datetime64.
+
+If dates are sorted this is a slice found by binary search, so indexing
+with it gives a view, otherwise it is an array of indices.'''
+    start = np.datetime64(start_date, 'D')
+    end = np.datetime64(end_date, 'D')
+    if len(dates) < 2 or (dates[1:] >= dates[:-1]).all():
+        return slice(np.searchsorted(dates, start, 'left'),
+                     np.searchsorted(dates, end, 'right'))
+    return np.where((dates >= start) & (dates <= end))[0]
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+import logging
+
+import numpy as np
+
+log = logging.getLogger('time_axis')
+
+class TimeAxis:
+    """Daily time axis that all the prepared data is laid out on
+
+Made once in prepare.prepare_all_data, covering start_date to end_date.
+Each series (discharge, temperature...) is added with the date of its
+first value and its length, so that its coverage of the axis is known.
+Dates are turned into offsets along the axis by subtraction, and periods
+into slices, so selecting a period of any series gives a view of it.
+"""
+    def __init__(self, start_date, end_date):
+        self.start = np.datetime64(start_date, 'D')
+        self.end = np.datetime64(end_date, 'D')
+        if self.end < self.start:
+            raise Exception('Time axis end %s is before start %s'%(self.end,
+                                                                   self.start))
+        # datetime64[D] array of all days on the axis.
+        self.dates = np.arange(self.start, self.end + 1)
+        # Maps series name to (first, one past last) offset of its data.
+        self.coverage = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def offset(self, date):
+        '''Returns the offset of date along the axis'''
+        offset = int((np.datetime64(date, 'D') - self.start).astype(int))
+        if not 0 <= offset < len(self):
+            raise Exception('%s is not on time axis %s to %s'%(date,
+                            self.start, self.end))
+        return offset
+
+    def index(self, start_date, end_date):
+        '''Returns the slice of the axis from start_date to end_date'''
+        return slice(self.offset(start_date), self.offset(end_date) + 1)
+
+    def add_series(self, name, first_date, length):
+        '''Records that series name has length values from first_date'''
+        first = int((np.datetime64(first_date, 'D') - self.start).astype(int))
+        if first < 0 or first + length > len(self):
+            raise Exception('Series %s (%s, %i days) does not fit on time '
+                            'axis %s to %s'%(name, first_date, length,
+                                             self.start, self.end))
+        if length != len(self):
+            log.info('  Series %s only covers %s to %s'%(name,
+                     self.dates[first], self.dates[first + length - 1]))
+        self.coverage[name] = (first, first + length)
+
+    def add_dated_series(self, name, dates):
+        '''Records that series name has values for dates (datetime64[D])
+
+The dates must be consecutive days.'''
+        if len(dates) == 0:
+            raise Exception('Series %s has no data'%name)
+        if int((dates[-1] - dates[0]).astype(int)) + 1 != len(dates):
+            raise Exception('Series %s has missing days between %s and %s'%(
+                            name, dates[0], dates[-1]))
+        self.add_series(name, dates[0], len(dates))
+
+    def common_index(self, names, start_date, end_date):
+        '''Returns the slice of start_date to end_date covered by all names
+
+Logs a warning if this is shorter than the period asked for, e.g. if
+the discharge data stops before end_date.'''
+        index = self.index(start_date, end_date)
+        start, stop = index.start, index.stop
+        for name in names:
+            first, last = self.coverage[name]
+            start, stop = max(start, first), min(stop, last)
+        if stop <= start:
+            raise Exception('No data for all of %s from %s to %s'%(
+                            ', '.join(names), start_date, end_date))
+        if (start, stop) != (index.start, index.stop):
+            log.warn('  Only have data for all of %s from %s to %s'%(
+                     ', '.join(names), self.dates[start], self.dates[stop - 1]))
+        return slice(start, stop)
+
+    def view(self, name, series, index):
+        '''Returns the part of series name that index (a slice of the
+axis) covers, as a view'''
+        first, last = self.coverage[name]
+        if index.start < first or index.stop > last:
+            raise Exception('Series %s does not cover %s to %s'%(name,
+                            self.dates[index.start], self.dates[index.stop - 1]))
+        return series[index.start - first:index.stop - first]
+
+    def datetimes(self, index=slice(None)):
+        '''Returns the dates for index as an array of datetime objects'''
+        return self.dates[index].astype('datetime64[us]').astype(object)